@@ -24,6 +24,7 @@ from master.models import *
 from master.models import Master as MasterModel
 from master.lib.mongo_oplog_watcher import OplogWatcher, OplogPrinter
 from master.lib.amqp_man import AmqpManager
+import master.lib.codec
 import master.watchers
 
 logging.basicConfig(level=logging.DEBUG)
@@ -191,6 +192,11 @@ class Master(object):
 		self._master_obj.queue = []
 		self._master_obj.save()
 
+		# extra slave_status message handlers, {<type>: [callbacks]}
+		self._slave_status_handlers = {}
+		# extra values sent to slaves in their config message
+		self._slave_config = {}
+
 		self._log.info("ready")
 
 	# -------------------------
@@ -241,14 +247,32 @@ class Master(object):
 	# private functions
 	# -------------------------
 
-	def update_status(self, queues=None, vms=None):
+	def add_slave_status_handler(self, type_, callback):
+		"""Also handle slave_status messages of type ``type_`` with ``callback``,
+		which will be called with the decoded message data after the master
+		has handled it
+		"""
+		self._slave_status_handlers.setdefault(type_, []).append(callback)
+
+	def set_slave_config(self, **config):
+		"""Set extra values to be included in the config message that is sent to
+		each new slave
+		"""
+		self._slave_config.update(config)
+
+	def update_status(self, queues=None, vms=None, stats=None):
 		"""Update the master document in mongodb
+
+		:stats: A dict of stats to merge into the master's stats, each top-level
+			key replaces the previous value of that key
 		"""
 		with self._master_obj_lock:
 			if queues is not None:
 				self._master_obj.queues = queues
 			if vms is not None:
 				self._master_obj.vms = vms
+			if stats is not None:
+				self._master_obj.stats.update(stats)
 
 			self._master_obj.save()
 
@@ -278,17 +302,27 @@ class Master(object):
 		"""
 		self._amqp_man.ack_method(method)
 
-		data = json.loads(body)
+		try:
+			data = master.lib.codec.Message.from_dict(master.lib.codec.decode_props(body, props))
+		except Exception as e:
+			self._log.warn("could not decode slave data: {}".format(e))
+			return
+
 		switch = dict(
 			new			= self._handle_slave_new,
 			status		= self._handle_slave_status,
 			heartbeat	= self._handle_slave_heartbeat,
 		)
 
-		if "type" not in data or data["type"] not in switch:
+		if "type" not in data or (data["type"] not in switch and data["type"] not in self._slave_status_handlers):
 			self._log.warn("recieved slave data is in the wrong format")
-		else:
+			return
+
+		if data["type"] in switch:
 			switch[data["type"]](data)
+
+		for callback in self._slave_status_handlers.get(data["type"], []):
+			callback(data)
 	
 	def _handle_slave_status(self, data):
 		"""Handle slave status messages"""
@@ -315,6 +349,9 @@ class Master(object):
 		if "vms" in data:
 			slave.vms = data["vms"]
 
+		if "amqp" in data:
+			slave.stats["amqp"] = data["amqp"]
+
 		slave.timestamps["modified"] = time.time()
 		slave.save()
 	
@@ -336,19 +373,24 @@ class Master(object):
 		slave.timestamps["created"] = datetime.datetime.utcnow()
 		slave.save()
 
+		config = dict(
+			type		= "config",
+			db			= self._ip,
+			code		= dict(
+				loc		= "http://{}/code_cache".format(self._ip),
+
+				# TODO put these in a config file
+				username	= "talus_job",
+				password	= "Monkeys eat bananas and poop all day."
+			),
+			image_url	= "http://{}/images/".format(self._ip),
+			# the slave picks the codec to send messages with from these
+			codecs		= master.lib.codec.available_codecs(),
+		)
+		config.update(self._slave_config)
+
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "config",
-				db			= self._ip,
-				code		= dict(
-					loc		= "http://{}/code_cache".format(self._ip),
-
-					# TODO put these in a config file
-					username	= "talus_job",
-					password	= "Monkeys eat bananas and poop all day."
-				),
-				image_url	= "http://{}/images/".format(self._ip)
-			)),
+			json.dumps(config),
 			self.AMQP_SLAVE_QUEUE + "_" + slave.uuid
 		)
 	
@@ -1,52 +1,149 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import contextlib
 import logging
 import os
+import Queue
 import threading
 import time
 import pika
 
+from master.lib.codec import Codec
+
 pika_logger = logging.getLogger('pika')
 pika_logger.setLevel(logging.CRITICAL)
 
+class ChannelStats(object):
+	"""Counts the operations done on an AmqpChannel and how long they took
+	"""
+
+	def __init__(self):
+		self._ops = 0
+		self._total = 0.0
+		self._peak = 0.0
+		self._lock = threading.Lock()
+
+	def add(self, elapsed):
+		"""Record an operation that took ``elapsed`` seconds
+		"""
+		with self._lock:
+			self._ops += 1
+			self._total += elapsed
+			self._peak = max(self._peak, elapsed)
+
+	def summary(self):
+		"""Return ``{"ops": N, "mean_ms": .., "max_ms": ..}``, the max being
+		since the last call
+		"""
+		with self._lock:
+			res = dict(
+				ops		= self._ops,
+				mean_ms	= (self._total / self._ops * 1000) if self._ops > 0 else None,
+				max_ms	= self._peak * 1000,
+			)
+			self._peak = 0.0
+		return res
+
+class AmqpChannel(object):
+	"""A connection and its one channel. pika's BlockingConnection is not
+	thread-safe, so an AmqpChannel must only be used by one thread at a time.
+	"""
+
+	def __init__(self, name, host, transactional=False):
+		"""init the channel
+
+		:param str name: The name to report stats under
+		:param str host: The host (and port) of the broker
+		:param bool transactional: Whether publishes must be committed with ``tx_commit``
+		"""
+		self.name = name
+		self.stats = ChannelStats()
+		self._host = host
+		self._transactional = transactional
+		self._connect()
+
+	def reconnect(self):
+		"""Replace the connection, e.g. after the channel was closed by an error
+		"""
+		self.close()
+		self._connect()
+
+	def call(self, method_name, *args, **kwargs):
+		"""Call the channel's method ``method_name``, timing how long it takes
+		"""
+		start = time.time()
+		try:
+			return getattr(self.channel, method_name)(*args, **kwargs)
+		finally:
+			self.stats.add(time.time() - start)
+
+	def close(self):
+		try:
+			self.conn.close()
+		except Exception:
+			# the connection was already closed or lost
+			pass
+
+	def _connect(self):
+		self.conn = pika.BlockingConnection(pika.URLParameters("amqp://guest:guest@" + self._host))
+		self.channel = self.conn.channel()
+		if self._transactional:
+			self.channel.tx_select()
+
 class AmqpQueueHandler(threading.Thread):
+	"""Consumes from ``queue_name`` on its own connection, calling ``callback``
+	with each message the broker pushes. At most ``prefetch`` unacked messages
+	are pushed at a time. Messages must be acked from the callback, which runs
+	on this thread.
+	"""
+
 	daemon = True
 
-	def __init__(self, callback, queue_name, channel, lock, no_ack, running):
+	def __init__(self, callback, queue_name, amqp_channel, local, no_ack, running, prefetch=None):
 		super(AmqpQueueHandler, self).__init__()
 
-		self.lock = lock
-		self.channel = channel
+		self.amqp_channel = amqp_channel
+		self.channel = amqp_channel.channel
 		self.queue_name = queue_name
 		self.callback = callback
 		self.no_ack = no_ack
+		self.prefetch = prefetch
+		self._local = local
 		self._running = running
 
 		self._log = logging.getLogger("AmqpMan").getChild(self.queue_name)
-	
+
 	def run(self):
 		self._running.set()
 		self._log.debug("monitoring")
 
+		# acks from the callback go to this thread's channel
+		self._local.channel = self.amqp_channel
+
+		if self.prefetch is not None and not self.no_ack:
+			self.amqp_channel.call("basic_qos", prefetch_count=self.prefetch)
+		self.amqp_channel.call("basic_consume", self._deliver, self.queue_name, no_ack=self.no_ack)
+
 		while self._running.is_set():
-			with self.lock:
-				method, props, body = self.channel.basic_get(
-					self.queue_name,
-					no_ack=self.no_ack
-				)
-			if method is None:
-				time.sleep(0.1)
-				continue
-			#self._log.debug("recieved message")
-			self.callback(self.channel, method, props, body)
+			# returns as soon as a message arrives, the time limit is only to
+			# notice being stopped
+			self.amqp_channel.conn.process_data_events(time_limit=1)
 
+		self.amqp_channel.close()
 		self._log.debug("finished")
 	
 	def stop(self):
 		self._log.debug("stopping")
 		self._running.clear()
 
+	def _deliver(self, channel, method, props, body):
+		#self._log.debug("recieved message")
+		try:
+			self.callback(self.channel, method, props, body)
+		except Exception:
+			self._log.exception("error handling message")
+
 class AmqpManager(threading.Thread):
 	"""A class to manage jobs (starting/stopping/cancelling/etc)"""
 
@@ -55,6 +152,9 @@ class AmqpManager(threading.Thread):
 	AMQP_JOB_QUEUE = "jobs"
 	AMQP_JOB_RESULT_QUEUE = "job_results"
 
+	# how many times to try publishing a window of messages, see queue_msgs
+	CONFIRM_RETRIES = 3
+
 	_INSTANCE = None
 	@classmethod
 	def instance(cls, host=None):
@@ -62,17 +162,36 @@ class AmqpManager(threading.Thread):
 			cls._INSTANCE = cls(host)
 		return cls._INSTANCE
 
-	def __init__(self, host=None):
+	def __init__(self, host=None, prefetch=100, publishers=2, confirm_publishers=1, confirm_window=100):
 		"""init the job manager
+
+		:param int prefetch: The default number of unacked messages the broker
+			may push to each consumer
+		:param int publishers: The number of connections in the pool shared by
+			publishes, declares and queue size checks
+		:param int confirm_publishers: The number of connections in the pool used
+			by ``queue_msgs``
+		:param int confirm_window: The most messages ``queue_msgs`` publishes
+			before waiting for the broker to confirm them
 		"""
 		super(AmqpManager, self).__init__()
 
 		if host is None and "TALUS_AMQP_PORT_5672_TCP" in os.environ:
 			host = os.environ["TALUS_AMQP_PORT_5672_TCP"].replace("tcp://", "")
 		self._amqp_host = host
-
-		self._amqp_conn = None
-		self._amqp_channel = None
+		self._prefetch = prefetch
+		self._num_publishers = publishers
+		self._num_confirm_publishers = confirm_publishers
+		self._confirm_window = confirm_window
+
+		# idle AmqpChannels of the publisher pool, checked out with _publisher()
+		self._publishers = Queue.Queue()
+		# idle transactional AmqpChannels, checked out with _confirmed_publisher()
+		self._confirm_publishers = Queue.Queue()
+		# all of the AmqpChannels, for their stats
+		self._channels = []
+		# the consumer channel of the current thread, see ack_method
+		self._local = threading.local()
 
 		self._running = threading.Event()
 		self._amqp_connected = threading.Event()
@@ -87,7 +206,9 @@ class AmqpManager(threading.Thread):
 		self._queue_props = {}
 		self._queue_handlers = {}
 
-		self._amqp_lock = threading.Lock()
+		# encodes dict messages, see set_codec
+		self._codec = Codec()
+
 		self._handlers_lock = threading.Lock()
 	
 	def do_start(self):
@@ -111,8 +232,8 @@ class AmqpManager(threading.Thread):
 			self.declare_queue(queue_name, **props)
 		for exchange_name, queue in self._cached_bind_queues:
 			self.bind_queue(exchange_name, queue)
-		for queue_name, callback, no_ack in self._cached_queue_consumes:
-			self.consume_queue(queue_name, callback, no_ack=no_ack)
+		for queue_name, callback, no_ack, prefetch in self._cached_queue_consumes:
+			self.consume_queue(queue_name, callback, no_ack=no_ack, prefetch=prefetch)
 
 		self._amqp_ioloop()
 
@@ -124,16 +245,14 @@ class AmqpManager(threading.Thread):
 
 		"""
 		self._log.info("stopping")
-		if self._amqp_channel is not None:
-			try:
-				self._amqp_channel.stop_consuming()
-			except RuntimeError as e:
-				pass
-			try:
-				self._amqp_conn.close()
-			except RuntimeError as e:
-				pass
 		self._running.clear()
+		# the consumers close their own connections
+		for pool in [self._publishers, self._confirm_publishers]:
+			while True:
+				try:
+					pool.get_nowait().close()
+				except Queue.Empty:
+					break
 		
 	def get_message_count(self, queue_name, **props):
 		""" Get the size of the amqp queue ``queue_name``. Note that the ``props``
@@ -146,8 +265,7 @@ class AmqpManager(threading.Thread):
 		if len(props) is None and queue_name in self._queue_props:
 			props = self._queue_props[queue_name]
 
-		with self._amqp_lock:
-			method = self._amqp_channel.queue_declare(queue_name, passive=True, **props)
+		method = self._call_publisher("queue_declare", queue_name, passive=True, **props)
 		res = method.method.message_count
 		return res
 	
@@ -155,10 +273,10 @@ class AmqpManager(threading.Thread):
 		"""Declare an exchange named ``name`` and of type ``type``
 		"""
 		self._log.info("declaring exchange {}, type {}".format(name, type))
-		if self._amqp_channel is None:
+		if not self._amqp_connected.is_set():
 			self._cached_exchange_declares.append((name, type))
 		else:
-			self._amqp_channel.exchange_declare(
+			self._call_publisher("exchange_declare",
 				exchange=name,
 				type=type
 			)
@@ -167,10 +285,10 @@ class AmqpManager(threading.Thread):
 		"""Bind the queue ``queue`` to the exchange ``exchange``
 		"""
 		self._log.info("binding queue {!r} to exchange {!r}".format(queue, exchange))
-		if self._amqp_channel is None:
+		if not self._amqp_connected.is_set():
 			self._cached_bind_queues.append((exchange, queue))
 		else:
-			self._amqp_channel.queue_bind( exchange=exchange,
+			self._call_publisher("queue_bind", exchange=exchange,
 				queue=queue
 			)
 	
@@ -185,30 +303,42 @@ class AmqpManager(threading.Thread):
 		self._log.info("declaring queue {}".format(queue_name))
 
 		self._queue_props[queue_name] = props
-		if self._amqp_channel is None:
+		if not self._amqp_connected.is_set():
 			self._cached_queue_declares.append((queue_name, props))
 		else:
-			self._amqp_channel.queue_declare(
+			self._call_publisher("queue_declare",
 				queue_name,
 				**props
 			)
 	
-	def consume_queue(self, queue_name, callback, no_ack=False):
-		"""Consume from the queue ``queue_name`` with callback ``callback``
+	def consume_queue(self, queue_name, callback, no_ack=False, prefetch=None):
+		"""Consume from the queue ``queue_name`` with callback ``callback``.
+		Each consumer gets its own connection and thread, and messages are
+		pushed by the broker (``basic_consume``), at most ``prefetch`` unacked
+		ones at a time.
+
+		:param int prefetch: The most unacked messages to have pushed to the
+			consumer, defaults to the manager's ``prefetch``
 		"""
 		self._log.info("will consume from queue {}".format(queue_name))
 
-		if self._amqp_channel is None:
-			self._cached_queue_consumes.append((queue_name, callback, no_ack))
+		if prefetch is None:
+			prefetch = self._prefetch
+
+		if not self._amqp_connected.is_set():
+			self._cached_queue_consumes.append((queue_name, callback, no_ack, prefetch))
 		else:
 			with self._handlers_lock:
+				amqp_channel = AmqpChannel("consume:" + queue_name, self._amqp_host)
+				self._channels.append(amqp_channel)
 				handler = AmqpQueueHandler(
 					callback,
 					queue_name,
-					self._amqp_channel,
-					self._amqp_lock,
+					amqp_channel,
+					self._local,
 					no_ack,
-					self._running
+					self._running,
+					prefetch
 				)
 				self._queue_handlers[queue_name] = handler
 				handler.start()
@@ -225,7 +355,8 @@ class AmqpManager(threading.Thread):
 	def queue_msg(self, msg, queue_name, **props):
 		"""Queue the message ``msg`` in  the queue ``queue_name``
 
-		:param str msg: The message to send (str or unicode)
+		:param msg: The message to send, a dict (encoded with the current codec)
+			or an already encoded str
 		:param str queue_name: The queue to put the message in
 		:param dict **props: Any additional props (exchange, etc)
 		"""
@@ -233,24 +364,138 @@ class AmqpManager(threading.Thread):
 			exchange	= ""
 		)
 		default_props.update(props)
-		with self._amqp_lock:
-			self._amqp_channel.basic_publish(
-				routing_key=queue_name,
-				body=msg,
-				**default_props
-			)
+		body,properties = self._encode(msg)
+		self._call_publisher("basic_publish",
+			routing_key=queue_name,
+			body=body,
+			properties=properties,
+			**default_props
+		)
+	
+	def queue_msgs(self, msgs, queue_name, **props):
+		"""Queue all of the messages in ``msgs`` in the queue ``queue_name`` and
+		wait until the broker has accepted them. The messages are published
+		``confirm_window`` at a time without waiting, and each window is
+		confirmed at once. A window that fails is republished on a new
+		connection, up to ``CONFIRM_RETRIES`` times.
+
+		:param list msgs: The messages to send (dicts or encoded strs, see ``queue_msg``)
+		:param str queue_name: The queue to put the messages in
+		:param dict **props: Any additional props (exchange, etc)
+		:returns: The messages that could not be confirmed, an empty list if all were
+		"""
+		if len(msgs) == 0:
+			return []
+
+		default_props = dict(
+			exchange	= ""
+		)
+		default_props.update(props)
+		with self._confirmed_publisher() as publisher:
+			for start in xrange(0, len(msgs), self._confirm_window):
+				window = msgs[start:start + self._confirm_window]
+				if not self._publish_window(publisher, window, queue_name, default_props):
+					return msgs[start:]
+		return []
 	
+	def set_codec(self, name):
+		"""Encode dict messages with the codec ``name`` from now on, see
+		``codec.choose``
+		"""
+		self._codec = Codec(name)
+
 	def ack_method(self, method):
-		"""basic_ack the method
+		"""basic_ack the method. Must be called from the consumer's callback,
+		delivery tags are only valid on the channel that received the message.
 
 		:method: The method to ack
 		"""
-		with self._amqp_lock:
-			self._amqp_channel.basic_ack(delivery_tag=method.delivery_tag)
+		amqp_channel = getattr(self._local, "channel", None)
+		if amqp_channel is None:
+			self._log.error("cannot ack {}, not on a consumer's thread".format(method.delivery_tag))
+			return
+		amqp_channel.call("basic_ack", delivery_tag=method.delivery_tag)
+
+	def channel_stats(self):
+		"""Return ``{<channel name>: {"ops": N, "mean_ms": .., "max_ms": ..}}``
+		of each consumer and publisher channel
+		"""
+		return dict((amqp_channel.name, amqp_channel.stats.summary()) for amqp_channel in list(self._channels))
 	
 	# ---------------------------------------
 	# amqp related
 	# ---------------------------------------
+
+	def _encode(self, msg):
+		"""Return the body and BasicProperties (None for str messages) to
+		publish ``msg`` with
+		"""
+		if not isinstance(msg, dict):
+			return msg, None
+		body,props = self._codec.encode(msg)
+		return body, pika.BasicProperties(**props)
+
+	@contextlib.contextmanager
+	def _publisher(self):
+		"""Check out an AmqpChannel of the publisher pool, waiting for one to be
+		returned if they are all in use
+		"""
+		publisher = self._publishers.get()
+		try:
+			yield publisher
+		finally:
+			self._publishers.put(publisher)
+
+	def _call_publisher(self, method_name, *args, **kwargs):
+		"""Call the channel method ``method_name`` on an AmqpChannel of the
+		publisher pool. If the channel or its connection was closed (e.g. the
+		broker went away, or a passive declare failed) the channel is
+		reconnected and the call is tried once more.
+		"""
+		with self._publisher() as publisher:
+			try:
+				return publisher.call(method_name, *args, **kwargs)
+			except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+				self._log.warn("{} on {} failed, reconnecting: {!r}".format(method_name, publisher.name, e))
+				publisher.reconnect()
+				return publisher.call(method_name, *args, **kwargs)
+
+	@contextlib.contextmanager
+	def _confirmed_publisher(self):
+		"""Check out a transactional AmqpChannel, see ``queue_msgs``
+		"""
+		publisher = self._confirm_publishers.get()
+		try:
+			yield publisher
+		finally:
+			self._confirm_publishers.put(publisher)
+
+	def _publish_window(self, publisher, msgs, queue_name, props):
+		"""Publish ``msgs`` on the transactional ``publisher`` and commit them,
+		retrying on a new connection if that fails. Returns whether the broker
+		accepted the messages.
+		"""
+		for attempt in xrange(self.CONFIRM_RETRIES):
+			try:
+				for msg in msgs:
+					body,properties = self._encode(msg)
+					publisher.call("basic_publish",
+						routing_key=queue_name,
+						body=body,
+						properties=properties,
+						**props
+					)
+				# the messages were only buffered by the broker until now, so a
+				# failed window is never partially delivered
+				publisher.call("tx_commit")
+				return True
+			except Exception as e:
+				self._log.warn("could not publish {} messages to {!r} (attempt {}): {}".format(len(msgs), queue_name, attempt + 1, e))
+				try:
+					publisher.reconnect()
+				except Exception as e:
+					self._log.error("could not reconnect {}: {}".format(publisher.name, e))
+		return False
 	
 	def _amqp_ioloop(self):
 		"""
@@ -262,8 +507,14 @@ class AmqpManager(threading.Thread):
 		"""
 		"""
 		self._log.info("connecting to amqp: {}".format(self._amqp_host))
-		self._amqp_conn = pika.BlockingConnection(pika.URLParameters("amqp://guest:guest@" + self._amqp_host))
-		self._amqp_channel = self._amqp_conn.channel()
+		for x in xrange(max(1, self._num_publishers)):
+			publisher = AmqpChannel("publish:{}".format(x), self._amqp_host)
+			self._channels.append(publisher)
+			self._publishers.put(publisher)
+		for x in xrange(max(1, self._num_confirm_publishers)):
+			publisher = AmqpChannel("confirm:{}".format(x), self._amqp_host, transactional=True)
+			self._channels.append(publisher)
+			self._confirm_publishers.put(publisher)
 
 		self._amqp_connected.set()
 	
@@ -1,19 +1,26 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import collections
 import datetime
 import json
 import logging
+import math
 import os
-try:
-    import Queue as Q  # ver. < 3.0
-except ImportError:
-	import queue as Q
-PQ = Q.PriorityQueue
 import threading
 import time
 
 from master.lib.amqp_man import AmqpManager
+from master.lib.codec import Message, decode_props
+from master.lib.jobs.breaker import CircuitBreaker
+from master.lib.jobs.counters import CoalescedCounters
+from master.lib.jobs.fair_share import BandedRoundRobin, DeficitRoundRobin
+from master.lib.jobs.ingest import BulkInserter
+from master.lib.jobs.job_queue import JobQueue
+from master.lib.jobs.lanes import LanePool
+from master.lib.jobs.rate import RateEstimator, TokenBucket, estimate_eta
+from master.lib.jobs.run_stats import RunStatsTracker
+from master.lib.jobs.wait_times import WaitTimes, aged_order_key
 
 from master.models import *
 from master.models import Master as MasterModel
@@ -24,38 +31,79 @@ logging.basicConfig(level=logging.DEBUG)
 class JobHandler(object):
 	"""A class to handle new jobs"""
 
-	def __init__(self, job, queue_name, job_man):
+	# how long (in seconds) past the job's vm_max an item may go without being
+	# heard from before it is considered lost and returned to the pool
+	ITEM_GRACE = 5*60
+	# the number of recent item run times kept to find stragglers with
+	DURATION_SAMPLES = 100
+
+	def __init__(self, job, queue_name, job_man, checkpoint=None):
 		"""init the job handler
 		
 		:param mongoengine.Document job: A Job model
 		:param str queue_name: The name of the queue this job will drip into
+		:param mongoengine.Document checkpoint: The JobCheckpoint of the job, if it was
+			already running before the master restarted
 		"""
 		self.job = job
 		self.job_man = job_man
 		self.drip_count = 0
 		self.queue_name = queue_name
-		self.fileset = FileSet(
-			name		= "{}_default_fileset".format(job.name),
-			timestamps	= {"created": time.time()},
-			job			= job,
-			tags		= job.tags
-		)
-		self.fileset.save()
+		# tracked in memory, the job document is only updated periodically
+		# by the JobManager's CoalescedCounters
+		self.progress = job.progress
+		# dict of {<idx>: <dispatch or taken time>} of items that have not
+		# finished yet
+		self.outstanding = {}
+		# protects outstanding and its checkpoint, items finish on the amqp
+		# consumer thread while they are dripped on the JobManager's
+		self._outstanding_lock = threading.Lock()
+		# dict of {(<idx>, <attempt>): <time first seen running>}, from the
+		# slave status messages
+		self.running = {}
+		# dict of {<idx>: set([<attempts>])} of items that were re-dispatched
+		# and still have more than one copy that could finish them
+		self.copies = {}
+		# how long recently finished items ran, used to spot stragglers
+		self.durations = collections.deque(maxlen=self.DURATION_SAMPLES)
+		# set([(<idx>, <attempt>)]) of items the master asked a slave to preempt
+		self.preempting = set()
+		# idxs of items that reported an error
+		self.errored = set()
+		# the CircuitBreakers that gate dispatching this job (its own and its
+		# image's), set by the JobManager
+		self.breakers = []
+		# which of the breakers ("job" or "image") paused the job, if it is paused
+		self.paused_by = None
+		self.fileset = None
+
+		if checkpoint is not None:
+			self._load_checkpoint(checkpoint)
+		else:
+			# the JobManager clears out anything left over from a previous run
+			# of the job. The checkpoint is saved along with the fileset, see
+			# _ensure_fileset
+			self._checkpoint = JobCheckpoint(job=job)
 
 		self.ran_pre_hook = False
-	
-	def drip(self, drip_size):
-		"""Return items to be inserted into the queue. The ``drip_size`` is the total
-		number in this drip. The amount yielded should be determined by the priority
-		and the drip_size.
 
-		:num: The number of items to return
+		# when the job started waiting for its next item to be dripped, set by
+		# the JobManager
+		self.wait_start = time.time()
+
+		# the json-encoded message minus the idx, see drop()
+		self._drop_template = None
+	
+	def drip_capacity(self):
+		"""Return the number of items this job is able to drip right now, or None
+		if it is not limited. The JobManager's fair-share scheduler decides how
+		many of these actually get dripped.
 		"""
 		# this check is usually performed in the _handle_job_progress function, as
 		# the progress of jobs is received over AMQP. We should check it here as well,
 		# just in case talus_master daemon is restarted and jobs end up with a progress
 		# higher than their limit
-		if self.job.limit != -1 and self.job.progress >= self.job.limit:
+		if self.job.limit != -1 and self.progress >= self.job.limit:
 			self.job.status = {"name": "stop"}
 			self.job.save()
 
@@ -64,58 +112,321 @@ class JobHandler(object):
 			# just going to update the document in the DB and let the job watcher
 			# handle the change (same procedure as cancelling a job)
 			# self.job_man.stop_job(self.job)
-			return
+			return 0
 
-		priority = self.job.priority
-		num = int(round(drip_size * priority / 100.0))
-		if num == 0:
-			num = 1
+		capacity = None
+		if self.job.limit != -1:
+			# only drip whatever's left, counting the items that are already
+			# queued or running but haven't reported their progress yet
+			# we only want to stop dripping jobs, not completely cancel the job
+			# job cancellation comes into play when progress >= limit
+			capacity = max(0, self.job.limit - self.progress - len(self.outstanding))
 
-		if self.job.debug and self.drip_count + num > self.job.limit:
-			# only drip whatever's left
-			num = self.job.limit - self.drip_count
+		# too many items have been failing, only probe items get through
+		for breaker in self.breakers:
+			allowed = breaker.allowed()
+			if allowed is not None and (capacity is None or allowed < capacity):
+				capacity = allowed
 
-			# we only want to stop dripping jobs, not completely cancel the job
-			# job cancellation for debug jobs comes into play when progress >= limit
-			if num == 0:
-				return
-		
+		return capacity
+
+	def drip(self, num):
+		"""Return a list of encoded items to be inserted into the queue. ``num`` is the
+		number of items this job was allotted by the fair-share scheduler, see
+		``drip_capacity``.
+
+		:num: The number of items to return
+		"""
 		print("dripping {} times for job {}".format(num, self.job.id))
 
-		for x in range(num):
-			res = self.drop()
+		# while paused, items are probes to see if the job works again. Other
+		# jobs of the image may have sent the image's probe since the capacity
+		# was checked, so make sure it is still due
+		probe = self.paused()
+		if probe:
+			if any(breaker.allowed() == 0 for breaker in self.breakers):
+				return []
+			num = min(num, 1)
+
+		res = []
+		with self._outstanding_lock:
+			for x in range(num):
+				drop = self.drop(probe)
+
+				# NOTE
+				# the job handler could return None if the pre_hook is queued and is waiting to be run
+				# also note - if the prehook fails/errors, the job should not continue
+				if drop is None:
+					break
+				res.append(drop)
+
+			self._checkpoint_drops(res)
+
+		if len(res) > 0:
+			# only the probe's own outcome may end the probe
+			probe_item = (str(self.job.id), self.drip_count) if probe else None
+			for breaker in self.breakers:
+				breaker.dispatched(item=probe_item)
 
-			# NOTE
-			# the job handler could return None if the pre_hook is queued and is waiting to be run
-			# also note - if the prehook fails/errors, the job should not continue
-			if res is not None:
-				yield res
-			else:
-				break
+		return res
 
-	def drop(self):
+	def drop(self, probe=False):
 		self.drip_count += 1
-		return json.dumps(dict(
-			job				= str(self.job.id),
-			idx				= self.drip_count,
-			debug			= self.job.debug,
-			image			= str(self.job.image.id),
-			image_username	= self.job.image.username,
-			image_password	= self.job.image.password,
-			os_type			= self.job.image.os.type,
-			tool			= str(self.job.task.tool.name),
-			params			= self.job.params,
-			fileset			= str(self.fileset.id),
-			network			= self.job.network,
-			vm_max			= self.job.vm_max
-		))
+		self.outstanding[self.drip_count] = time.time()
+
+		if probe:
+			return '{"idx": ' + str(self.drip_count) + ', "probe": true, ' + self._get_drop_template()[1:]
+		return '{"idx": ' + str(self.drip_count) + ", " + self._get_drop_template()[1:]
+
+	def paused(self):
+		"""Return True if dispatching is paused because too many items failed
+		"""
+		return any(breaker.state != CircuitBreaker.CLOSED for breaker in self.breakers)
+
+	def remaining(self):
+		"""Return the number of items the job still has to run, or None if it
+		is not limited
+		"""
+		if self.job.limit == -1:
+			return None
+		return max(0, self.job.limit - self.progress)
+
+	def waiting(self):
+		"""Return True if the job has items that are not running yet
+		"""
+		if self.job.limit == -1:
+			return True
+		running = set(idx for idx,attempt in self.running.keys())
+		return self.job.limit - self.progress - len(running) > 0
+
+	def tail_reached(self):
+		"""Return True if the job has a limit and every remaining item has
+		already been dripped
+		"""
+		if self.job.limit == -1:
+			return False
+		return self.job.limit - self.progress - len(self.outstanding) <= 0
+
+	def item_running(self, idx, attempt=1, now=None):
+		"""Note that a slave reported the item ``idx`` as running
+		"""
+		if now is None:
+			now = time.time()
+		with self._outstanding_lock:
+			if idx in self.outstanding:
+				self.running.setdefault((idx, attempt), now)
+
+	def stragglers(self, factor, min_samples, now=None):
+		"""Return ``(elapsed, idx)`` tuples of running items that have taken more
+		than ``factor`` times the median run time of the job's finished items,
+		slowest first. Items that already have a second copy are not included.
+
+		:param float factor: How many times slower than the median an item must be
+		:param int min_samples: The fewest finished items needed to trust the median
+		"""
+		if len(self.durations) < min_samples:
+			return []
+
+		if now is None:
+			now = time.time()
+
+		durations = sorted(self.durations)
+		median = durations[len(durations) / 2]
+
+		res = []
+		for (idx,attempt),started in self.running.items():
+			if idx in self.copies or idx not in self.outstanding:
+				continue
+			elapsed = now - started
+			if elapsed > factor * median:
+				res.append((elapsed, idx))
+		res.sort(reverse=True)
+		return res
+
+	def speculate(self, idx):
+		"""Return an encoded copy of the outstanding item ``idx`` to be run
+		alongside the original, or None if the item is no longer outstanding.
+		Whichever copy reports progress first wins, see ``item_progress``.
+		"""
+		with self._outstanding_lock:
+			if idx not in self.outstanding:
+				return None
+
+			attempts = set(attempt for (running_idx,attempt) in self.running if running_idx == idx)
+			attempts.add(1)
+			attempt = max(attempts) + 1
+			attempts.add(attempt)
+			self.copies[idx] = attempts
+			# the copy gets a full vm_max before the item expires
+			self.outstanding[idx] = time.time()
+
+		return '{"idx": ' + str(idx) + ', "attempt": ' + str(attempt) + ", " + self._get_drop_template()[1:]
+
+	def item_progress(self, idx, attempt=1):
+		"""Note that ``attempt`` of the item ``idx`` reported progress. If the
+		item was re-dispatched, this copy wins.
+
+		:returns: True if other copies of the item should be cancelled
+		"""
+		with self._outstanding_lock:
+			attempts = self.copies.get(idx)
+			if attempts is None or attempt not in attempts or len(attempts) == 1:
+				return False
+			self.copies[idx] = set([attempt])
+			return True
+
+	def item_taken(self, idx):
+		"""Note that a slave took the item ``idx`` off of the queue, which
+		restarts its timeout
+		"""
+		if idx in self.outstanding:
+			self.outstanding[idx] = time.time()
+
+	def expire_items(self, now=None):
+		"""Return items that have not been heard from in longer than the job's
+		``vm_max`` (plus ``ITEM_GRACE``) to the pool, so they no longer count
+		against the job's limit
+
+		:returns: The list of expired idxs
+		"""
+		if now is None:
+			now = time.time()
+
+		max_age = self.job.vm_max + self.ITEM_GRACE
+		expired = [idx for idx,last_seen in self.outstanding.items() if now - last_seen > max_age]
+		for idx in expired:
+			self.finish_item(idx)
+
+		return expired
+
+	def finish_item(self, idx, attempt=None, started=False, now=None):
+		"""Mark the item ``idx`` as finished (successfully or not). An item with
+		more than one copy is only finished once the winning (or last) copy is.
+
+		:param int attempt: The copy of the item that finished, None if unknown
+		:param bool started: Whether the item's tool actually ran
+		:returns: True if the item is now finished
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._outstanding_lock:
+			if attempt is not None:
+				running_since = self.running.pop((idx, attempt), None)
+
+				attempts = self.copies.get(idx)
+				if attempts is not None:
+					if attempt not in attempts:
+						# a copy that lost (or was already given up on)
+						return
+					attempts.discard(attempt)
+					if len(attempts) > 0:
+						# another copy is still running, e.g. this one's VM
+						# never started
+						return
+
+				if started and running_since is not None:
+					self.durations.append(now - running_since)
+
+			self.copies.pop(idx, None)
+			for key in [key for key in self.running if key[0] == idx]:
+				del self.running[key]
+			for key in [key for key in self.preempting if key[0] == idx]:
+				self.preempting.discard(key)
+			self.errored.discard(idx)
+
+			if self.outstanding.pop(idx, None) is None:
+				return False
+
+			self._checkpoint_collection().update(
+				{"_id": self._checkpoint.id},
+				{"$unset": {"outstanding.{}".format(idx): ""}}
+			)
+			return True
 	
 	def cleanup(self):
-		self.fileset.reload()
+		if self.fileset is not None:
+			fileset = FileSet.objects(id=self.fileset.id).first()
+
+			# don't need a bunch of empty filesets sitting around
+			if fileset is not None and len(fileset.files) == 0:
+				fileset.delete()
+
+		if self._checkpoint.id is not None:
+			self._checkpoint.delete()
+
+	# ---------------------------------------
+
+	def _load_checkpoint(self, checkpoint):
+		self._checkpoint = checkpoint
+		self.drip_count = checkpoint.drip_count
+
+		# checkpoints are loaded without dereferencing, the fileset is loaded
+		# when it's needed
+		self.fileset = checkpoint.fileset
+		for idx,dispatched in checkpoint.outstanding.iteritems():
+			self.outstanding[int(idx)] = dispatched
+
+	def _ensure_fileset(self):
+		"""Load or create the fileset the job's results go into. This is done
+		when the first item is dripped, so that starting many jobs at once
+		doesn't create all of their filesets up front.
+		"""
+		if isinstance(self.fileset, FileSet):
+			return
 
-		# don't need a bunch of empty filesets sitting around
-		if len(self.fileset.files) == 0:
-			self.fileset.delete()
+		if self.fileset is not None:
+			self.fileset = FileSet.objects(id=self.fileset.id).first()
+			if self.fileset is not None:
+				return
+
+		# the fileset may have been deleted out from under the checkpoint
+		self.fileset = FileSet(
+			name		= "{}_default_fileset".format(self.job.name),
+			timestamps	= {"created": time.time()},
+			job			= self.job,
+			tags		= self.job.tags
+		)
+		self.fileset.save()
+		self._checkpoint.fileset = self.fileset
+		self._checkpoint.save()
+
+	def _get_drop_template(self):
+		# everything but the idx stays the same for the life of the job, so
+		# only dereference the image/os/tool and encode it all once
+		if self._drop_template is None:
+			self._ensure_fileset()
+			self._drop_template = json.dumps(dict(
+				type			= "job",
+				job				= str(self.job.id),
+				debug			= self.job.debug,
+				image			= str(self.job.image.id),
+				image_username	= self.job.image.username,
+				image_password	= self.job.image.password,
+				os_type			= self.job.image.os.type,
+				tool			= str(self.job.task.tool.name),
+				params			= self.job.params,
+				fileset			= str(self.fileset.id),
+				network			= self.job.network,
+				vm_max			= self.job.vm_max
+			))
+
+		return self._drop_template
+
+	def _checkpoint_collection(self):
+		return JobCheckpoint._get_collection()
+
+	def _checkpoint_drops(self, drops):
+		"""Record the dispatch state after ``drops`` were dripped
+		"""
+		if len(drops) == 0:
+			return
+
+		update = {"drip_count": self.drip_count}
+		for idx in xrange(self.drip_count - len(drops) + 1, self.drip_count + 1):
+			update["outstanding.{}".format(idx)] = self.outstanding[idx]
+
+		self._checkpoint_collection().update({"_id": self._checkpoint.id}, {"$set": update})
 
 class JobManager(threading.Thread):
 	"""A class to manage jobs (starting/stopping/cancelling/etc)"""
@@ -130,26 +441,174 @@ class JobManager(threading.Thread):
 		exclusive	= False,
 	)
 
-	def __init__(self, drip_size=25):
+	# job items are pre-published into the shared jobs queue
+	DISPATCH_PUSH = "push"
+	# slaves advertise free VM slots (credits) and job items are published
+	# directly to their private queues
+	DISPATCH_CREDIT = "credit"
+
+	# job etas are only rewritten when they move by more than this many seconds
+	ETA_TOLERANCE = 10
+
+	def __init__(self, drip_size=25, reconcile_interval=5.0, dispatch=DISPATCH_PUSH, progress_flush_interval=1.0,
+				result_batch_size=100, result_max_latency=0.5, lookahead=5, slave_fresh_time=30,
+				drip_horizon=10.0, rate_time_constant=60.0, speculate=False, speculate_factor=2.0,
+				speculate_min_samples=5, aging_rate=1.0/60, preempt=False, preempt_priority_gap=20,
+				preempt_min_runtime=60, preempt_rate=1.0/60, preempt_burst=3, default_share_weight=1.0,
+				breaker_window=20, breaker_min_samples=10, breaker_threshold=0.8, breaker_backoff=60,
+				breaker_max_backoff=60*60, ingest_batch_size=500, status_lanes=4):
 		"""init the job manager
 		
-		:drip_size: The number of jobs to be added to the queue at once"""
+		:drip_size: The most job items to keep in an AMQP queue beyond the free
+			capacity of the slaves. Also used for queues whose consumption rate is
+			not known yet.
+		:reconcile_interval: How often (in seconds) the AMQP queue sizes are polled
+			from the broker to correct the locally tracked sizes
+		:dispatch: How work in the default jobs queue reaches the slaves, one of
+			``DISPATCH_PUSH`` or ``DISPATCH_CREDIT``
+		:progress_flush_interval: How often (in seconds) job progress is written to
+			the database
+		:result_batch_size: The most job results (or errors/logs) to insert into the
+			database at once
+		:result_max_latency: The longest (in seconds) a job result (or error/log) is
+			buffered before being inserted
+		:lookahead: The number of job items to keep in the default jobs queue beyond
+			the free VM slots of the slaves
+		:slave_fresh_time: Slaves that have not reported their status in this many
+			seconds do not count towards the free capacity
+		:drip_horizon: Each AMQP queue is kept deep enough to cover this many seconds
+			of consumption at its measured rate
+		:rate_time_constant: The time constant (in seconds) of the moving average
+			of each queue's consumption rate
+		:speculate: Whether to run a second copy of straggling items on idle slave
+			capacity once a job with a limit has nothing left to drip
+		:speculate_factor: How many times slower than the job's median run time an
+			item must be to count as a straggler
+		:speculate_min_samples: The number of items a job must have finished before
+			any of its items count as stragglers
+		:aging_rate: How many priority points per second a job gains while it
+			waits for an item to be dripped, so low priority jobs can't be starved
+		:preempt: Whether to stop running VMs of low priority jobs when there are no
+			free VM slots and a higher priority job is waiting
+		:preempt_priority_gap: How much higher a job's priority must be than a running
+			job's to preempt it
+		:preempt_min_runtime: VMs that have been running for less than this many
+			seconds are not preempted
+		:preempt_rate: How many preemptions per second are allowed on average
+		:preempt_burst: The most preemptions allowed at once
+		:default_share_weight: The fair-share weight of job groups whose tag does
+			not have a ShareWeight
+		:breaker_window: How many recent item outcomes of each job and image are
+			used to calculate their failure rates
+		:breaker_min_samples: The fewest outcomes needed before a job or image can
+			be paused
+		:breaker_threshold: The failure rate (0-1) at which dispatching a job's
+			items, or all items of an image, is paused
+		:breaker_backoff: How long (in seconds) to wait before dispatching a probe
+			item of a paused job
+		:breaker_max_backoff: The longest to wait between probes
+		:ingest_batch_size: The most submitted jobs to start at once
+		:status_lanes: The number of threads that handle job_status messages.
+			Messages of the same job are always handled by the same thread, in
+			order"""
 		super(JobManager, self).__init__()
 
 		self._drip_size = drip_size
+		self._reconcile_interval = reconcile_interval
+		self._dispatch = dispatch
+		self._lookahead = lookahead
+		self._slave_fresh_time = slave_fresh_time
+		self._drip_horizon = drip_horizon
+		self._rate_time_constant = rate_time_constant
+		self._speculate = speculate
+		self._speculate_factor = speculate_factor
+		self._speculate_min_samples = speculate_min_samples
+		self._aging_rate = aging_rate
+		self._preempt = preempt
+		self._preempt_priority_gap = preempt_priority_gap
+		self._preempt_min_runtime = preempt_min_runtime
+		self._preempt_bucket = TokenBucket(preempt_rate, preempt_burst)
+		self._default_share_weight = default_share_weight
+		self._breaker_args = dict(
+			window		= breaker_window,
+			min_samples	= breaker_min_samples,
+			threshold	= breaker_threshold,
+			backoff		= breaker_backoff,
+			max_backoff	= breaker_max_backoff,
+		)
+		# dict of {<image id>: CircuitBreaker}, shared by all jobs of the image
+		self._image_breakers = {}
+
+		self._ingest_batch_size = ingest_batch_size
+		# ids of jobs waiting to be started by the main loop
+		self._submitted = []
+		self._submitted_lock = threading.Lock()
+
+		# dict of {<queue_name>: RateEstimator}, how fast items are taken
+		# from each AMQP queue
+		self._queue_rates = {}
+
+		# free VM slots across all fresh slaves, refreshed from the database when
+		# the queue sizes are reconciled
+		self._free_capacity = 0
+		# list of (<slave uuid>, <vm info>) of the VMs running on fresh slaves,
+		# refreshed along with the free capacity
+		self._slave_vms = []
 
 		self._running = threading.Event()
 		self._job_queue_lock = threading.Lock()
 
+		# set whenever slaves take work from a queue or new jobs arrive, wakes
+		# up the main loop to refill the queues
+		self._drip_evt = threading.Event()
+		# dict of {<queue_name>: <number of items believed to be in the AMQP queue>}
+		self._queue_outstanding = {}
+		self._queue_outstanding_lock = threading.Lock()
+
 		self._amqp_man = AmqpManager.instance()
+		self._job_counters = CoalescedCounters(Job, progress_flush_interval)
+		self._result_inserter = BulkInserter(Result, result_batch_size, result_max_latency)
+		self._job_log_inserter = BulkInserter(JobLog, result_batch_size, result_max_latency)
+		# job_status messages are handled off of the AMQP consumer thread,
+		# partitioned by job id
+		self._status_lanes = LanePool(self._handle_job_status, status_lanes, "JobStatusLanes")
+		# serializes pausing/resuming jobs, see _update_paused
+		self._paused_lock = threading.Lock()
 
 		self._log = logging.getLogger("JobMan")
 		
 		# each job can potentially specify their own queue, this
-		# will be a dict of Q.PriorityQueue()s
+		# will be a dict of JobQueue()s
 		self._job_amqp_queues = {}
+		# dict of {<queue_name>: DeficitRoundRobin}, used to split each drip
+		# across the job groups in a queue according to their share weights
+		self._group_fair_shares = {}
+		# dict of {<queue_name>: {<group>: BandedRoundRobin}}, used to split a
+		# group's part of each drip across its priorities and then its jobs
+		self._job_fair_shares = {}
+		# dict of {<tag>: <weight>}, refreshed from the ShareWeight collection
+		self._share_weights = {}
+		# dict of {<group>: RateEstimator} of how fast items of each group are
+		# dripped, to report the shares the groups actually get
+		self._group_rates = {}
 		# dict of {<jobid>: JobHandler}
 		self._job_handlers = {}
+		# how long items of each tool/image take, used to order jobs within
+		# a priority and to estimate when jobs will finish
+		self._run_stats = RunStatsTracker(RunStats)
+		# dict of {<jobid>: <eta last written to the job>}
+		self._job_etas = {}
+		# how long jobs wait between drips, grouped by priority band
+		self._wait_times = WaitTimes()
+		# copies of straggling items waiting for slave credits, only used with
+		# DISPATCH_CREDIT
+		self._speculative_drops = []
+
+		if self._dispatch == self.DISPATCH_CREDIT:
+			Master.instance().set_slave_config(dispatch=self.DISPATCH_CREDIT)
+			Master.instance().add_slave_status_handler("credit", self._on_slave_credit)
+		if self._speculate:
+			Master.instance().add_slave_status_handler("status", self._on_slave_status)
 	
 	def run(self):
 		"""Run the job manager. Only one of these should ever be running at a time
@@ -165,13 +624,28 @@ class JobManager(threading.Thread):
 		self._amqp_man.do_start()
 		self._amqp_man.wait_for_ready()
 
+		self._job_counters.start()
+		self._result_inserter.start()
+		self._job_log_inserter.start()
+		self._status_lanes.start()
+
 		self._log.info("beginning main loop")
 
+		self._run_stats.load()
 		self._create_handlers_for_existing()
 
+		last_reconcile = 0
 		while self._running.is_set():
-			self._monitor_queues()
-			time.sleep(0.2)
+			self._drip_evt.clear()
+
+			self._ingest_submitted()
+
+			reconcile = (time.time() - last_reconcile >= self._reconcile_interval)
+			if reconcile:
+				last_reconcile = time.time()
+			self._monitor_queues(reconcile)
+
+			self._drip_evt.wait(self._reconcile_interval)
 
 		self._log.info("finished")
 	
@@ -182,54 +656,131 @@ class JobManager(threading.Thread):
 		"""
 		self._log.info("stopping")
 		self._running.clear()
+		self._drip_evt.set()
+		self._job_counters.stop()
+		self._result_inserter.stop()
+		self._job_log_inserter.stop()
+		self._status_lanes.stop()
+		self._run_stats.flush()
 	
-	def run_job(self, job):
-		"""TODO: Docstring for run_job.
+	def submit_job(self, job_id):
+		"""Queue the job ``job_id``, whose status is ``run``, to be started. Jobs
+		are started in batches by the main loop, see :meth:`run_jobs`.
+		"""
+		with self._submitted_lock:
+			self._submitted.append(job_id)
+		self._drip_evt.set()
 
-		:job: TODO
-		:returns: TODO
+	def run_jobs(self, job_ids):
+		"""Start the jobs ``job_ids`` whose status is ``run`` in one batch: the
+		jobs are loaded with one query, their statuses are set with one update
+		and the queues are published to the master status once.
+
+		:job_ids: The ids of the jobs to run
 		"""
-		self._log.info("running job: {}".format(job.id))
+		jobs = list(Job.objects(id__in=job_ids, status__name="run").select_related())
+		if len(jobs) == 0:
+			return
 
-		job.priority = self._safe_priority(job.priority)
-		job.save()
+		ready = []
+		not_ready = []
+		for job in jobs:
+			if job.image.status["name"] != "ready":
+				self._log.warn("Image is not in a ready state! cannot run job {} yet, cancelling".format(job.id))
+				not_ready.append(job.id)
+			else:
+				ready.append(job)
+
+		if len(not_ready) > 0:
+			Job.objects(id__in=not_ready).update(set__status={"name": "cancelled", "desc": "image not ready"})
+		if len(ready) == 0:
+			return
+
+		self._log.info("running {} jobs".format(len(ready)))
+
+		# clear out anything left over from previous runs of the jobs
+		JobCheckpoint.objects(job__in=ready).delete()
+		Job.objects(id__in=[job.id for job in ready]).update(set__status={"name": "running"})
+
+		with self._job_queue_lock:
+			for job in ready:
+				job.status = {"name": "running"}
+				self._add_job(job)
+			Master.instance().update_status(queues=self._get_queues())
+
+		self._drip_evt.set()
+
+	def _ingest_submitted(self):
+		"""Start the jobs queued with :meth:`submit_job`, ``ingest_batch_size`` at
+		a time
+		"""
+		with self._submitted_lock:
+			job_ids = self._submitted
+			self._submitted = []
+
+		for start in xrange(0, len(job_ids), self._ingest_batch_size):
+			self.run_jobs(job_ids[start:start + self._ingest_batch_size])
+
+	def _add_job(self, job, checkpoint=None):
+		"""Create the JobHandler for ``job`` and add it to its queue. The
+		``_job_queue_lock`` must already be held.
+		"""
+		priority = self._safe_priority(job.priority)
+		if priority != job.priority:
+			job.priority = priority
+			job.save()
 
 		queue = job.queue
 		if queue is None or queue == "":
 			queue = self.AMQP_JOB_QUEUE
 
-		handler = JobHandler(job, queue, self)
+		handler = JobHandler(job, queue, self, checkpoint)
+		handler.breakers = [self._new_breaker(job), self._get_image_breaker(job)]
+		if job.status.get("name") == "paused":
+			# it was paused before the master restarted, by its own breaker
+			# unless the status says otherwise
+			handler.paused_by = job.status.get("breaker", "job")
+			breaker = self._paused_breaker(handler)
+			# the image's breaker may already be open from another of its jobs
+			if breaker.state == CircuitBreaker.CLOSED:
+				breaker.trip()
 		self._job_handlers[str(job.id)] = handler
 
-		with self._job_queue_lock:
-			job_priority_queue = self._job_amqp_queues.setdefault(queue, PQ())
-			# items are fetched by lowest priority value first, so we need to
-			# invert the priorities
-			job_priority_queue.put(((1000-job.priority), handler))
-
-			Master.instance().update_status(queues=self._get_queues())
+		job_priority_queue = self._job_amqp_queues.setdefault(queue, JobQueue())
+		self._group_fair_shares.setdefault(queue, DeficitRoundRobin())
+		self._job_fair_shares.setdefault(queue, {})
+		handler.wait_start = time.time()
+		job_priority_queue.put(str(job.id), self._queue_key(handler), handler)
 	
 	def _get_queues(self):
 		queues = {}
 		for qname,pq in self._job_amqp_queues.iteritems():
 			q = queues.setdefault(qname, [])
 
-			items = []
-			while pq.qsize() > 0:
-				# get them IN ORDER!!! pq.queue IS NOT in order!!!
-				priority,handler = pq.get()
-				items.append((priority, handler))
+			now = time.time()
+			for priority,handler in pq.snapshot():
 				q.append({
 					"job": str(handler.job.id),
 					"job_name": handler.job.name,
 					"priority": handler.job.priority,
+					"effective_priority": self._effective_priority(handler, now),
 				})
 
-			for item in items:
-				pq.put(item)
-
 		return queues
 
+	def _queue_key(self, handler):
+		"""Return the JobQueue priority of ``handler``. Items are fetched by
+		lowest priority value first, so the priorities are inverted. A job's
+		effective priority is its priority plus ``aging_rate`` times how long it
+		has been waiting. Every job ages at the same rate, so ordering by the
+		effective priority at any moment is the same as ordering by this fixed
+		value. The key only has to be updated when the job's wait restarts.
+		"""
+		return (1000 - handler.job.priority) + self._aging_rate * handler.wait_start
+
+	def _effective_priority(self, handler, now):
+		return handler.job.priority + self._aging_rate * (now - handler.wait_start)
+
 	def stop_job(self, job):
 		"""This is intended to be called once a job has been completed
 		(not cancelled, but completed)
@@ -239,15 +790,8 @@ class JobManager(threading.Thread):
 		if str(job.id) in self._job_handlers:
 			with self._job_queue_lock:
 				handler = self._job_handlers[str(job.id)]
-				queue = self._job_amqp_queues[handler.queue_name]
-
-				new_queue = []
-				for priority,handler in queue.queue:
-					if handler.job.id == job.id:
-						continue
-					new_queue.append((priority, handler))
-
-				queue.queue = new_queue
+				self._job_amqp_queues[handler.queue_name].remove(str(job.id))
+				self._remove_fair_share(handler)
 
 				Master.instance().update_status(queues=self._get_queues())
 
@@ -260,6 +804,7 @@ class JobManager(threading.Thread):
 			exchange=Master.AMQP_BROADCAST_XCHG
 		)
 
+		self._job_counters.flush()
 		job.reload()
 		job.status = {
 			"name": "finished"
@@ -285,18 +830,8 @@ class JobManager(threading.Thread):
 		if str(job.id) in self._job_handlers:
 			with self._job_queue_lock:
 				handler = self._job_handlers[str(job.id)]
-				queue = self._job_amqp_queues[handler.queue_name]
-
-				new_queue = []
-				while queue.qsize() > 0:
-					priority,handler = queue.get()
-					# leave this one out (the one we're cancelling)
-					if handler.job.id == job.id:
-						continue
-					new_queue.append((priority, handler))
-
-				for item in new_queue:
-					queue.put(item)
+				self._job_amqp_queues[handler.queue_name].remove(str(job.id))
+				self._remove_fair_share(handler)
 
 				Master.instance().update_status(queues=self._get_queues())
 		else:
@@ -311,6 +846,7 @@ class JobManager(threading.Thread):
 			exchange=Master.AMQP_BROADCAST_XCHG
 		)
 
+		self._job_counters.flush()
 		job.reload()
 		job.status = {
 			"name": "cancelled"
@@ -323,18 +859,149 @@ class JobManager(threading.Thread):
 		self._cleanup_job(job)
 
 	# ---------------------------------------
+	def _remove_fair_share(self, handler):
+		"""Forget the fair-share state of the removed job, and of its group if
+		no other job in its queue is in the group, or of its priority band if no
+		other job in the group has the same priority
+		"""
+		group = self._share_group(handler.job)
+		group_shares = self._job_fair_shares[handler.queue_name]
+
+		same_group = False
+		same_band = False
+		job_queue = self._job_amqp_queues[handler.queue_name]
+		for priority,other in job_queue.snapshot():
+			if other is handler or self._share_group(other.job) != group:
+				continue
+			same_group = True
+			if other.job.priority == handler.job.priority:
+				same_band = True
+
+		if not same_group:
+			self._group_fair_shares[handler.queue_name].remove(group)
+			group_shares.pop(group, None)
+		elif group in group_shares:
+			band_key = self._band_key(handler.job.priority)
+			if same_band:
+				group_shares[group].remove(band_key, str(handler.job.id))
+			else:
+				group_shares[group].remove(band_key)
+
+	def resume_job(self, job):
+		"""Resume dispatching the paused job ``job``, e.g. after its image was
+		fixed. Failures are counted from scratch for the breaker that paused
+		the job (or both of its breakers if that is not known).
+		"""
+		self._log.info("resuming job: {}".format(job.id))
+
+		handler = self._job_handlers.get(str(job.id))
+		if handler is None:
+			# resume jobs are also resumed when the handlers are created at startup
+			self._log.warn("job to resume ({}) not in job handlers".format(job.id))
+			return
+
+		if handler.paused_by is None:
+			breakers = handler.breakers
+		else:
+			breakers = [self._paused_breaker(handler)]
+		for breaker in breakers:
+			breaker.reset()
+
+		handler.paused_by = None
+		handler.job.status = {"name": "running"}
+		handler.job.save()
+
+		# other jobs of the image may have only been paused by the image
+		with self._paused_lock:
+			self._update_paused()
+		self._drip_evt.set()
+
+	def _paused_breaker(self, handler):
+		"""Return the breaker named by ``handler.paused_by``
+		"""
+		job_breaker,image_breaker = handler.breakers
+		if handler.paused_by == "image":
+			return image_breaker
+		return job_breaker
+
+	def _new_breaker(self, job):
+		return CircuitBreaker(probe_timeout=job.vm_max + JobHandler.ITEM_GRACE, **self._breaker_args)
+
+	def _get_image_breaker(self, job):
+		image_id = str(job.image.id)
+		if image_id not in self._image_breakers:
+			# setdefault so that status lanes racing here share one breaker
+			self._image_breakers.setdefault(image_id, self._new_breaker(job))
+		return self._image_breakers[image_id]
+
+	def _record_outcome(self, handler, idx, success):
+		"""Record whether the item ``idx`` of the job failed, which may pause (or
+		resume) dispatching the job and any other jobs of its image
+		"""
+		states = [breaker.state for breaker in handler.breakers]
+		for breaker in handler.breakers:
+			breaker.record(success, item=(str(handler.job.id), idx))
+
+		if states != [breaker.state for breaker in handler.breakers]:
+			with self._paused_lock:
+				self._update_paused()
+
+	def _update_paused(self):
+		"""Set the status of each job to paused (with the reason) or running,
+		to match its CircuitBreakers
+		"""
+		for job_id,handler in self._job_handlers.items():
+			job_breaker,image_breaker = handler.breakers
+			status = handler.job.status.get("name")
+
+			if handler.paused() and status == "running":
+				if job_breaker.state != CircuitBreaker.CLOSED:
+					handler.paused_by = "job"
+					reason = "{:.0%} of the job's recent items failed".format(job_breaker.failure_rate or 1.0)
+				else:
+					handler.paused_by = "image"
+					reason = "{:.0%} of image {}'s recent items failed".format(image_breaker.failure_rate or 1.0, handler.job.image.id)
+				self._log.warn("pausing job {}: {}".format(job_id, reason))
+				handler.job.status = {"name": "paused", "reason": reason, "breaker": handler.paused_by}
+				handler.job.save()
+
+			elif not handler.paused() and status == "paused":
+				self._log.info("job {} is no longer paused".format(job_id))
+				handler.paused_by = None
+				handler.job.status = {"name": "running"}
+				handler.job.save()
+
 	def _cleanup_job(self, job):
 		self._log.info("cleaning up job: {}".format(job.id))
 
+		self._job_etas.pop(str(job.id), None)
+
 		if str(job.id) in self._job_handlers:
 			handler = self._job_handlers[str(job.id)]
 			handler.cleanup()
 			del self._job_handlers[str(job.id)]
+		else:
+			JobCheckpoint.objects(job=job).delete()
 
 	def _create_handlers_for_existing(self):
 		self._log.info("creating job handlers for existing running jobs in the database")
-		for job in Job.objects(status__name = "running"):
-			self.run_job(job)
+		# jobs in the resume state were paused and asked to be resumed before
+		# their handler was (re)created, see resume_job
+		jobs = list(Job.objects(status__name__in = ["running", "paused", "resume"]))
+		checkpoints = {}
+		for checkpoint in JobCheckpoint.objects(job__in=jobs).no_dereference():
+			checkpoints[checkpoint.job.id] = checkpoint
+
+		with self._job_queue_lock:
+			for job in jobs:
+				self._log.info("running job: {}".format(job.id))
+				self._add_job(job, checkpoints.get(job.id))
+			Master.instance().update_status(queues=self._get_queues())
+
+		for job in jobs:
+			if job.status.get("name") == "resume":
+				self.resume_job(job)
+		self._drip_evt.set()
 
 		self._log.info("cancelling jobs stuck in cancelling state")
 		for job in Job.objects(status__name = "cancelling"):
@@ -350,20 +1017,32 @@ class JobManager(threading.Thread):
 
 	def _on_job_status(self, channel, method, properties, body):
 		"""Should be called when an AMQP_JOB_STATUS_QUEUE message is received - intended
-		to be for job progress...  maybe more?
+		to be for job progress...  maybe more? The message is handled by the
+		status lane of its job, see ``_handle_job_status``
 		"""
-		self._log.info("received job status: {}".format(body))
-
 		# just ack it immediately
 		self._amqp_man.ack_method(method)
 
-		data = json.loads(body)
+		try:
+			data = Message.from_dict(decode_props(body, properties))
+		except Exception as e:
+			self._log.warn("could not decode job status: {}".format(e))
+			return
+
+		self._log.info("received job status: {}".format(data))
 
+		self._status_lanes.submit(data.get("job"), data)
+
+	def _handle_job_status(self, data):
+		"""Handle a decoded job_status message on a status lane
+		"""
 		switch = dict(
 			progress	= self._handle_job_progress,
 			result		= self._handle_job_result,
 			error		= self._handle_job_error,
 			log			= self._handle_job_log,
+			taken		= self._handle_job_taken,
+			finished	= self._handle_job_finished,
 		)
 
 		if data["type"] not in switch:
@@ -376,38 +1055,125 @@ class JobManager(threading.Thread):
 		"""Handle job errors
 		"""
 		self._log.debug("handling job error: {}".format(data))
-
-		err_data = data["data"]
-		error = JobError(**err_data)
-		Job.objects(id=data["job"]).update_one(add_to_set__errors=error)
+		self._add_job_log("error", data)
 	
 	def _handle_job_log(self, data):
 		"""Handle job errors
 		"""
 		self._log.debug("handling job log: {}".format(data))
+		self._add_job_log("log", data)
+
+	def _add_job_log(self, log_type, data):
+		"""Buffer a JobLog of type ``log_type`` to be inserted and count it on the
+		job document (``num_errors``/``num_logs``)
+		"""
+		job = self._get_job(data["job"])
+		if job is None:
+			self._log.warn("received {} for a non-existent job!".format(log_type))
+			return
 
-		# holds the same info as an error, so just reuse that class
+		# holds the same info for errors and logs
 		log_data = data["data"]
-		log = JobError(**log_data)
-		Job.objects(id=data["job"]).update_one(add_to_set__logs=log)
+		job_log = JobLog(
+			job			= job,
+			idx			= data.get("idx"),
+			type		= log_type,
+			message		= log_data.get("message"),
+			backtrace	= log_data.get("backtrace"),
+			logs		= log_data.get("logs", []),
+		)
+		self._job_log_inserter.add(job_log)
+		self._job_counters.inc(data["job"], "num_{}s".format(log_type), 1)
+
+		handler = self._job_handlers.get(data["job"])
+		if log_type == "error" and handler is not None and data.get("idx") is not None:
+			handler.errored.add(data["idx"])
+
+	def _get_job(self, job_id):
+		"""Return the Job with id ``job_id``. Running jobs are already loaded,
+		others (e.g. messages that trickle in after a job has finished) are
+		queried for.
+		"""
+		if job_id in self._job_handlers:
+			return self._job_handlers[job_id].job
+		return Job.objects(id=job_id).first()
+
+	def _handle_job_taken(self, data):
+		"""Handle a slave taking a job item off of an AMQP queue
+		"""
+		queue_name = data.get("queue", self.AMQP_JOB_QUEUE)
+
+		handler = self._job_handlers.get(data.get("job"))
+		if handler is not None:
+			handler.item_taken(data.get("idx"))
+
+		self._get_queue_rate(queue_name).add()
+
+		with self._queue_outstanding_lock:
+			if queue_name in self._queue_outstanding:
+				self._queue_outstanding[queue_name] = max(0, self._queue_outstanding[queue_name] - 1)
+
+			# the slave will be using one of its free slots for this
+			if queue_name == self.AMQP_JOB_QUEUE:
+				self._free_capacity = max(0, self._free_capacity - 1)
+
+		self._drip_evt.set()
+
+	def _handle_job_finished(self, data):
+		"""Handle a slave reporting that the VM for a job item has finished,
+		whether it succeeded or not
+		"""
+		if data.get("started") and not data.get("preempted") and data.get("tool") is not None and data.get("image") is not None:
+			self._run_stats.add(data["tool"], data["image"], data.get("boot_time"), data.get("run_time"))
+
+		handler = self._job_handlers.get(data["job"])
+		if handler is None:
+			return
+
+		if data.get("preempted") or data.get("skipped"):
+			# it goes back into the job's pool and will be dripped again
+			self._log.info("job {} item {} was {}".format(data["job"], data["idx"], "preempted" if data.get("preempted") else "skipped"))
+			handler.finish_item(data["idx"], data.get("attempt", 1), False)
+			self._drip_evt.set()
+			return
+
+		# an item fails if its VM never started the tool or it reported an error
+		success = data.get("started", False) and data["idx"] not in handler.errored
+		if handler.finish_item(data["idx"], data.get("attempt", 1), data.get("started", False)):
+			self._record_outcome(handler, data["idx"], success)
 
 	def _handle_job_progress(self, data):
-		"""Handling job progress
+		"""Handling job progress. Progress is counted in memory and written to
+		the job document in batches, the limit is checked against the in-memory
+		count.
 		"""
 		self._log.debug("handling job progress: {}".format(data))
 
-		Job.objects(id=data["job"]).update_one(inc__progress = data["amt"])
+		self._job_counters.inc(data["job"], "progress", data["amt"])
 
 		if data["job"] not in self._job_handlers:
 			self._log.warn("job {} not in current list of job handlers".format(data["job"]))
 			return
 
 		handler = self._job_handlers[data["job"]]
+		handler.progress += data["amt"]
 		job = handler.job
-		job.reload()
 
-		if job.limit != -1 and job.progress >= job.limit:
-			self._log.debug("job {} finished ({}/{})".format(job.id, job.progress, job.limit))
+		if handler.item_progress(data["idx"], data.get("attempt", 1)):
+			self._log.info("job {} item {} copy {} won, cancelling the others".format(job.id, data["idx"], data.get("attempt", 1)))
+			self._amqp_man.queue_msg(
+				json.dumps(dict(
+					type			= "cancel",
+					job				= str(job.id),
+					idx				= data["idx"],
+					keep_attempt	= data.get("attempt", 1)
+				)),
+				"",
+				exchange=Master.AMQP_BROADCAST_XCHG
+			)
+
+		if job.limit != -1 and handler.progress >= job.limit:
+			self._log.debug("job {} finished ({}/{})".format(job.id, handler.progress, job.limit))
 			self.stop_job(job)
 	
 	def _handle_job_result(self, data):
@@ -419,10 +1185,10 @@ class JobManager(threading.Thread):
 		if not isinstance(data["data"], dict):
 			data["data"] = {"data": data["data"]}
 
-		jobs = Job.objects(id=data["job"])
-		if len(jobs) == 0:
+		job = self._get_job(data["job"])
+		if job is None:
 			self._log.warn("received result for a non-existent job!")
-		job = jobs[0]
+			return
 
 		result = Result()
 		result.job = job
@@ -442,21 +1208,281 @@ class JobManager(threading.Thread):
 		result.type = data["data"]["type"]
 		result.tool	= data["tool"]
 		result.data = data["data"]["data"]
-		result.save()
+		self._result_inserter.add(result)
 	
-	def _monitor_queues(self):
+	def _monitor_queues(self, reconcile=False):
 		"""Drip-feed the queue based on the current state of the job priority
-		queue.
+		queue. The sizes of the AMQP queues are tracked locally (dripped items
+		minus items slaves report as taken), and are only polled from the broker
+		when ``reconcile`` is True.
+
+		:reconcile: Whether to correct the tracked queue sizes from the broker
 		"""
+		if reconcile:
+			self._update_free_capacity()
+			self._expire_items()
+			if self._speculate:
+				self._speculate_stragglers()
+			if self._preempt:
+				self._preempt_for_waiting()
+			self._run_stats.flush()
+			self._update_etas()
+			self._load_share_weights()
+			Master.instance().update_status(stats={
+				"wait_times": self._wait_times.summary(),
+				"shares": self._get_shares(),
+				"job_status_lanes": self._status_lanes.stats(),
+				"amqp": self._amqp_man.channel_stats(),
+			})
+
 		with self._job_queue_lock:
 			for queue_name,job_queue in self._job_amqp_queues.iteritems():
 				if job_queue.qsize() == 0:
 					continue
-				num_msgs = self._amqp_man.get_message_count(queue_name)
-				if num_msgs < self._drip_size:
-					#self._log.debug("queue has {}/{} messages, dripping some more".format(num_msgs, self._drip_size))
-					self._do_drip(queue_name, job_queue)
+
+				# slaves pull work from this queue with credits instead
+				if self._dispatch == self.DISPATCH_CREDIT and queue_name == self.AMQP_JOB_QUEUE:
+					continue
+
+				queue_rate = self._get_queue_rate(queue_name)
+
+				with self._queue_outstanding_lock:
+					if reconcile or queue_name not in self._queue_outstanding:
+						# any "taken" messages still in flight will make this
+						# slightly low, the next reconciliation fixes that
+						num_msgs = self._amqp_man.get_message_count(queue_name)
+						if queue_name in self._queue_outstanding and num_msgs < self._queue_outstanding[queue_name]:
+							# consumed by something that did not report it
+							queue_rate.add(self._queue_outstanding[queue_name] - num_msgs)
+						self._queue_outstanding[queue_name] = num_msgs
+					num_msgs = self._queue_outstanding[queue_name]
+
+				queue_rate.sample()
+
+				target = self._queue_target(queue_name)
+				if num_msgs < target:
+					#self._log.debug("queue has {}/{} messages, dripping some more".format(num_msgs, target))
+					self._do_drip(queue_name, job_queue, target - num_msgs)
+
+	def _expire_items(self):
+		"""Return job items that were lost (e.g. their VM never started) to their
+		job's pool
+		"""
+		with self._job_queue_lock:
+			for job_id,handler in self._job_handlers.items():
+				expired = handler.expire_items()
+				if len(expired) > 0:
+					self._log.warn("job {} items {} timed out, returning them to the pool".format(job_id, expired))
+
+	def _on_slave_status(self, data):
+		"""Note the start times of the job items running on a slave, see
+		``_speculate_stragglers``
+		"""
+		for vm in data.get("vms", []):
+			handler = self._job_handlers.get(vm.get("job"))
+			if handler is not None:
+				handler.item_running(vm["idx"], vm.get("attempt", 1))
+
+	def _speculate_stragglers(self):
+		"""Re-dispatch the slowest running items of jobs that are in their tail
+		(have nothing left to drip) to idle slave capacity. The first copy to
+		report progress wins and the others are cancelled, see
+		``_handle_job_progress``.
+		"""
+		with self._queue_outstanding_lock:
+			idle = self._free_capacity - self._queue_outstanding.get(self.AMQP_JOB_QUEUE, 0) - len(self._speculative_drops)
+		if idle <= 0:
+			return
+
+		with self._job_queue_lock:
+			stragglers = []
+			for handler in self._job_handlers.values():
+				if handler.paused() or not handler.tail_reached():
+					continue
+				for elapsed,idx in handler.stragglers(self._speculate_factor, self._speculate_min_samples):
+					stragglers.append((elapsed, idx, handler))
+			stragglers.sort(key=lambda straggler: straggler[0], reverse=True)
+
+			for elapsed,idx,handler in stragglers[:idle]:
+				drop = handler.speculate(idx)
+				if drop is None:
+					continue
+
+				self._log.info("job {} item {} has run for {:.0f}s, re-dispatching it".format(handler.job.id, idx, elapsed))
+				if self._dispatch == self.DISPATCH_CREDIT and handler.queue_name == self.AMQP_JOB_QUEUE:
+					self._speculative_drops.append(drop)
+					continue
+
+				self._amqp_man.queue_msg(drop, handler.queue_name)
+				with self._queue_outstanding_lock:
+					self._queue_outstanding[handler.queue_name] = self._queue_outstanding.get(handler.queue_name, 0) + 1
+
+	def _preempt_for_waiting(self):
+		"""If the slaves have no free VM slots, stop the lowest priority
+		preemptible VMs to make room for the highest priority job in the default
+		queue that still has items waiting. Each preempt message carries an item
+		of the waiting job, which the slave starts in the stopped VM's slot. The
+		number of preemptions is limited by a token bucket.
+		"""
+		with self._queue_outstanding_lock:
+			if self._free_capacity > 0:
+				return
+			slave_vms = self._slave_vms
+
+		now = time.time()
+		with self._job_queue_lock:
+			job_queue = self._job_amqp_queues.get(self.AMQP_JOB_QUEUE)
+			if job_queue is None:
+				return
+
+			for uuid,vm in slave_vms:
+				handler = self._job_handlers.get(vm.get("job"))
+				if handler is not None:
+					handler.item_running(vm["idx"], vm.get("attempt", 1), now)
+
+			urgent = None
+			for priority,handler in job_queue.snapshot():
+				if handler.paused() or not handler.waiting():
+					continue
+				if urgent is None or handler.job.priority > urgent.job.priority:
+					urgent = handler
+			if urgent is None:
+				return
+
+			victims = []
+			for uuid,vm in slave_vms:
+				handler = self._job_handlers.get(vm.get("job"))
+				if handler is None or not handler.job.preemptible:
+					continue
+				if handler.job.priority + self._preempt_priority_gap > urgent.job.priority:
+					continue
+
+				key = (vm["idx"], vm.get("attempt", 1))
+				if key in handler.preempting or key not in handler.running:
+					continue
+				runtime = now - handler.running[key]
+				if runtime < self._preempt_min_runtime:
+					continue
+
+				# the lowest priority first, and the least work lost
+				victims.append((handler.job.priority, runtime, uuid, key, handler))
+			victims.sort(key=lambda victim: victim[:2])
+
+			for priority,runtime,uuid,(idx,attempt),handler in victims:
+				capacity = urgent.drip_capacity()
+				if capacity is not None and capacity <= 0:
+					break
+				if not self._preempt_bucket.take(now):
+					self._log.debug("preemption rate limit reached")
+					break
+
+				drops = urgent.drip(1)
+				if len(drops) == 0:
+					break
+				handler.preempting.add((idx, attempt))
+				# account for the item like any other drip, so the job's wait
+				# and aged priority start over
+				self._restart_wait(self.AMQP_JOB_QUEUE, urgent, self._band_key(urgent.job.priority), now)
+				self._get_group_rate(self._share_group(urgent.job)).add(1)
+
+				self._log.info("preempting job {} item {} on slave {} for job {}".format(handler.job.id, idx, uuid, urgent.job.id))
+				self._amqp_man.queue_msg(
+					json.dumps(dict(
+						type	= "preempt",
+						job		= str(handler.job.id),
+						idx		= idx,
+						attempt	= attempt,
+						next	= json.loads(drops[0]),
+					)),
+					Master.AMQP_SLAVE_QUEUE + "_" + uuid
+				)
+
+	def _get_queue_rate(self, queue_name):
+		if queue_name not in self._queue_rates:
+			# setdefault so that status lanes racing here share one estimator
+			self._queue_rates.setdefault(queue_name, RateEstimator(self._rate_time_constant))
+		return self._queue_rates[queue_name]
+
+	def _queue_target(self, queue_name):
+		"""Return the number of items that should be kept in the AMQP queue
+		``queue_name``: enough to cover ``drip_horizon`` seconds at the queue's
+		measured consumption rate, capped at ``drip_size``. Slaves consume the
+		default jobs queue, so it also covers their free VM slots, and never
+		drops below ``lookahead``.
+		"""
+		queue_rate = self._get_queue_rate(queue_name)
+		if queue_rate.warmed_up():
+			depth = min(self._drip_size, int(math.ceil(queue_rate.rate * self._drip_horizon)))
+		elif queue_name == self.AMQP_JOB_QUEUE:
+			depth = self._lookahead
+		else:
+			depth = self._drip_size
+
+		if queue_name == self.AMQP_JOB_QUEUE:
+			return self._free_capacity + max(self._lookahead, depth)
+		return max(1, depth)
+
+	def _update_free_capacity(self):
+		"""Recalculate the free VM slots across all slaves that have recently
+		reported their status
+		"""
+		min_modified = time.time() - self._slave_fresh_time
+
+		free = 0
+		slave_vms = []
+		for slave in Slave.objects(timestamps__modified__gte=min_modified).only("uuid", "max_vms", "running_vms", "vms"):
+			free += max(0, slave.max_vms - slave.running_vms)
+			for vm in slave.vms:
+				slave_vms.append((slave.uuid, vm))
+
+		with self._queue_outstanding_lock:
+			self._free_capacity = free
+			self._slave_vms = slave_vms
 	
+	def _on_slave_credit(self, data):
+		"""Handle a slave advertising free VM slots. Exactly that many job items
+		(or fewer, if there is not enough work) are published to the slave's
+		private queue, followed by a ``credit_ack`` message. Jobs whose image
+		the slave already has are preferred.
+
+		:data: The credit message, with ``uuid``, ``slots`` and ``images`` keys
+		"""
+		slave_queue = Master.AMQP_SLAVE_QUEUE + "_" + data["uuid"]
+		slots = data.get("slots", 0)
+		cached_images = set(data.get("images", []))
+
+		drops = []
+		with self._job_queue_lock:
+			# copies of straggling items go first, they hold up whole jobs
+			drops += self._speculative_drops[:slots]
+			del self._speculative_drops[:slots]
+
+			job_queue = self._job_amqp_queues.get(self.AMQP_JOB_QUEUE)
+			if job_queue is not None and slots - len(drops) > 0:
+				cached_handlers = []
+				other_handlers = []
+				for priority,handler in job_queue.snapshot():
+					if str(handler.job.image.id) in cached_images:
+						cached_handlers.append(handler)
+					else:
+						other_handlers.append(handler)
+
+				for handlers in [cached_handlers, other_handlers]:
+					drops += self._drip_handlers(self.AMQP_JOB_QUEUE, handlers, slots - len(drops))
+
+		unsent = self._amqp_man.queue_msgs(drops, slave_queue)
+		if len(unsent) > 0:
+			self._log.error("{} items could not be sent to slave {}, returning them to their jobs".format(len(unsent), data["uuid"]))
+			self._return_drops(unsent)
+
+		self._amqp_man.queue_msg(
+			json.dumps(dict(
+				type	= "credit_ack",
+				granted	= len(drops) - len(unsent)
+			)),
+			slave_queue
+		)
+
 	def _safe_priority(self, priority):
 		res = priority
 		if not isinstance(res, int):
@@ -470,19 +1496,249 @@ class JobManager(threading.Thread):
 
 		return res
 	
-	def _do_drip(self, queue_name, job_queue):
-		"""Drip more items into the job queue
+	def _do_drip(self, queue_name, job_queue, num):
+		"""Drip more items into the job queue, see ``_drip_handlers``
 
 		:queue_name: The name of the queue to add more job items into
 		:job_queue: The job queue to work
+		:num: The number of items to drip
 		:returns: None
 		"""
-		count = 0
-		for priority,job in job_queue.queue:
-			for drop in job.drip(self._drip_size):
-				count += 1
-				self._amqp_man.queue_msg(drop, queue_name)
+		handlers = [handler for priority,handler in job_queue.snapshot()]
+		drops = self._drip_handlers(queue_name, handlers, num)
+
+		unsent = self._amqp_man.queue_msgs(drops, queue_name)
+		if len(unsent) > 0:
+			self._log.error("{} items could not be dripped into {}, returning them to their jobs".format(len(unsent), queue_name))
+			self._return_drops(unsent)
+		dripped = len(drops) - len(unsent)
+
+		with self._queue_outstanding_lock:
+			self._queue_outstanding[queue_name] = self._queue_outstanding.get(queue_name, 0) + dripped
+
+	def _return_drops(self, drops):
+		"""Return the encoded items ``drops``, which never reached a queue, to
+		their jobs' pools
+		"""
+		for drop in drops:
+			data = json.loads(drop)
+			handler = self._job_handlers.get(data["job"])
+			if handler is not None:
+				handler.finish_item(data["idx"], data.get("attempt", 1), False)
+
+	def _drip_handlers(self, queue_name, handlers, num):
+		"""Return up to ``num`` encoded items from the jobs in ``handlers``. The
+		jobs are grouped by tag (see ``_share_group``) and the items are split
+		across the groups with deficit round robin, weighted by the groups'
+		ShareWeights. Each group's items are then split across its jobs by
+		``_drip_group``.
+
+		:queue_name: The name of the queue the jobs belong to
+		:handlers: The JobHandlers of the jobs to drip from
+		:num: The number of items to drip
+		"""
+		fair_share = self._group_fair_shares[queue_name]
+		now = time.time()
+
+		# dict of {<group>: [(<handler>, <capacity>)]}
+		groups = {}
+		entries = []
+		for handler in handlers:
+			group = self._share_group(handler.job)
+			if group not in groups:
+				groups[group] = []
+				entries.append(group)
+			groups[group].append((handler, handler.drip_capacity()))
+
+		for idx,group in enumerate(entries):
+			capacity = 0
+			for handler,handler_capacity in groups[group]:
+				if handler_capacity is None:
+					capacity = None
+					break
+				capacity += handler_capacity
+			entries[idx] = (group, self._share_weights.get(group, self._default_share_weight), capacity)
+
+		drops = []
+		for group,count in fair_share.allocate(num, entries):
+			group_drops = self._drip_group(queue_name, group, groups[group], count, now)
+			fair_share.refund(group, count - len(group_drops))
+			self._get_group_rate(group).add(len(group_drops))
+			drops += group_drops
+
+		return drops
+
+	def _drip_group(self, queue_name, group, handlers, num, now):
+		"""Return up to ``num`` encoded items from the jobs of one group. The
+		items are split across the priorities of the jobs with deficit round
+		robin, so every priority gets throughput in proportion to the summed
+		effective priorities of its jobs (see ``_queue_key``). The items of a
+		priority are split the same way across its jobs, in proportion to each
+		job's effective priority. The jobs are visited longest waiting first
+		(in steps of one aged priority), and ties go to the job with the least
+		expected work left, see ``aged_order_key``.
+
+		:queue_name: The name of the queue the jobs belong to
+		:group: The group the jobs are in
+		:handlers: A list of ``(JobHandler, <drip capacity>)`` tuples
+		:num: The number of items to drip
+		:now: The current time
+		"""
+		fair_share = self._job_fair_shares[queue_name].setdefault(group, BandedRoundRobin())
+
+		# dict of {<band key>: [(<order key>, <job id>, <effective priority>, <capacity>)]}
+		bands = {}
+		band_keys = []
+		job_handlers = {}
+		for handler,handler_capacity in handlers:
+			key = self._band_key(handler.job.priority)
+			if key not in bands:
+				bands[key] = []
+				band_keys.append(key)
+			order = aged_order_key(
+				handler.job.priority,
+				now - handler.wait_start,
+				self._expected_work(handler),
+				self._aging_rate
+			)
+			job_id = str(handler.job.id)
+			job_handlers[job_id] = handler
+			bands[key].append((order, job_id, self._effective_priority(handler, now), handler_capacity))
+
+		entries = []
+		for key in band_keys:
+			band = sorted(bands[key])
+			entries.append((key, [(job_id, weight, capacity) for order,job_id,weight,capacity in band]))
+
+		drops = []
+		for key,job_id,count in fair_share.allocate(num, entries):
+			handler = job_handlers[job_id]
+			job_drops = handler.drip(count)
+			drops += job_drops
+			fair_share.refund(key, job_id, count - len(job_drops))
+
+			if len(job_drops) > 0:
+				self._restart_wait(queue_name, handler, key, now)
+
+		return drops
+
+	def _restart_wait(self, queue_name, handler, band_key, now):
+		"""Record how long ``handler`` waited for its last drip and start its
+		next wait
+		"""
+		self._wait_times.add(band_key, now - handler.wait_start)
+		handler.wait_start = now
+		self._job_amqp_queues[queue_name].update(str(handler.job.id), self._queue_key(handler))
+
+	def _share_group(self, job):
+		"""Return the fair-share group of ``job``: the first of its tags that has
+		a ShareWeight, else its first tag, else the empty string
+		"""
+		for tag in job.tags:
+			if tag in self._share_weights:
+				return tag
+		if len(job.tags) > 0:
+			return job.tags[0]
+		return ""
+
+	def _load_share_weights(self):
+		"""Refresh the fair-share weights of the job groups from the database
+		"""
+		weights = {}
+		for share_weight in ShareWeight.objects():
+			if share_weight.weight > 0:
+				weights[share_weight.tag] = share_weight.weight
+		self._share_weights = weights
+
+	def _get_group_rate(self, group):
+		if group not in self._group_rates:
+			self._group_rates[group] = RateEstimator(self._rate_time_constant)
+		return self._group_rates[group]
+
+	def _get_shares(self):
+		"""Return a list of the target and achieved (recently dripped) shares of
+		each job group that has running jobs
+		"""
+		weights = {}
+		for handler in self._job_handlers.values():
+			group = self._share_group(handler.job)
+			weights[group] = self._share_weights.get(group, self._default_share_weight)
+
+		for group_rate in self._group_rates.values():
+			group_rate.sample()
+
+		total_weight = float(sum(weights.values()))
+		total_rate = sum(self._get_group_rate(group).rate for group in weights)
+
+		res = []
+		for group,weight in sorted(weights.items()):
+			achieved = None
+			if total_rate > 0:
+				achieved = self._get_group_rate(group).rate / total_rate
+			res.append({
+				"group": group,
+				"weight": weight,
+				"target": weight / total_weight,
+				"achieved": achieved,
+			})
+		return res
+
+	def _band_key(self, priority):
+		return "priority_{}".format(priority)
+
+	def _expected_time(self, handler):
+		"""Return the expected time (in seconds) for one item of the job, or None
+		if nothing has run yet
+		"""
+		return self._run_stats.expected_time(str(handler.job.task.tool.name), str(handler.job.image.id))
+
+	def _expected_work(self, handler):
+		"""Return how much work the job has left, in seconds of VM time. If no
+		run times are known at all the number of remaining items is used.
+		Jobs without a limit never run out of work.
+		"""
+		remaining = handler.remaining()
+		if remaining is None:
+			return float("inf")
+
+		item_time = self._expected_time(handler)
+		if item_time is None:
+			return remaining
+		return remaining * item_time
+
+	def _update_etas(self):
+		"""Estimate when each running job with a limit will finish and write
+		it to the job's ``eta`` field. The job's remaining items are assumed to
+		run as many at a time as it has outstanding now.
+		"""
+		now = time.time()
+
+		updates = {}
+		with self._job_queue_lock:
+			for job_id,handler in self._job_handlers.items():
+				eta = estimate_eta(
+					handler.remaining(),
+					self._expected_time(handler),
+					len(handler.outstanding),
+					now
+				)
+
+				last_eta = self._job_etas.get(job_id)
+				if eta is None and last_eta is None:
+					continue
+				if eta is not None and last_eta is not None and abs(eta - last_eta) < self.ETA_TOLERANCE:
+					continue
+
+				self._job_etas[job_id] = eta
+				updates[handler.job.id] = eta
+
+		if len(updates) == 0:
+			return
 
-				# always cap this off at _drip_size
-				if count >= self._drip_size:
-					return
+		bulk = Job._get_collection().initialize_unordered_bulk_op()
+		for job_id,eta in updates.iteritems():
+			bulk.find({"_id": job_id}).update_one({"$set": {"eta": eta}})
+		try:
+			bulk.execute()
+		except Exception as e:
+			self._log.error("could not update job etas: {}".format(e))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import collections
+import threading
+import time
+
+class CircuitBreaker(object):
+	"""Stops dispatching work when too much of it fails. The outcomes of the
+	most recent ``window`` items are kept, and once at least ``min_samples`` of
+	them are known and the failure rate reaches ``threshold`` the breaker
+	opens. After ``backoff`` seconds a single probe item is allowed through
+	(half-open): if it succeeds the breaker closes again, otherwise it reopens
+	with twice the backoff, up to ``max_backoff``.
+	"""
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, window=20, min_samples=10, threshold=0.8, backoff=60, max_backoff=60*60, probe_timeout=35*60):
+		"""init the circuit breaker
+
+		:param int window: The number of recent outcomes to keep
+		:param int min_samples: The fewest outcomes needed before the breaker can open
+		:param float threshold: The failure rate (0-1) at which the breaker opens
+		:param float backoff: How long (in seconds) to wait before the first probe
+		:param float max_backoff: The longest to wait between probes
+		:param float probe_timeout: How long to wait for a probe's outcome before
+			counting it as failed
+		"""
+		self._min_samples = min_samples
+		self._threshold = threshold
+		self._initial_backoff = backoff
+		self._max_backoff = max_backoff
+		self._probe_timeout = probe_timeout
+
+		self._outcomes = collections.deque(maxlen=window)
+		self._backoff = backoff
+		self._open_until = None
+		self._probe_time = None
+		# the item that was sent as the probe, see dispatched
+		self._probe_item = None
+		self._lock = threading.Lock()
+
+		self.state = self.CLOSED
+		# the failure rate when the breaker last opened
+		self.failure_rate = None
+
+	def record(self, success, now=None, item=None):
+		"""Record the outcome of an item
+
+		:param bool success: Whether the item succeeded
+		:param item: Identifies the item, see :meth:`dispatched`
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			if self.state == self.HALF_OPEN:
+				if self._probe_item is not None and item != self._probe_item:
+					# items that were already running when the breaker opened
+					return
+				if success:
+					self._close()
+				else:
+					self._open(now, self._backoff * 2)
+				return
+
+			if self.state == self.OPEN:
+				# items that were already running when the breaker opened
+				return
+
+			self._outcomes.append(success)
+			if len(self._outcomes) < self._min_samples:
+				return
+
+			failure_rate = self._outcomes.count(False) / float(len(self._outcomes))
+			if failure_rate >= self._threshold:
+				self.failure_rate = failure_rate
+				self._open(now, self._initial_backoff)
+
+	def trip(self, now=None):
+		"""Open the breaker, e.g. to restore a paused state
+		"""
+		if now is None:
+			now = time.time()
+		with self._lock:
+			self._open(now, self._initial_backoff)
+
+	def reset(self):
+		"""Close the breaker and forget all outcomes
+		"""
+		with self._lock:
+			self._close()
+
+	def allowed(self, now=None):
+		"""Return how many items may be dispatched right now: None (unlimited)
+		if the breaker is closed, 1 if a probe is due, otherwise 0
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			if self.state == self.HALF_OPEN and now - self._probe_time > self._probe_timeout:
+				# the probe was lost
+				self._open(now, self._backoff * 2)
+
+			if self.state == self.CLOSED:
+				return None
+			if self.state == self.OPEN and now >= self._open_until:
+				return 1
+			return 0
+
+	def dispatched(self, now=None, item=None):
+		"""Note that an item was dispatched, which makes a due probe in flight
+
+		:param item: Identifies the item. If given, only the outcome recorded
+			for the same ``item`` ends the probe.
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			if self.state == self.OPEN and now >= self._open_until:
+				self.state = self.HALF_OPEN
+				self._probe_time = now
+				self._probe_item = item
+
+	# ---------------------------------------
+
+	def _open(self, now, backoff):
+		self.state = self.OPEN
+		self._backoff = min(backoff, self._max_backoff)
+		self._open_until = now + self._backoff
+		self._probe_time = None
+		self._probe_item = None
+
+	def _close(self):
+		self.state = self.CLOSED
+		self._outcomes.clear()
+		self._backoff = self._initial_backoff
+		self._open_until = None
+		self._probe_time = None
+		self._probe_item = None
+		self.failure_rate = None
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import threading
+import time
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+class CoalescedCounters(threading.Thread):
+	"""Accumulates ``$inc`` updates to documents in memory and periodically
+	writes them to mongodb in one bulk operation, so that many small counter
+	updates (e.g. job progress) turn into one write per document per interval.
+	"""
+
+	daemon = True
+
+	def __init__(self, model, flush_interval=1.0):
+		"""init the coalesced counters
+
+		:param mongoengine.Document model: The model whose documents will be updated
+		:param float flush_interval: How often (in seconds) to write the counters
+		"""
+		super(CoalescedCounters, self).__init__()
+
+		self._model = model
+		self._flush_interval = flush_interval
+
+		# dict of {<doc id>: {<field>: <amount>}}
+		self._pending = {}
+		self._pending_lock = threading.Lock()
+		# only one flush may write at a time, or the increments could
+		# reach mongodb out of order with respect to explicit flushes
+		self._flush_lock = threading.Lock()
+
+		self._running = threading.Event()
+		self._log = logging.getLogger("Counters").getChild(model.__name__)
+
+	def run(self):
+		self._running.set()
+
+		while self._running.is_set():
+			time.sleep(self._flush_interval)
+			self.flush()
+
+		self.flush()
+
+	def stop(self):
+		self._running.clear()
+
+	def inc(self, doc_id, field, amt=1):
+		"""Increment the field ``field`` of document ``doc_id`` by ``amt``
+		"""
+		with self._pending_lock:
+			fields = self._pending.setdefault(str(doc_id), {})
+			fields[field] = fields.get(field, 0) + amt
+
+	def flush(self):
+		"""Write all pending increments to mongodb
+		"""
+		with self._flush_lock:
+			with self._pending_lock:
+				pending = self._pending
+				self._pending = {}
+
+			if len(pending) == 0:
+				return
+
+			bulk = self._model._get_collection().initialize_unordered_bulk_op()
+			for doc_id,fields in pending.iteritems():
+				bulk.find({"_id": ObjectId(doc_id)}).update_one({"$inc": fields})
+
+			try:
+				bulk.execute()
+			except BulkWriteError as e:
+				# some of the updates may have been applied, don't retry any of them
+				self._log.error("errors flushing counters: {}".format(e.details))
+			except Exception as e:
+				self._log.error("could not flush counters, will retry: {}".format(e))
+				for doc_id,fields in pending.iteritems():
+					for field,amt in fields.iteritems():
+						self.inc(doc_id, field, amt)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+class DeficitRoundRobin(object):
+	"""Weighted fair-share allocation using deficit round robin. Each call to
+	:meth:`allocate` splits a number of work items across the entries so that,
+	over many calls, every entry receives a share proportional to its weight.
+	Deficits carry over between calls, so entries with small weights still get
+	their share even when each individual allocation is small.
+	"""
+
+	def __init__(self):
+		"""init the deficit round robin scheduler"""
+		# dict of {<key>: <float deficit>}
+		self._deficits = {}
+		# the key served last, the next round starts after it
+		self._last_key = None
+
+	def remove(self, key):
+		"""Forget all state for ``key``
+		"""
+		self._deficits.pop(key, None)
+		if self._last_key == key:
+			self._last_key = None
+
+	def refund(self, key, amt):
+		"""Give back ``amt`` allocated items that ``key`` was not able to use
+		"""
+		if amt > 0 and key in self._deficits:
+			self._deficits[key] += amt
+
+	def allocate(self, total, entries):
+		"""Split ``total`` items across ``entries``.
+
+		:param int total: The number of items to hand out
+		:param list entries: A list of ``(key, weight, capacity)`` tuples, in the order
+			they should be visited. ``capacity`` is the most the entry can take
+			right now, or None if it is unlimited.
+		:returns: A list of ``(key, count)`` tuples in the order they were served
+		"""
+		active = []
+		for key,weight,capacity in entries:
+			if weight <= 0 or (capacity is not None and capacity <= 0):
+				# DRR resets the deficit of flows that have nothing to send
+				self._deficits.pop(key, None)
+				continue
+			active.append([key, weight, capacity])
+
+		if total <= 0 or len(active) == 0:
+			return []
+
+		# start the round after the last entry that was served
+		for idx,entry in enumerate(active):
+			if entry[0] == self._last_key:
+				active = active[idx+1:] + active[:idx+1]
+				break
+
+		# normalize so the heaviest entry gets one item per round
+		max_weight = float(max(entry[1] for entry in active))
+
+		counts = {}
+		order = []
+		remaining = total
+		while remaining > 0 and len(active) > 0:
+			next_active = []
+			for entry in active:
+				if remaining == 0:
+					break
+
+				key,weight,capacity = entry
+				deficit = self._deficits.get(key, 0.0) + weight / max_weight
+				num = min(int(deficit), remaining)
+				if capacity is not None:
+					num = min(num, capacity)
+
+				if num > 0:
+					if key not in counts:
+						counts[key] = 0
+						order.append(key)
+					counts[key] += num
+					deficit -= num
+					remaining -= num
+				self._last_key = key
+
+				if capacity is not None:
+					entry[2] = capacity - num
+					if entry[2] == 0:
+						self._deficits.pop(key, None)
+						continue
+
+				self._deficits[key] = deficit
+				next_active.append(entry)
+			active = next_active
+
+		return [(allocated_key, counts[allocated_key]) for allocated_key in order]
+
+class BandedRoundRobin(object):
+	"""Two levels of deficit round robin: items are split across bands (e.g.
+	the priorities of a group's jobs) in proportion to the summed weights of
+	their entries, then the items of each band are split across its entries
+	in proportion to their weights.
+	"""
+
+	def __init__(self):
+		"""init the banded round robin scheduler"""
+		self._bands = DeficitRoundRobin()
+		# dict of {<band>: DeficitRoundRobin}
+		self._entries = {}
+
+	def remove(self, band, key=None):
+		"""Forget all state for ``key`` in ``band``, or for the whole band if
+		``key`` is None
+		"""
+		if key is None:
+			self._bands.remove(band)
+			self._entries.pop(band, None)
+		elif band in self._entries:
+			self._entries[band].remove(key)
+
+	def refund(self, band, key, amt):
+		"""Give back ``amt`` allocated items that ``key`` in ``band`` was not able
+		to use
+		"""
+		if band in self._entries:
+			self._entries[band].refund(key, amt)
+		self._bands.refund(band, amt)
+
+	def allocate(self, total, bands):
+		"""Split ``total`` items across the entries of ``bands``.
+
+		:param int total: The number of items to hand out
+		:param list bands: A list of ``(band, entries)`` tuples, in the order they
+			should be visited. ``entries`` is a list of ``(key, weight, capacity)``
+			tuples, see :meth:`DeficitRoundRobin.allocate`.
+		:returns: A list of ``(band, key, count)`` tuples in the order they were served
+		"""
+		band_entries = {}
+		band_totals = []
+		for band,entries in bands:
+			band_entries[band] = entries
+
+			weight = 0
+			capacity = 0
+			for key,entry_weight,entry_capacity in entries:
+				if entry_weight <= 0:
+					continue
+				weight += entry_weight
+				if capacity is not None:
+					capacity = None if entry_capacity is None else capacity + max(0, entry_capacity)
+			band_totals.append((band, weight, capacity))
+
+		res = []
+		for band,count in self._bands.allocate(total, band_totals):
+			allocated = 0
+			for key,key_count in self._entries.setdefault(band, DeficitRoundRobin()).allocate(count, band_entries[band]):
+				res.append((band, key, key_count))
+				allocated += key_count
+			self._bands.refund(band, count - allocated)
+		return res
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import threading
+
+class BulkInserter(threading.Thread):
+	"""Buffers new documents and inserts them into mongodb in batches. A batch
+	is written once ``batch_size`` documents are buffered, or once the oldest
+	buffered document has waited ``max_latency`` seconds, whichever comes
+	first.
+	"""
+
+	daemon = True
+
+	def __init__(self, model, batch_size=100, max_latency=0.5):
+		"""init the bulk inserter
+
+		:param mongoengine.Document model: The model of the documents to insert
+		:param int batch_size: The most documents to insert at once
+		:param float max_latency: The longest (in seconds) a document may be buffered
+		"""
+		super(BulkInserter, self).__init__()
+
+		self._model = model
+		self._batch_size = batch_size
+		self._max_latency = max_latency
+
+		self._buffer = []
+		self._buffer_lock = threading.Lock()
+		# set when a full batch is ready
+		self._batch_ready = threading.Event()
+
+		self._running = threading.Event()
+		self._log = logging.getLogger("BulkInsert").getChild(model.__name__)
+
+	def run(self):
+		self._running.set()
+
+		while self._running.is_set():
+			self._batch_ready.wait(self._max_latency)
+			self._batch_ready.clear()
+			self.flush()
+
+		self.flush()
+
+	def stop(self):
+		self._running.clear()
+		self._batch_ready.set()
+
+	def add(self, doc):
+		"""Buffer the unsaved document ``doc`` to be inserted
+		"""
+		with self._buffer_lock:
+			self._buffer.append(doc)
+			if len(self._buffer) >= self._batch_size:
+				self._batch_ready.set()
+
+	def flush(self):
+		"""Insert all buffered documents, ``batch_size`` at a time
+		"""
+		with self._buffer_lock:
+			docs = self._buffer
+			self._buffer = []
+
+		for x in xrange(0, len(docs), self._batch_size):
+			batch = docs[x:x+self._batch_size]
+			try:
+				self._model.objects.insert(batch, load_bulk=False)
+			except Exception:
+				self._log.exception("could not insert {} documents".format(len(batch)))
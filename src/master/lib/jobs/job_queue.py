@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import itertools
+
+class JobQueue(object):
+	"""An indexed priority queue of job handlers. Items are keyed by job id
+	so they can be removed or re-prioritized in O(log n) without draining
+	and refilling the whole queue. Lower priority values come out first,
+	items with equal priorities come out in insertion order.
+	"""
+
+	def __init__(self):
+		"""init the job queue"""
+		# binary heap of [priority, seq, key, item] entries
+		self._heap = []
+		# dict of {<key>: <heap index>}
+		self._index = {}
+		self._counter = itertools.count()
+
+	def __len__(self):
+		return len(self._heap)
+
+	def __contains__(self, key):
+		return key in self._index
+
+	def qsize(self):
+		"""Return the number of items in the queue (same as ``Q.PriorityQueue.qsize``)
+		"""
+		return len(self._heap)
+
+	def put(self, key, priority, item):
+		"""Add ``item`` to the queue under ``key`` with priority ``priority``. If
+		``key`` is already in the queue, its item and priority are replaced.
+
+		:param str key: The unique key of the item (a job id)
+		:param priority: The priority of the item, lowest comes out first
+		:param item: The item itself (a JobHandler)
+		"""
+		if key in self._index:
+			idx = self._index[key]
+			self._heap[idx][3] = item
+			self._reprioritize(idx, priority)
+			return
+
+		entry = [priority, next(self._counter), key, item]
+		self._heap.append(entry)
+		self._index[key] = len(self._heap) - 1
+		self._sift_up(len(self._heap) - 1)
+
+	def get(self, key, default=None):
+		"""Return the item stored under ``key`` without removing it
+		"""
+		if key not in self._index:
+			return default
+		return self._heap[self._index[key]][3]
+
+	def priority(self, key):
+		"""Return the priority of the item stored under ``key``
+		"""
+		return self._heap[self._index[key]][0]
+
+	def peek(self):
+		"""Return the ``(priority, item)`` that would be popped next, or None if
+		the queue is empty
+		"""
+		if len(self._heap) == 0:
+			return None
+		entry = self._heap[0]
+		return entry[0], entry[3]
+
+	def pop(self):
+		"""Remove and return the ``(priority, item)`` with the lowest priority value
+		"""
+		if len(self._heap) == 0:
+			raise IndexError("pop from an empty JobQueue")
+		entry = self._heap[0]
+		self._remove_at(0)
+		return entry[0], entry[3]
+
+	def remove(self, key):
+		"""Remove the item stored under ``key``, returning it. None is returned if
+		``key`` is not in the queue.
+		"""
+		if key not in self._index:
+			return None
+		idx = self._index[key]
+		item = self._heap[idx][3]
+		self._remove_at(idx)
+		return item
+
+	def update(self, key, priority):
+		"""Change the priority of the item stored under ``key``
+		"""
+		self._reprioritize(self._index[key], priority)
+
+	def snapshot(self):
+		"""Return a list of ``(priority, item)`` tuples in the order they would be
+		popped. The queue itself is not modified.
+		"""
+		return [(entry[0], entry[3]) for entry in sorted(self._heap)]
+
+	def __iter__(self):
+		return iter([item for priority,item in self.snapshot()])
+
+	# ---------------------------------------
+
+	def _reprioritize(self, idx, priority):
+		old_priority = self._heap[idx][0]
+		self._heap[idx][0] = priority
+		if priority < old_priority:
+			self._sift_up(idx)
+		else:
+			self._sift_down(idx)
+
+	def _remove_at(self, idx):
+		entry = self._heap[idx]
+		del self._index[entry[2]]
+
+		last = self._heap.pop()
+		if idx == len(self._heap):
+			return
+
+		self._heap[idx] = last
+		self._index[last[2]] = idx
+		# the moved entry may need to go either direction
+		self._sift_up(idx)
+		self._sift_down(self._index[last[2]])
+
+	def _swap(self, i, j):
+		heap = self._heap
+		heap[i],heap[j] = heap[j],heap[i]
+		self._index[heap[i][2]] = i
+		self._index[heap[j][2]] = j
+
+	def _less(self, i, j):
+		# [priority, seq] is unique, never compare keys or items
+		return self._heap[i][:2] < self._heap[j][:2]
+
+	def _sift_up(self, idx):
+		while idx > 0:
+			parent = (idx - 1) >> 1
+			if not self._less(idx, parent):
+				break
+			self._swap(idx, parent)
+			idx = parent
+
+	def _sift_down(self, idx):
+		size = len(self._heap)
+		while True:
+			left = 2*idx + 1
+			if left >= size:
+				break
+			smallest = left
+			right = left + 1
+			if right < size and self._less(right, left):
+				smallest = right
+			if not self._less(smallest, idx):
+				break
+			self._swap(idx, smallest)
+			idx = smallest
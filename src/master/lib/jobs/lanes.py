@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import Queue
+import threading
+import zlib
+
+class _Lane(threading.Thread):
+	"""One ordered worker of a LanePool"""
+
+	daemon = True
+
+	# put in the queue to stop the lane
+	_STOP = object()
+
+	def __init__(self, callback, log):
+		super(_Lane, self).__init__()
+
+		self._callback = callback
+		self._log = log
+		self.queue = Queue.Queue()
+
+		# the most items waiting in the queue since the last stats() call
+		self.peak = 0
+		self.handled = 0
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is self._STOP:
+				break
+
+			try:
+				self._callback(item)
+			except Exception:
+				self._log.exception("error handling {!r}".format(item))
+			self.handled += 1
+
+	def stop(self):
+		self.queue.put(self._STOP)
+
+class LanePool(object):
+	"""Handles work items on ``num_lanes`` worker threads. Items with the same
+	key always go to the same lane, so they are handled one at a time and in
+	the order they were submitted, while items with different keys are handled
+	in parallel.
+	"""
+
+	def __init__(self, callback, num_lanes=4, name="Lanes"):
+		"""init the lane pool
+
+		:param callable callback: Called with each submitted item
+		:param int num_lanes: The number of worker threads
+		:param str name: The name to log as
+		"""
+		self._log = logging.getLogger(name)
+		self._lanes = [_Lane(callback, self._log.getChild(str(x))) for x in xrange(max(1, num_lanes))]
+		self._stats_lock = threading.Lock()
+
+	def start(self):
+		for lane in self._lanes:
+			lane.start()
+
+	def stop(self):
+		"""Stop the lanes once the items already submitted are handled
+		"""
+		for lane in self._lanes:
+			lane.stop()
+
+	def submit(self, key, item):
+		"""Handle ``item`` on the lane for ``key``
+		"""
+		lane = self._lanes[(zlib.crc32(str(key)) & 0xffffffff) % len(self._lanes)]
+		lane.queue.put(item)
+
+		depth = lane.queue.qsize()
+		if depth > lane.peak:
+			lane.peak = depth
+
+	def depths(self):
+		"""Return the number of items waiting in each lane
+		"""
+		return [lane.queue.qsize() for lane in self._lanes]
+
+	def stats(self):
+		"""Return the current and peak (since the last call) queue depths and
+		the number of items handled by each lane
+		"""
+		with self._stats_lock:
+			res = dict(
+				depths		= self.depths(),
+				peaks		= [lane.peak for lane in self._lanes],
+				handled		= [lane.handled for lane in self._lanes],
+			)
+			for lane in self._lanes:
+				lane.peak = 0
+		return res
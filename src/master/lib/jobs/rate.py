@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import math
+import threading
+import time
+
+class RateEstimator(object):
+	"""An exponentially weighted moving average of the rate (per second) at
+	which events happen. Older samples decay with the time constant ``tau``,
+	so the estimate is independent of how often it is sampled.
+	"""
+
+	def __init__(self, tau=60.0, now=None):
+		"""init the rate estimator
+
+		:param float tau: The time constant (in seconds) of the moving average
+		:param float now: The current time, defaults to ``time.time()``
+		"""
+		if now is None:
+			now = time.time()
+
+		self._tau = float(tau)
+		self._rate = 0.0
+		self._count = 0
+		self._start = now
+		self._last_sample = now
+		self._lock = threading.Lock()
+
+	def add(self, num=1):
+		"""Record ``num`` events
+		"""
+		with self._lock:
+			self._count += num
+
+	def sample(self, now=None):
+		"""Fold the events recorded since the last sample into the average
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			dt = now - self._last_sample
+			if dt <= 0:
+				return
+			decay = math.exp(-dt / self._tau)
+			self._rate = self._rate * decay + (self._count / dt) * (1.0 - decay)
+			self._count = 0
+			self._last_sample = now
+
+	def warmed_up(self, now=None):
+		"""Return True once the estimate covers at least one time constant
+		"""
+		if now is None:
+			now = time.time()
+		return now - self._start >= self._tau
+
+	@property
+	def rate(self):
+		"""The estimated number of events per second
+		"""
+		return self._rate
+
+class TokenBucket(object):
+	"""Allows bursts of up to ``burst`` actions, refilled at ``rate`` actions
+	per second
+	"""
+
+	def __init__(self, rate, burst, now=None):
+		"""init the token bucket
+
+		:param float rate: How many tokens are added per second
+		:param int burst: The most tokens the bucket can hold
+		:param float now: The current time, defaults to ``time.time()``
+		"""
+		if now is None:
+			now = time.time()
+
+		self._rate = float(rate)
+		self._burst = burst
+		self._tokens = float(burst)
+		self._last = now
+		self._lock = threading.Lock()
+
+	def take(self, now=None):
+		"""Take a token if one is available
+
+		:returns: True if a token was taken
+		"""
+		if now is None:
+			now = time.time()
+
+		with self._lock:
+			self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+			self._last = now
+			if self._tokens < 1:
+				return False
+			self._tokens -= 1
+			return True
+
+def estimate_eta(remaining, item_time, parallel=1, now=None):
+	"""Estimate when ``remaining`` items will be finished if they each take
+	``item_time`` seconds and ``parallel`` of them run at a time
+
+	:returns: The estimated finish time, or None if it can't be estimated
+	"""
+	if remaining is None or item_time is None:
+		return None
+	if now is None:
+		now = time.time()
+	return now + math.ceil(remaining / float(max(1, parallel))) * item_time
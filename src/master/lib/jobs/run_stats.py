@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import math
+import threading
+import time
+
+class RunningStats(object):
+	"""The running count, mean and variance of a series of values, updated one
+	value at a time with Welford's method so no values need to be kept.
+	"""
+
+	def __init__(self, count=0, mean=0.0, m2=0.0):
+		"""init the running stats
+
+		:param int count: The number of values seen so far
+		:param float mean: The mean of the values seen so far
+		:param float m2: The sum of squared differences from the mean
+		"""
+		self.count = count
+		self.mean = mean
+		self.m2 = m2
+
+	def add(self, value):
+		"""Add ``value`` to the stats
+		"""
+		value = float(value)
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+
+	@property
+	def variance(self):
+		"""The sample variance of the values, 0 if there are fewer than two
+		"""
+		if self.count < 2:
+			return 0.0
+		return self.m2 / (self.count - 1)
+
+	@property
+	def stddev(self):
+		return math.sqrt(self.variance)
+
+class RunStatsTracker(object):
+	"""Tracks how long job items take to boot and run for each tool and image,
+	so that the scheduler can estimate how much work a job has left. Stats are
+	kept in memory and written to the database with :meth:`flush`.
+	"""
+
+	def __init__(self, model):
+		"""init the run stats tracker
+
+		:param mongoengine.Document model: The model to persist the stats with (RunStats)
+		"""
+		self._model = model
+
+		# dict of {(<tool>, <image>): (<boot RunningStats>, <run RunningStats>)}
+		self._stats = {}
+		# keys that changed since the last flush
+		self._dirty = set()
+		self._lock = threading.Lock()
+
+		self._log = logging.getLogger("RunStats")
+
+	def load(self):
+		"""Load all of the stats from the database
+		"""
+		with self._lock:
+			for doc in self._model.objects():
+				self._stats[(doc.tool, doc.image)] = (
+					RunningStats(doc.boot_count, doc.boot_mean, doc.boot_m2),
+					RunningStats(doc.run_count, doc.run_mean, doc.run_m2),
+				)
+
+	def add(self, tool, image, boot_time=None, run_time=None):
+		"""Record how long an item of ``tool`` in ``image`` took to boot and to
+		run. Either time may be None if it is unknown.
+		"""
+		key = (tool, image)
+		with self._lock:
+			if key not in self._stats:
+				self._stats[key] = (RunningStats(), RunningStats())
+			boot,run = self._stats[key]
+
+			if boot_time is not None:
+				boot.add(boot_time)
+			if run_time is not None:
+				run.add(run_time)
+			self._dirty.add(key)
+
+	def expected_time(self, tool, image):
+		"""Return the expected time (in seconds) to boot and run one item of
+		``tool`` in ``image``. If the combination has never run, the mean over
+		all known combinations is used, and None if nothing is known at all.
+		"""
+		with self._lock:
+			stats = self._stats.get((tool, image))
+			if stats is not None and stats[1].count > 0:
+				return stats[0].mean + stats[1].mean
+
+			known = [boot.mean + run.mean for boot,run in self._stats.values() if run.count > 0]
+			if len(known) == 0:
+				return None
+			return sum(known) / len(known)
+
+	def flush(self):
+		"""Write the stats that have changed to the database
+		"""
+		with self._lock:
+			dirty = [(key, self._stats[key]) for key in self._dirty]
+			self._dirty = set()
+
+		for (tool,image),(boot,run) in dirty:
+			try:
+				self._model.objects(tool=tool, image=image).update_one(
+					upsert						= True,
+					set__boot_count				= boot.count,
+					set__boot_mean				= boot.mean,
+					set__boot_m2				= boot.m2,
+					set__run_count				= run.count,
+					set__run_mean				= run.mean,
+					set__run_m2					= run.m2,
+					set__timestamps__modified	= time.time(),
+				)
+			except Exception as e:
+				self._log.error("could not save run stats for {}/{}, will retry: {}".format(tool, image, e))
+				with self._lock:
+					self._dirty.add((tool, image))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import collections
+import threading
+
+def percentile(values, pct):
+	"""Return the ``pct`` percentile (0-100) of the sorted list ``values``
+	using the nearest-rank method, or None if it is empty
+	"""
+	if len(values) == 0:
+		return None
+	rank = int(round(pct / 100.0 * (len(values) - 1)))
+	return values[rank]
+
+def aged_order_key(priority, waited, work, aging_rate):
+	"""Return the key to order jobs with the same priority by. Jobs are ordered
+	by their aged priority (``priority`` plus ``aging_rate`` per second
+	``waited``, in whole steps), then by least expected ``work`` left. A job
+	with a lot of work can be passed by jobs with less work that have waited
+	about as long, but not forever by a stream of new ones.
+	"""
+	return (-int(priority + aging_rate * waited), work)
+
+class WaitTimes(object):
+	"""Keeps the most recent wait times of each group (e.g. priority band)
+	and summarizes them as percentiles
+	"""
+
+	PERCENTILES = [50, 90, 99]
+
+	def __init__(self, window=1000):
+		"""init the wait times
+
+		:param int window: The number of recent wait times kept per group
+		"""
+		self._window = window
+		# dict of {<group>: deque([<wait time>])}
+		self._waits = {}
+		self._lock = threading.Lock()
+
+	def add(self, group, wait):
+		"""Record that something in ``group`` waited ``wait`` seconds
+		"""
+		with self._lock:
+			if group not in self._waits:
+				self._waits[group] = collections.deque(maxlen=self._window)
+			self._waits[group].append(wait)
+
+	def summary(self):
+		"""Return ``{<group>: {"count": N, "p50": .., "p90": .., "p99": ..}}``
+		"""
+		with self._lock:
+			waits = dict((group, sorted(values)) for group,values in self._waits.iteritems())
+
+		res = {}
+		for group,values in waits.iteritems():
+			stats = {"count": len(values)}
+			for pct in self.PERCENTILES:
+				stats["p{}".format(pct)] = percentile(values, pct)
+			res[group] = stats
+		return res
@@ -61,10 +61,67 @@ class Job(Document):
 	network		= StringField()
 	debug		= BooleanField(default=False)
 	vm_max		= IntField(default=30*60)
+	# whether the job's VMs may be stopped to make room for higher priority jobs
+	preemptible	= BooleanField(default=True)
+	num_errors	= IntField(default=0)
+	num_logs	= IntField(default=0)
+	# estimated completion time, None if it can't be estimated (yet)
+	eta			= FloatField(null=True)
+	# legacy, errors and logs are now stored as JobLog documents
 	errors		= ListField(EmbeddedDocumentField(JobError))
 	logs		= ListField(EmbeddedDocumentField(JobError))
 	tags		= ListField(StringField())
 
+class JobLog(Document):
+	meta = {
+		"indexes": [
+			{"fields": ["job", "idx"]},
+			{"fields": ["job", "type", "created"]},
+		]
+	}
+
+	job			= ReferenceField("Job", required=True)
+	idx			= IntField()
+	type		= StringField(required=True) # error or log
+	message		= StringField()
+	backtrace	= StringField()
+	logs		= ListField(StringField())
+	created		= DateTimeField(default=datetime.datetime.now)
+
+class JobCheckpoint(Document):
+	"""Dispatch state of a running job, so the master can resume it after
+	a restart"""
+	job			= ReferenceField("Job", required=True, unique=True)
+	drip_count	= IntField(default=0)
+	fileset		= ReferenceField("FileSet")
+	# {"<idx>": <dispatch time>} of items that have not finished yet
+	outstanding	= DictField()
+
+class RunStats(Document):
+	"""How long job items of a tool in an image take to boot and run, as
+	running means and sums of squared differences (Welford's method)"""
+	meta = {
+		"indexes": [
+			{"fields": ["tool", "image"], "unique": True},
+		]
+	}
+
+	tool		= StringField(required=True)
+	image		= StringField(required=True)
+	boot_count	= IntField(default=0)
+	boot_mean	= FloatField(default=0.0)
+	boot_m2		= FloatField(default=0.0)
+	run_count	= IntField(default=0)
+	run_mean	= FloatField(default=0.0)
+	run_m2		= FloatField(default=0.0)
+	timestamps	= DictField()
+
+class ShareWeight(Document):
+	"""The fair-share weight of the group of jobs tagged with ``tag``,
+	relative to the other groups"""
+	tag			= StringField(unique=True)
+	weight		= FloatField(default=1.0)
+
 class FileSet(Document):
 	name		= StringField()
 	files		= ListField()
@@ -104,6 +161,7 @@ class Master(Document):
 	ip				= StringField()
 	vms				= ListField(DictField())
 	queues			= DictField()
+	stats			= DictField()
 
 class Slave(Document):
 	meta = {
@@ -119,4 +177,5 @@ class Slave(Document):
 	running_vms		= IntField(default=0)
 	total_jobs_run	= IntField(default=0)
 	vms				= ListField(DictField())
+	stats			= DictField()
 	timestamps		= DictField()
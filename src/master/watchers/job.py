@@ -11,17 +11,33 @@ from master.lib.jobs import JobManager
 from master.watchers import WatcherBase
 from master.lib.amqp_man import AmqpManager
 
+def _env_flag(name, default=False):
+	"""Return True if the environment variable ``name`` is set to a true
+	value (``1``, ``true``, ``yes`` or ``on``), or ``default`` if it is unset
+	"""
+	value = os.environ.get(name)
+	if value is None:
+		return default
+	return value.strip().lower() in ["1", "true", "yes", "on"]
+
 class JobWatcher(WatcherBase):
 	collection = "talus.job"
 
 	def __init__(self, *args, **kwargs):
 		WatcherBase.__init__(self, *args, **kwargs)
 
-		self._job_man = JobManager()
+		# TALUS_JOB_DISPATCH - "push" (default) or "credit", see JobManager
+		# TALUS_JOB_SPECULATE - re-dispatch copies of straggling items, off by default
+		# TALUS_JOB_PREEMPT - stop low-priority VMs for waiting high-priority jobs, off by default
+		self._job_man = JobManager(
+			dispatch	= os.environ.get("TALUS_JOB_DISPATCH", JobManager.DISPATCH_PUSH),
+			speculate	= _env_flag("TALUS_JOB_SPECULATE", False),
+			preempt		= _env_flag("TALUS_JOB_PREEMPT", False),
+		)
 		# this needs to be continuously running
 		self._job_man.start()
 
-		for job in master.models.Job.objects(status__name__in=["run", "stop", "cancel"]):
+		for job in master.models.Job.objects(status__name__in=["run", "stop", "cancel", "resume"]):
 			self._handle_status(job.id, job=job)
 	
 	def stop(self):
@@ -31,6 +47,12 @@ class JobWatcher(WatcherBase):
 	def insert(self, id_, obj):
 		self._log.debug("handling insert")
 
+		if obj.get("status", {}).get("name") == "run":
+			# new jobs are started in batches by the job manager, no need to
+			# query each one here
+			self._job_man.submit_job(id_)
+			return
+
 		self._handle_status(id_, obj)
 
 	def update(self, id, mod):
@@ -50,6 +72,7 @@ class JobWatcher(WatcherBase):
 			"run"		: self._handle_run,
 			"stop"		: self._handle_stop,
 			"cancel"	: self._handle_cancel,
+			"resume"	: self._handle_resume,
 		}
 
 		if job is None:
@@ -62,22 +85,12 @@ class JobWatcher(WatcherBase):
 			switch[job.status["name"]](id_, job)
 	
 	def _handle_run(self, id_, job):
-		"""Handle running a job
+		"""Handle running a job. The job manager checks the image and sets the
+		job's status when it starts the job.
 		"""
 		self._log.info("handling job runnage")
 
-		if job.image.status["name"] != "ready":
-			self._log.warn("Image is not in a ready state! cannot run the job yet, cancelling")
-			job.status = {"name": "cancelled", "desc": "image not ready"}
-			job.save()
-			return
-
-		self._job_man.run_job(job)
-
-		job.status = {
-			"name": "running"
-		}
-		job.save()
+		self._job_man.submit_job(job.id)
 
 	def _handle_stop(self, id_, job):
 		"""Handle stopping a job - to be used only for internal purposes. Not
@@ -103,3 +116,11 @@ class JobWatcher(WatcherBase):
 		job.save()
 
 		self._job_man.cancel_job(job)
+	
+	def _handle_resume(self, id_, job):
+		"""Handle resuming a job that was paused because too many of its items
+		(or its image's) failed
+		"""
+		self._log.info("handling job resumption")
+
+		self._job_man.resume_job(job)
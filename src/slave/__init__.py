@@ -22,6 +22,8 @@ import time
 import uuid
 
 from slave.amqp_man import AmqpManager
+from slave.codec import SlaveNew,SlaveStatus,SlaveCredit,JobTaken,JobProgress,JobResult,JobError,JobLog,JobFinished
+import slave.codec
 from slave.vm import VMHandler,ImageManager
 import slave.models
 
@@ -165,6 +167,10 @@ class Slave(threading.Thread):
 		exclusive	= False,
 	)
 
+	# see the master's JobManager.DISPATCH_* values
+	DISPATCH_PUSH = "push"
+	DISPATCH_CREDIT = "credit"
+
 	_INSTANCE = None
 	@classmethod
 	def instance(cls, amqp_host=None, max_vms=None, intf=None):
@@ -201,6 +207,19 @@ class Slave(threading.Thread):
 
 		self._already_consuming = False
 
+		# set by the config message, in credit mode the slave asks the master
+		# for work instead of consuming the shared jobs queue
+		self._dispatch = self.DISPATCH_PUSH
+		self._granted_jobs = Queue()
+		self._credit_lock = threading.Lock()
+		# True while a credit message is waiting on its credit_ack
+		self._credit_pending = False
+		self._credit_sent_time = 0
+		# resend credits if the master never answered (e.g. it restarted)
+		self._credit_timeout = 30
+		# granted jobs that have not become VMHandlers yet
+		self._reserved_slots = 0
+
 		self._handlers = []
 		self._handlers_lock = threading.Lock()
 		self._total_jobs_run = 0
@@ -258,13 +277,13 @@ class Slave(threading.Thread):
 		self._amqp_man.wait_for_ready()
 
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "new",
+			SlaveNew(
 				uuid		= self._uuid,
 				ip		= self._ip,
 				hostname	= self._hostname,
 				max_vms		= self._max_vms,
-			)),
+				codecs		= slave.codec.available_codecs(),
+			),
 			self.AMQP_SLAVE_STATUS_QUEUE
 		)
 
@@ -277,6 +296,10 @@ class Slave(threading.Thread):
 		self._status_update_thread.daemon = True
 		self._status_update_thread.start()
 
+		self._granted_jobs_thread = threading.Thread(target=self._do_start_granted_jobs)
+		self._granted_jobs_thread.daemon = True
+		self._granted_jobs_thread.start()
+
 		while self._running.is_set():
 			time.sleep(0.2)
 
@@ -305,16 +328,22 @@ class Slave(threading.Thread):
 
 		logging.shutdown()
 	
-	def cancel_job(self, job):
+	def cancel_job(self, job, idx=None, keep_attempt=None):
 		"""
 		Cancel the job with job id ``job``
 
 		:job: The job id to cancel
+		:idx: Only cancel this item of the job
+		:keep_attempt: Don't cancel this copy of the item
 		"""
 		for handler in self._handlers:
-			if handler.job == job:
-				self._log.debug("cancelling handler for job {}".format(job))
-				handler.stop()
+			if handler.job != job:
+				continue
+			if idx is not None and (handler.idx != idx or handler.attempt == keep_attempt):
+				continue
+			self._log.debug("cancelling handler for job {}:{}".format(job, handler.idx))
+			handler.cancelled = True
+			handler.stop()
 		self._log.warn("could not find handler for job {} to cancel".format(job))
 	
 	# -----------------------
@@ -355,6 +384,7 @@ class Slave(threading.Thread):
 		if found_handler is not None:
 			found_handler.on_received_started()
 			self._last_vm_started_evt.set()
+			self._send_credit()
 		else:
 			self._log.warn("cannot find the handler for data: {}".format(data))
 	
@@ -362,13 +392,12 @@ class Slave(threading.Thread):
 		self._log.debug("handling errored job part: {}:{}".format(data["job"], data["idx"]))
 
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "error",
+			JobError(
 				tool		= data["tool"],
 				idx			= data["idx"],
 				job			= data["job"],
 				data		= data["data"]
-			)),
+			),
 			self.AMQP_JOB_STATUS_QUEUE
 		)
 	
@@ -376,13 +405,12 @@ class Slave(threading.Thread):
 		self._log.debug("handling debug logs from job part: {}:{}".format(data["job"], data["idx"]))
 
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "log",
+			JobLog(
 				tool		= data["tool"],
 				idx			= data["idx"],
 				job			= data["job"],
 				data		= data["data"]
-			)),
+			),
 			self.AMQP_JOB_STATUS_QUEUE
 		)
 	
@@ -409,16 +437,18 @@ class Slave(threading.Thread):
 				matched_handler = handler
 				break
 
+		attempt = data.get("attempt", 1)
 		if matched_handler is not None:
 			matched_handler.total_progress += data["data"]
+			attempt = matched_handler.attempt
 
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "progress",
+			JobProgress(
 				job			= data["job"],
 				idx			= data["idx"],
+				attempt		= attempt,
 				amt			= data["data"], # it's expected to just be a number
-			)),
+			),
 			self.AMQP_JOB_STATUS_QUEUE
 		)
 	
@@ -426,13 +456,12 @@ class Slave(threading.Thread):
 		self._log.debug("handling job result: {}:{}".format(data["job"], data["idx"]))
 
 		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type		= "result",
+			JobResult(
 				tool		= data["tool"],
 				idx			= data["idx"],
 				job			= data["job"],
 				data		= data["data"],
-			)),
+			),
 			self.AMQP_JOB_STATUS_QUEUE
 		)
 
@@ -443,6 +472,18 @@ class Slave(threading.Thread):
 	def _on_job_received(self, channel, method, properties, body):
 		"""
 		"""
+		data = slave.codec.decode_props(body, properties)
+
+		# let the master know the job queue has room for more work
+		self._amqp_man.queue_msg(
+			JobTaken(
+				queue		= self.AMQP_JOB_QUEUE,
+				job			= data.get("job"),
+				idx			= data.get("idx"),
+			),
+			self.AMQP_JOB_STATUS_QUEUE
+		)
+
 		self._max_vms_lock.acquire()
 
 		# wait for any restarts to be 
@@ -453,8 +494,14 @@ class Slave(threading.Thread):
 		self._log.info("received job from queue: {}".format(body))
 
 		self._amqp_man.ack_method(method)
-		data = json.loads(body)
 
+		self._start_job(data)
+
+	def _start_job(self, data):
+		"""Start a VMHandler for the job item ``data``. A slot in
+		``self._max_vms_lock`` must already be held, it is released if the
+		job cannot be started.
+		"""
 		jobs = slave.models.Job.objects(id=data["job"])
 		if len(jobs) == 0:
 			self._log.warn("received a job that doesn't exist???")
@@ -462,9 +509,23 @@ class Slave(threading.Thread):
 			return
 
 		job_obj = jobs[0]
-		if job_obj.status["name"] != "running":
+		# probe items check whether a paused job works again
+		runnable = (job_obj.status["name"] == "running" or (job_obj.status["name"] == "paused" and data.get("probe", False)))
+		if not runnable:
 			self._log.warn("job's state is not 'running', so not running it (was {})".format(job_obj.status["name"]))
 			self._max_vms_lock.release()
+
+			# let the master return the item to the job's pool
+			self._amqp_man.queue_msg(
+				JobFinished(
+					job			= data["job"],
+					idx			= data["idx"],
+					attempt		= data.get("attempt", 1),
+					started		= False,
+					skipped		= True,
+				),
+				self.AMQP_JOB_STATUS_QUEUE
+			)
 			return
 
 		# wait until the last vm started to start the next vm
@@ -477,6 +538,7 @@ class Slave(threading.Thread):
 			handler = VMHandler(
 				job					= data["job"],
 				idx					= data["idx"],
+				attempt				= data.get("attempt", 1),
 				debug				= data["debug"],
 				image				= data["image"],
 				image_username		= data["image_username"],
@@ -507,6 +569,75 @@ class Slave(threading.Thread):
 
 		self._update_status()
 		self._log.debug("done starting VMHandler")
+
+	def _handle_job_granted(self, data):
+		"""Handle a job item the master published directly to this slave in
+		response to a credit message
+		"""
+		self._log.info("received granted job: {}".format(data))
+
+		with self._credit_lock:
+			self._reserved_slots += 1
+		self._granted_jobs.put(data)
+
+	def _do_start_granted_jobs(self):
+		"""Start granted jobs one at a time, off of the amqp consumer thread so
+		config and cancel messages are not held up by booting VMs
+		"""
+		while self._running.is_set():
+			data = self._granted_jobs.get()
+
+			self._max_vms_lock.acquire()
+			if not self._libvirtd_can_be_used.is_set():
+				self._log.debug("waiting for libvirtd to restart before starting any new VMs")
+			self._libvirtd_can_be_used.wait(2**31)
+
+			try:
+				self._start_job(data)
+			finally:
+				with self._credit_lock:
+					self._reserved_slots -= 1
+
+	def _handle_credit_ack(self, data):
+		"""Handle the master's response to a credit message, sent after all
+		of the granted jobs
+		"""
+		with self._credit_lock:
+			self._credit_pending = False
+
+		# if nothing was granted, the periodic status update will try again
+		if data.get("granted", 0) > 0:
+			self._send_credit()
+
+	def _send_credit(self):
+		"""Advertise the free VM slots and the locally cached images to the
+		master when in credit dispatch mode. Only one credit message is
+		outstanding at a time.
+		"""
+		if self._dispatch != self.DISPATCH_CREDIT:
+			return
+
+		# don't take on more work while a VM is still booting
+		if not self._last_vm_started_evt.is_set():
+			return
+
+		with self._credit_lock:
+			if self._credit_pending and time.time() - self._credit_sent_time < self._credit_timeout:
+				return
+			slots = self._max_vms - len(self._handlers) - self._reserved_slots
+			if slots <= 0:
+				return
+			self._credit_pending = True
+			self._credit_sent_time = time.time()
+
+		self._amqp_man.queue_msg(
+			SlaveCredit(
+				uuid		= self._uuid,
+				slots		= slots,
+				images		= self._image_man.cached_images(),
+			),
+			self.AMQP_SLAVE_STATUS_QUEUE
+		)
 	
 	def _get_next_vnc(self):
 		return self._vnc_ports.get()
@@ -529,14 +660,39 @@ class Slave(threading.Thread):
 
 		# it never reported progress for some reason, so let's report a progress of 1
 		# for just having run the VM (1 vm == 1 progress. ALWAYS!)
-		if handler.total_progress == 0 and handler._received_started_msg:
+		# a cancelled copy of a re-dispatched item lost to another copy, which
+		# reports the progress
+		if handler.total_progress == 0 and handler._received_started_msg and not handler.cancelled:
 			self._log.info("job handler exited without reporting any progress, reporting 1 progress")
 			self._handle_job_progress({
-				"job"	: handler.job,
-				"idx"	: handler.idx,
-				"data"	: 1
+				"job"		: handler.job,
+				"idx"		: handler.idx,
+				"attempt"	: handler.attempt,
+				"data"		: 1
 			})
 
+		run_time = None
+		if handler.tool_start_time is not None:
+			run_time = time.time() - handler.tool_start_time
+
+		# confirmed, the master's accounting of the item depends on this
+		unsent = self._amqp_man.queue_msgs([
+			JobFinished(
+				job			= handler.job,
+				idx			= handler.idx,
+				attempt		= handler.attempt,
+				started		= handler._received_started_msg,
+				preempted	= handler.preempted,
+				tool		= handler.tool,
+				image		= handler.image,
+				boot_time	= handler.boot_time,
+				run_time	= run_time,
+			)],
+			self.AMQP_JOB_STATUS_QUEUE
+		)
+		if len(unsent) > 0:
+			self._log.error("could not report that job {}:{} finished".format(handler.job, handler.idx))
+
 		# vm died, never received started message, so don't block anymore
 		if not handler._received_started_msg:
 			self._last_vm_started_evt.set()
@@ -557,8 +713,18 @@ class Slave(threading.Thread):
 
 		self._mac_addrs.put(handler.mac)
 		self._vnc_ports.put(handler.vnc_port)
-		self._max_vms_lock.release()
+
+		if handler.successor is not None:
+			# the preempting job item takes over the slot
+			with self._credit_lock:
+				self._reserved_slots += 1
+			thread = threading.Thread(target=self._start_successor, args=(handler.successor,))
+			thread.daemon = True
+			thread.start()
+		else:
+			self._max_vms_lock.release()
 		self._update_status()
+		self._send_credit()
 	
 	def _on_vm_handler_vnc_avail(self, handler):
 		"""
@@ -572,7 +738,7 @@ class Slave(threading.Thread):
 		"""
 		self._log.info("received slave all msg from queue: {}".format(body))
 
-		data = json.loads(body)
+		data = slave.codec.decode_props(body, properties)
 
 		if "type" not in data:
 			self._log.warn("all slaves type specifier was not in data: {}".format(data))
@@ -586,11 +752,14 @@ class Slave(threading.Thread):
 		self._log.info("received slave me msg from queue: {}".format(body))
 		self._amqp_man.ack_method(method)
 
-		data = json.loads(body)
+		data = slave.codec.decode_props(body, properties)
 
 		switch = dict(
-			config	= self._handle_config,
-			cancel	= self._handle_job_cancel,
+			config		= self._handle_config,
+			cancel		= self._handle_job_cancel,
+			job			= self._handle_job_granted,
+			credit_ack	= self._handle_credit_ack,
+			preempt		= self._handle_preempt,
 		)
 
 		if "type" not in data or data["type"] not in switch:
@@ -605,8 +774,46 @@ class Slave(threading.Thread):
 			self._log.warn("the job was not specified")
 			return
 
-		self.cancel_job(data["job"])
+		self.cancel_job(data["job"], data.get("idx"), data.get("keep_attempt"))
 	
+	def _handle_preempt(self, data):
+		"""Stop a running VM to make room for a higher priority job item. The
+		stopped item does not report any progress, the master returns it to
+		its job's pool.
+
+		:data: The preempt message, with the ``job``, ``idx`` and ``attempt`` of
+			the VM to stop and the job item to start instead as ``next``
+		"""
+		self._log.info("handling preemption: {}".format(data))
+
+		found_handler = None
+		with self._handlers_lock:
+			for handler in self._handlers:
+				if handler.job == data["job"] and handler.idx == data["idx"] and handler.attempt == data.get("attempt", 1):
+					found_handler = handler
+					break
+
+			if found_handler is not None and not found_handler.preempted:
+				found_handler.preempted = True
+				found_handler.cancelled = True
+				found_handler.successor = data.get("next")
+				found_handler.stop()
+				return
+
+		# it already finished, start the next item whenever a slot frees up
+		self._log.warn("could not find handler for job {}:{} to preempt".format(data["job"], data["idx"]))
+		if data.get("next") is not None:
+			self._handle_job_granted(data["next"])
+
+	def _start_successor(self, data):
+		"""Start the job item that preempted a VM, in the VM's slot
+		"""
+		try:
+			self._start_job(data)
+		finally:
+			with self._credit_lock:
+				self._reserved_slots -= 1
+
 	def _handle_config(self, data):
 		self._log.info("handling config: {}".format(data))
 
@@ -626,8 +833,24 @@ class Slave(threading.Thread):
 			self._image_url = data["image_url"]
 			self._image_man.instance().image_url = self._image_url
 
-		if not self._already_consuming:
-			self._amqp_man.consume_queue(self.AMQP_JOB_QUEUE, self._on_job_received)
+		if "codecs" in data:
+			codec = slave.codec.choose(data["codecs"])
+			self._log.info("sending messages with the {} codec".format(codec))
+			self._amqp_man.set_codec(codec)
+
+		if "dispatch" in data:
+			self._log.info("setting dispatch mode to {}".format(data["dispatch"]))
+			self._dispatch = data["dispatch"]
+
+		if self._dispatch == self.DISPATCH_CREDIT:
+			self._send_credit()
+
+		elif not self._already_consuming:
+			# items are only acked once a VM slot is free for them, so the one
+			# unacked item is the next to start. Starting VMs is serialized
+			# anyway, and prefetching more would hoard items other slaves could
+			# start now
+			self._amqp_man.consume_queue(self.AMQP_JOB_QUEUE, self._on_job_received, prefetch=1)
 			self._already_consuming = True
 	
 	# -----------------------
@@ -635,6 +858,7 @@ class Slave(threading.Thread):
 	def _do_update_status(self):
 		while self._running.is_set():
 			self._update_status()
+			self._send_credit()
 			time.sleep(5)
 
 	def _update_status(self):
@@ -643,22 +867,25 @@ class Slave(threading.Thread):
 			vm_infos.append(dict(
 				job			= handler.job,
 				idx			= handler.idx,
+				attempt		= handler.attempt,
 				vnc_port	= handler.vnc_port,
 				tool		= handler.tool,
 				start_time	= handler.start_time,
 				vm_status	= handler.vm_status,
 			))
 
-		self._amqp_man.queue_msg(
-			json.dumps(dict(
-				type			= "status",
+		unsent = self._amqp_man.queue_msgs([
+			SlaveStatus(
 				uuid			= self._uuid,
 				running_vms		= len(self._handlers),
 				total_jobs_run	= self._total_jobs_run,
-				vms				= vm_infos
-			)),
+				vms				= vm_infos,
+				amqp			= self._amqp_man.channel_stats(),
+			)],
 			self.AMQP_SLAVE_STATUS_QUEUE
 		)
+		if len(unsent) > 0:
+			self._log.warn("could not send status update, will send another soon")
 
 def main(amqp_host, max_vms, intf):
 	#_install_sig_handlers()
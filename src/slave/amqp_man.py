@@ -6,58 +6,106 @@ import os
 import threading
 import time
 import pika
+from pika.adapters import twisted_connection
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.python import threadable
+
+from slave.codec import Codec
 
 pika_logger = logging.getLogger('pika')
 pika_logger.setLevel(logging.CRITICAL)
 
-class AmqpQueueHandler(threading.Thread):
-	daemon = True
+class ChannelStats(object):
+	"""Counts the operations done on a channel and how long they took
+	"""
 
-	def __init__(self, callback, queue_name, channel, lock, no_ack, running):
-		super(AmqpQueueHandler, self).__init__()
+	def __init__(self):
+		self._ops = 0
+		self._total = 0.0
+		self._peak = 0.0
+		self._lock = threading.Lock()
 
-		self.lock = lock
-		self.channel = channel
-		self.queue_name = queue_name
+	def add(self, elapsed):
+		"""Record an operation that took ``elapsed`` seconds
+		"""
+		with self._lock:
+			self._ops += 1
+			self._total += elapsed
+			self._peak = max(self._peak, elapsed)
+
+	def summary(self):
+		"""Return ``{"ops": N, "mean_ms": .., "max_ms": ..}``, the max being
+		since the last call
+		"""
+		with self._lock:
+			res = dict(
+				ops		= self._ops,
+				mean_ms	= (self._total / self._ops * 1000) if self._ops > 0 else None,
+				max_ms	= self._peak * 1000,
+			)
+			self._peak = 0.0
+		return res
+
+class AmqpConsumer(object):
+	"""Consumes from ``queue_name`` on the reactor. The callbacks may block
+	(e.g. waiting for a free VM slot), so each one is run in the reactor's
+	thread pool, one message at a time so that the queue's messages are
+	handled in order.
+	"""
+
+	def __init__(self, callback, queue_name, no_ack, prefetch, stats):
 		self.callback = callback
+		self.queue_name = queue_name
 		self.no_ack = no_ack
-		self._running = running
+		self.prefetch = prefetch
+		self.stats = stats
 
 		self._log = logging.getLogger("AmqpMan").getChild(self.queue_name)
-	
-	def run(self):
-		self._running.set()
+
+	@defer.inlineCallbacks
+	def start(self, channel):
+		"""Start consuming on ``channel``, must be called on the reactor
+		"""
+		if self.prefetch is not None and not self.no_ack:
+			# applies to consumers started after it on the channel
+			yield channel.basic_qos(prefetch_count=self.prefetch)
+		queue, consumer_tag = yield channel.basic_consume(queue=self.queue_name, no_ack=self.no_ack)
 		self._log.debug("monitoring")
+		self._consume(channel, queue)
+
+	@defer.inlineCallbacks
+	def _consume(self, channel, queue):
+		while True:
+			try:
+				ch, method, props, body = yield queue.get()
+			except Exception:
+				# the channel was closed
+				break
 
-		while self._running.is_set():
-			method = None
-			with self.lock:
-				try:
-					method, props, body = self.channel.basic_get(
-						self.queue_name,
-						no_ack=self.no_ack
-					)
-				except:
-					pass
-			if method is None:
-				time.sleep(0.1)
-				continue
 			self._log.debug("recieved message")
-			self.callback(self.channel, method, props, body)
+			start = time.time()
+			try:
+				yield threads.deferToThread(self.callback, channel, method, props, body)
+			except Exception:
+				self._log.exception("error handling message")
+			self.stats.add(time.time() - start)
 
 		self._log.debug("finished")
-	
-	def stop(self):
-		self._log.debug("stopping")
-		self._running.clear()
 
-class AmqpManager(threading.Thread):
-	"""A class to manage jobs (starting/stopping/cancelling/etc)"""
+class AmqpManager(object):
+	"""Talks to the broker from the Twisted reactor, which the slave already
+	runs for guest comms. All channel operations happen on the reactor thread.
+	Other threads hand them over with ``callFromThread``, and only wait for
+	them (``blockingCallFromThread``) when they need a result.
+	"""
 
-	daemon = True
 	AMQP_JOB_QUEUE = "jobs"
 	AMQP_JOB_RESULT_QUEUE = "job_results"
 
+	# how many times to try publishing messages that were not confirmed, see
+	# queue_msgs
+	CONFIRM_RETRIES = 3
+
 	_INSTANCE = None
 	@classmethod
 	def instance(cls, host=None):
@@ -65,21 +113,43 @@ class AmqpManager(threading.Thread):
 			cls._INSTANCE = cls(host)
 		return cls._INSTANCE
 
-	def __init__(self, host=None):
+	def __init__(self, host=None, prefetch=100, confirm_window=100):
 		"""init the job manager
+
+		:param int prefetch: The default number of unacked messages the broker
+			may push to each consumer
+		:param int confirm_window: The most messages ``queue_msgs`` publishes
+			before waiting for the broker to confirm them
 		"""
 		super(AmqpManager, self).__init__()
 
 		if host is None and "TALUS_AMQP_PORT_5672_TCP" in os.environ:
 			host = os.environ["TALUS_AMQP_PORT_5672_TCP"].replace("tcp://", "")
 		self._amqp_host = host
+		self._prefetch = prefetch
+		self._confirm_window = confirm_window
 
 		self._amqp_conn = None
+		# used for declaring, consuming and acking
 		self._amqp_channel = None
+		# in confirm mode, all messages are published on it so that they reach
+		# the broker in the order they were queued (e.g. a job item's error
+		# before the item is finished)
+		self._confirm_channel = None
+		# the delivery tag of the last message published on the confirm channel
+		self._confirm_tag = 0
+		# dict of {<delivery tag>: Deferred} of messages the broker has not
+		# confirmed yet, the Deferreds fire with whether the message was acked
+		self._unconfirmed = {}
+
+		# dict of {<channel name>: ChannelStats}
+		self._stats = {
+			"amqp"		: ChannelStats(),
+			"confirm"	: ChannelStats(),
+		}
 
 		self._running = threading.Event()
 		self._amqp_connected = threading.Event()
-		self._amqp_consume_thread = None
 		self._log = logging.getLogger("AmqpMan")
 
 		self._cached_exchange_declares = []
@@ -90,54 +160,25 @@ class AmqpManager(threading.Thread):
 		self._queue_props = {}
 		self._queue_handlers = {}
 
-		self._amqp_lock = threading.Lock()
-		self._handlers_lock = threading.Lock()
-	
+		# encodes dict messages, see set_codec
+		self._codec = Codec()
+
 	def do_start(self):
 		if self._running.is_set():
 			return
-		self.start()
-	
-	def run(self):
-		"""Run the job manager. Only one of these should ever be running at a time
-		:returns: TODO
-
-		"""
-		self._log.info("running")
 		self._running.set()
+		self._call(self._amqp_connect)
 
-		self._amqp_connect()
-
-		for exchange_name, type in self._cached_exchange_declares:
-			self.declare_exchange(exchange_name, type)
-		for queue_name, props in self._cached_queue_declares:
-			self.declare_queue(queue_name, **props)
-		for exchange_name, queue in self._cached_bind_queues:
-			self.bind_queue(exchange_name, queue)
-		for queue_name, callback, no_ack in self._cached_queue_consumes:
-			self.consume_queue(queue_name, callback, no_ack=no_ack)
-
-		self._amqp_ioloop()
-
-		self._log.info("finished")
-	
 	def stop(self):
 		"""Stop the job manager
 		:returns: TODO
 
 		"""
 		self._log.info("stopping")
-		if self._amqp_channel is not None:
-			try:
-				self._amqp_channel.stop_consuming()
-			except RuntimeError as e:
-				pass
-			try:
-				self._amqp_conn.close()
-			except RuntimeError as e:
-				pass
 		self._running.clear()
-		
+		if self._amqp_conn is not None:
+			self._call(self._amqp_conn.close)
+
 	def get_message_count(self, queue_name, **props):
 		""" Get the size of the amqp queue ``queue_name``. Note that the ``props``
 		kwargs must match the declaration properties of the queue. Getting the
@@ -149,11 +190,10 @@ class AmqpManager(threading.Thread):
 		if len(props) is None and queue_name in self._queue_props:
 			props = self._queue_props[queue_name]
 
-		with self._amqp_lock:
-			method = self._amqp_channel.queue_declare(queue_name, passive=True, **props)
+		method = self._blocking(self._amqp_channel.queue_declare, queue=queue_name, passive=True, **props)
 		res = method.method.message_count
 		return res
-	
+
 	def declare_exchange(self, name, type):
 		"""Declare an exchange named ``name`` and of type ``type``
 		"""
@@ -161,11 +201,11 @@ class AmqpManager(threading.Thread):
 		if self._amqp_channel is None:
 			self._cached_exchange_declares.append((name, type))
 		else:
-			self._amqp_channel.exchange_declare(
+			self._blocking(self._amqp_channel.exchange_declare,
 				exchange=name,
 				type=type
 			)
-	
+
 	def bind_queue(self, exchange, queue):
 		"""Bind the queue ``queue`` to the exchange ``exchange``
 		"""
@@ -173,10 +213,10 @@ class AmqpManager(threading.Thread):
 		if self._amqp_channel is None:
 			self._cached_bind_queues.append((exchange, queue))
 		else:
-			self._amqp_channel.queue_bind( exchange=exchange,
+			self._blocking(self._amqp_channel.queue_bind, exchange=exchange,
 				queue=queue
 			)
-	
+
 	def declare_queue(self, queue_name, **props):
 		"""Declare the queue ``queue_name`` with properties defined in
 		``**props`` kwargs. Popular properties to set:
@@ -191,44 +231,47 @@ class AmqpManager(threading.Thread):
 		if self._amqp_channel is None:
 			self._cached_queue_declares.append((queue_name, props))
 		else:
-			self._amqp_channel.queue_declare(
-				queue_name,
+			self._blocking(self._amqp_channel.queue_declare,
+				queue=queue_name,
 				**props
 			)
-	
-	def consume_queue(self, queue_name, callback, no_ack=False):
-		"""Consume from the queue ``queue_name`` with callback ``callback``
+
+	def consume_queue(self, queue_name, callback, no_ack=False, prefetch=None):
+		"""Consume from the queue ``queue_name`` with callback ``callback``.
+		Messages are pushed by the broker (``basic_consume``), at most ``prefetch``
+		unacked ones at a time. The callback is run in the reactor's thread pool.
+
+		:param int prefetch: The most unacked messages to have pushed to the
+			consumer, defaults to the manager's ``prefetch``
 		"""
 		self._log.info("will consume from queue {}".format(queue_name))
 
+		if prefetch is None:
+			prefetch = self._prefetch
+
 		if self._amqp_channel is None:
-			self._cached_queue_consumes.append((queue_name, callback, no_ack))
+			self._cached_queue_consumes.append((queue_name, callback, no_ack, prefetch))
 		else:
-			with self._handlers_lock:
-				handler = AmqpQueueHandler(
-					callback,
-					queue_name,
-					self._amqp_channel,
-					self._amqp_lock,
-					no_ack,
-					self._running
-				)
-				self._queue_handlers[queue_name] = handler
-				handler.start()
-	
+			stats = ChannelStats()
+			self._stats["consume:" + queue_name] = stats
+			consumer = AmqpConsumer(callback, queue_name, no_ack, prefetch, stats)
+			self._queue_handlers[queue_name] = consumer
+			self._call(consumer.start, self._amqp_channel)
+
 	def wait_for_ready(self, timeout=2**31):
 		"""Wait until the AMQP manager is connected and ready to go
 		"""
 		self._log.info("waiting until connected")
 		self._amqp_connected.wait(timeout)
-		# stupid, not sure if neccessary
-		time.sleep(3)
 		self._log.info("connected!")
-	
+
 	def queue_msg(self, msg, queue_name, **props):
-		"""Queue the message ``msg`` in  the queue ``queue_name``
+		"""Queue the message ``msg`` in  the queue ``queue_name``. This does not
+		wait for the message to be published or confirmed, but it is published
+		on the same channel as (and in order with) the messages of ``queue_msgs``.
 
-		:param str msg: The message to send (str or unicode)
+		:param msg: The message to send, a dict (encoded with the current codec)
+			or an already encoded str
 		:param str queue_name: The queue to put the message in
 		:param dict **props: Any additional props (exchange, etc)
 		"""
@@ -236,41 +279,225 @@ class AmqpManager(threading.Thread):
 			exchange	= ""
 		)
 		default_props.update(props)
-		with self._amqp_lock:
-			self._amqp_channel.basic_publish(
-				routing_key=queue_name,
-				body=msg,
-				**default_props
-			)
-	
+		self._call(self._publish, time.time(), msg, queue_name, default_props)
+
+	def queue_msgs(self, msgs, queue_name, **props):
+		"""Queue all of the messages in ``msgs`` in the queue ``queue_name`` and
+		wait until the broker has confirmed them. The messages are published
+		``confirm_window`` at a time without waiting, then the publisher confirms
+		of the window are waited for. Messages the broker nacked are published
+		again, up to ``CONFIRM_RETRIES`` times.
+
+		The reactor must not be blocked, so on the reactor thread the messages
+		are published without waiting for confirms.
+
+		:param list msgs: The messages to send (dicts or encoded strs, see ``queue_msg``)
+		:param str queue_name: The queue to put the messages in
+		:param dict **props: Any additional props (exchange, etc)
+		:returns: The messages that could not be confirmed, an empty list if all were
+		"""
+		if len(msgs) == 0:
+			return []
+
+		default_props = dict(
+			exchange	= ""
+		)
+		default_props.update(props)
+
+		if threadable.isInIOThread():
+			for msg in msgs:
+				self._publish(time.time(), msg, queue_name, default_props)
+			return []
+
+		return self._blocking(self._publish_confirmed, msgs, queue_name, default_props)
+
+	def set_codec(self, name):
+		"""Encode dict messages with the codec ``name`` from now on, see
+		``codec.choose``
+		"""
+		self._codec = Codec(name)
+
 	def ack_method(self, method):
 		"""basic_ack the method
 
 		:method: The method to ack
 		"""
-		with self._amqp_lock:
-			self._amqp_channel.basic_ack(delivery_tag=method.delivery_tag)
-	
+		self._call(self._amqp_channel.basic_ack, delivery_tag=method.delivery_tag)
+
+	def channel_stats(self):
+		"""Return ``{<channel name>: {"ops": N, "mean_ms": .., "max_ms": ..}}``.
+		For the ``amqp`` channel the latency is how long operations waited to
+		reach the reactor, for the ``confirm`` channel how long windows took to
+		be confirmed, and for ``consume:<queue>`` how long messages took to be
+		handled.
+		"""
+		return dict((name, stats.summary()) for name,stats in self._stats.items())
+
 	# ---------------------------------------
 	# amqp related
 	# ---------------------------------------
-	
-	def _amqp_ioloop(self):
+
+	def _call(self, fn, *args, **kwargs):
+		"""Run ``fn`` on the reactor without waiting for it
+		"""
+		if threadable.isInIOThread():
+			fn(*args, **kwargs)
+		else:
+			reactor.callFromThread(fn, *args, **kwargs)
+
+	def _blocking(self, fn, *args, **kwargs):
+		"""Run ``fn`` on the reactor and wait for its result (which may be a
+		Deferred). Must not be called on the reactor thread.
+		"""
+		start = time.time()
+		try:
+			return threads.blockingCallFromThread(reactor, fn, *args, **kwargs)
+		finally:
+			self._stats["amqp"].add(time.time() - start)
+
+	def _publish(self, queued_time, msg, queue_name, props):
+		"""Publish ``msg`` on the confirm channel without waiting for it to be
+		confirmed
+		"""
+		self._stats["amqp"].add(time.time() - queued_time)
+		res = self._publish_one(msg, queue_name, props)
+		res.addCallback(self._on_unwaited_confirm, queue_name)
+
+	def _on_unwaited_confirm(self, acked, queue_name):
+		if not acked:
+			self._log.warn("a message to {!r} was not confirmed".format(queue_name))
+
+	@defer.inlineCallbacks
+	def _publish_confirmed(self, msgs, queue_name, props):
+		"""Publish ``msgs`` on the confirm channel, ``confirm_window`` at a time.
+		Fires with the messages that were not confirmed.
+		"""
+		pending = list(msgs)
+		for attempt in xrange(self.CONFIRM_RETRIES):
+			nacked = []
+			for start in xrange(0, len(pending), self._confirm_window):
+				window = pending[start:start + self._confirm_window]
+				start_time = time.time()
+				try:
+					confirms = [self._publish_one(msg, queue_name, props) for msg in window]
+				except Exception as e:
+					self._log.error("could not publish to {!r}: {}".format(queue_name, e))
+					defer.returnValue(pending[start:] + nacked)
+				results = yield defer.DeferredList(confirms)
+				self._stats["confirm"].add(time.time() - start_time)
+				nacked += [msg for msg,(success,acked) in zip(window, results) if not (success and acked)]
+
+			pending = nacked
+			if len(pending) == 0:
+				break
+			self._log.warn("{} messages to {!r} were not confirmed (attempt {})".format(len(pending), queue_name, attempt + 1))
+
+		defer.returnValue(pending)
+
+	def _encode(self, msg):
+		"""Return the body and BasicProperties (None for str messages) to
+		publish ``msg`` with
+		"""
+		if not isinstance(msg, dict):
+			return msg, None
+		body,props = self._codec.encode(msg)
+		return body, pika.BasicProperties(**props)
+
+	def _publish_one(self, msg, queue_name, props):
+		"""Publish ``msg`` on the confirm channel, returning a Deferred that fires
+		with whether the broker acked it
+		"""
+		if self._confirm_channel is None:
+			return defer.succeed(False)
+
+		body,properties = self._encode(msg)
+		self._confirm_channel.basic_publish(
+			routing_key=queue_name,
+			body=body,
+			properties=properties,
+			**props
+		)
+		self._confirm_tag += 1
+		res = defer.Deferred()
+		self._unconfirmed[self._confirm_tag] = res
+		return res
+
+	def _on_confirm(self, frame):
+		"""Called with the broker's Basic.Ack or Basic.Nack of messages on the
+		confirm channel
 		"""
+		acked = isinstance(frame.method, pika.spec.Basic.Ack)
+		tag = frame.method.delivery_tag
+		if frame.method.multiple:
+			tags = [unconfirmed_tag for unconfirmed_tag in self._unconfirmed if unconfirmed_tag <= tag]
+		else:
+			tags = [tag]
+
+		for unconfirmed_tag in tags:
+			res = self._unconfirmed.pop(unconfirmed_tag, None)
+			if res is not None:
+				res.callback(acked)
+
+	def _on_confirm_channel_closed(self, *args):
+		"""Nothing will be confirmed anymore, fail the waiting messages and
+		open a new confirm channel
+		"""
+		self._log.warn("confirm channel was closed")
+		self._confirm_channel = None
+		unconfirmed = self._unconfirmed
+		self._unconfirmed = {}
+		for res in unconfirmed.values():
+			res.callback(False)
+
+		if self._running.is_set():
+			self._open_confirm_channel()
+
+	@defer.inlineCallbacks
+	def _open_confirm_channel(self):
+		"""Open the confirm channel and put it in confirm mode
 		"""
-		while self._running.is_set():
-			time.sleep(0.1)
+		try:
+			channel = yield self._amqp_conn.channel()
+		except Exception as e:
+			self._log.error("could not open the confirm channel: {}".format(e))
+			return
 
+		channel.add_on_close_callback(self._on_confirm_channel_closed)
+		channel.confirm_delivery(self._on_confirm)
+		# delivery tags start over on each channel
+		self._confirm_tag = 0
+		self._confirm_channel = channel
+
+	@defer.inlineCallbacks
 	def _amqp_connect(self):
 		"""
 		"""
 		self._log.info("connecting to amqp: {}".format(self._amqp_host))
-		self._amqp_conn = pika.BlockingConnection(pika.URLParameters("amqp://guest:guest@" + self._amqp_host))
-		self._amqp_channel = self._amqp_conn.channel()
+		params = pika.URLParameters("amqp://guest:guest@" + self._amqp_host)
+		try:
+			self._amqp_conn = yield protocol.ClientCreator(
+				reactor,
+				twisted_connection.TwistedProtocolConnection,
+				params
+			).connectTCP(params.host, params.port)
+			yield self._amqp_conn.ready
+
+			amqp_channel = yield self._amqp_conn.channel()
+			yield self._open_confirm_channel()
+		except Exception as e:
+			self._log.error("could not connect to amqp: {}".format(e))
+			return
+
+		for exchange_name, type in self._cached_exchange_declares:
+			yield amqp_channel.exchange_declare(exchange=exchange_name, type=type)
+		for queue_name, props in self._cached_queue_declares:
+			yield amqp_channel.queue_declare(queue=queue_name, **props)
+		for exchange_name, queue in self._cached_bind_queues:
+			yield amqp_channel.queue_bind(exchange=exchange_name, queue=queue)
+
+		# from here on the public methods use the channel directly
+		self._amqp_channel = amqp_channel
+		for queue_name, callback, no_ack, prefetch in self._cached_queue_consumes:
+			self.consume_queue(queue_name, callback, no_ack=no_ack, prefetch=prefetch)
 
 		self._amqp_connected.set()
-	
-	def _job_queue(self, channel, method, properties, body):
-		"""Called when an AMQP message is received
-		"""
-		print("received {}".format(body))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The encoding of the messages sent between the master and the slaves. Messages
+are dicts with a ``type``, encoded with msgpack (if it is installed) or JSON
+and compressed with zlib when they are large. The encoding is named in the
+AMQP ``content_type``/``content_encoding`` properties, so a message is always
+decoded the way it was encoded, and messages without them are plain JSON (as
+sent by older masters and slaves).
+
+Which codec a slave sends with is negotiated: the slave lists its codecs in
+its ``new`` message and the master lists its own in the ``config`` reply, see
+:func:`choose`.
+"""
+
+import json
+import zlib
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+VERSION = 1
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/x-msgpack"
+CONTENT_ENCODING_ZLIB = "zlib"
+
+# most preferred first
+_CONTENT_TYPES = {
+	"msgpack"	: CONTENT_TYPE_MSGPACK,
+	"json"		: CONTENT_TYPE_JSON,
+}
+
+class CodecError(Exception):
+	pass
+
+def available_codecs():
+	"""Return the names of the codecs that can be used here, most preferred
+	first
+	"""
+	res = []
+	if msgpack is not None:
+		res.append("msgpack")
+	res.append("json")
+	return res
+
+def choose(remote_codecs):
+	"""Return the most preferred codec that is available here and in
+	``remote_codecs``, falling back to ``json``
+	"""
+	for name in available_codecs():
+		if name in remote_codecs:
+			return name
+	return "json"
+
+# ---------------------------------------
+# typed messages
+# ---------------------------------------
+
+_MESSAGE_TYPES = {}
+
+def _register(cls):
+	_MESSAGE_TYPES[cls.TYPE] = cls
+	return cls
+
+class Message(dict):
+	"""A message of type ``TYPE``, which must have all of the ``FIELDS``.
+	Messages are dicts, so handlers read them like any other message data.
+	"""
+
+	TYPE = None
+	FIELDS = []
+
+	def __init__(self, **fields):
+		super(Message, self).__init__(**fields)
+		self["type"] = self.TYPE
+		self.validate()
+
+	def validate(self):
+		missing = [field for field in self.FIELDS if field not in self]
+		if len(missing) > 0:
+			raise CodecError("{} message is missing {}".format(self.TYPE, ", ".join(missing)))
+
+	@classmethod
+	def from_dict(cls, data):
+		"""Return ``data`` as an instance of its type's Message class, or as is
+		if the type has no class
+		"""
+		msg_cls = _MESSAGE_TYPES.get(data.get("type"))
+		if msg_cls is None:
+			return data
+		return msg_cls(**data)
+
+@_register
+class SlaveNew(Message):
+	TYPE = "new"
+	FIELDS = ["uuid", "ip", "hostname", "max_vms"]
+
+@_register
+class SlaveStatus(Message):
+	TYPE = "status"
+	FIELDS = ["uuid", "running_vms", "total_jobs_run", "vms"]
+
+@_register
+class SlaveCredit(Message):
+	TYPE = "credit"
+	FIELDS = ["uuid", "slots"]
+
+@_register
+class JobTaken(Message):
+	TYPE = "taken"
+	FIELDS = ["queue", "job", "idx"]
+
+@_register
+class JobProgress(Message):
+	TYPE = "progress"
+	FIELDS = ["job", "idx", "amt"]
+
+@_register
+class JobResult(Message):
+	TYPE = "result"
+	FIELDS = ["job", "idx", "tool", "data"]
+
+@_register
+class JobError(Message):
+	TYPE = "error"
+	FIELDS = ["job", "idx", "tool", "data"]
+
+@_register
+class JobLog(Message):
+	TYPE = "log"
+	FIELDS = ["job", "idx", "tool", "data"]
+
+@_register
+class JobFinished(Message):
+	TYPE = "finished"
+	FIELDS = ["job", "idx", "started"]
+
+# ---------------------------------------
+# encoding
+# ---------------------------------------
+
+class Codec(object):
+	"""Encodes messages with one codec
+	"""
+
+	def __init__(self, name="json", compress_threshold=4096, compress_level=6):
+		"""init the codec
+
+		:param str name: The codec to encode with, one of :func:`available_codecs`
+		:param int compress_threshold: Encoded messages larger than this (in
+			bytes) are compressed
+		:param int compress_level: The zlib compression level
+		"""
+		if name not in available_codecs():
+			raise CodecError("codec {!r} is not available".format(name))
+
+		self.name = name
+		self.content_type = _CONTENT_TYPES[name]
+		self._compress_threshold = compress_threshold
+		self._compress_level = compress_level
+
+	def encode(self, data):
+		"""Encode the message ``data``
+
+		:returns: A tuple of ``(<body>, <properties dict>)``, the properties are
+			the ``content_type``, ``content_encoding`` and ``headers`` to publish
+			the body with
+		"""
+		data = dict(data)
+		if self.name == "msgpack":
+			body = msgpack.packb(data)
+		else:
+			body = json.dumps(data)
+
+		props = dict(
+			content_type	= self.content_type,
+			headers			= {"version": VERSION},
+		)
+		if len(body) > self._compress_threshold:
+			body = zlib.compress(body, self._compress_level)
+			props["content_encoding"] = CONTENT_ENCODING_ZLIB
+
+		return body, props
+
+def decode(body, content_type=None, content_encoding=None):
+	"""Decode a message that was encoded by a :class:`Codec` (or is plain
+	JSON if ``content_type`` is None)
+	"""
+	if content_encoding == CONTENT_ENCODING_ZLIB:
+		body = zlib.decompress(body)
+	elif content_encoding is not None:
+		raise CodecError("unknown content encoding {!r}".format(content_encoding))
+
+	if content_type is None or content_type == CONTENT_TYPE_JSON:
+		return json.loads(body)
+	if content_type == CONTENT_TYPE_MSGPACK:
+		if msgpack is None:
+			raise CodecError("received a msgpack message, but msgpack is not installed")
+		return msgpack.unpackb(body)
+	raise CodecError("unknown content type {!r}".format(content_type))
+
+def decode_props(body, props):
+	"""Decode a message received with the AMQP properties ``props``. Messages
+	without a version are from older masters and slaves and are decoded as
+	version 1, messages from a newer version are rejected.
+	"""
+	headers = getattr(props, "headers", None) or {}
+	version = headers.get("version", 1)
+	if not isinstance(version, (int, long)) or not 1 <= version <= VERSION:
+		raise CodecError("unsupported message version {!r}, at most {} is supported".format(version, VERSION))
+
+	return decode(
+		body,
+		getattr(props, "content_type", None),
+		getattr(props, "content_encoding", None)
+	)
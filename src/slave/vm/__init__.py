@@ -112,6 +112,16 @@ class ImageManager(object):
 
 		return output
 	
+	def cached_images(self):
+		"""Return a list of the ids of all images that already exist in LIBVIRT_BASE
+		"""
+		suffix = image_id_to_volume("")
+		res = []
+		for filename in os.listdir(LIBVIRT_BASE):
+			if filename.endswith(suffix):
+				res.append(filename[:-len(suffix)])
+		return res
+	
 	def download_image(self, image_id):
 		"""Download the image from the image_url"""
 		downloading_already = False
@@ -182,18 +192,21 @@ class ImageManager(object):
 		return True
 
 class VMHandler(threading.Thread):
-	def __init__(self, job, idx, image, image_username, image_password, os_type, tool, params, code_loc, code_username, code_password, fileset, db_host, timeout=1800, network="whitelist", on_finished=None, on_vnc_available=None, startup_timeout=120, debug=False, cpus=1, ram=int(1024*3), libvirt_conn=None, mac=None, vnc_port=None):
+	def __init__(self, job, idx, image, image_username, image_password, os_type, tool, params, code_loc, code_username, code_password, fileset, db_host, timeout=1800, network="whitelist", on_finished=None, on_vnc_available=None, startup_timeout=120, debug=False, cpus=1, ram=int(1024*3), libvirt_conn=None, mac=None, vnc_port=None, attempt=1):
 		"""Start up the VM image ``image`` in libvirt, with a timeout of ``timeout``,
 		and params ``params, using network ``network``.
 
 		:image: The name of the image
 		:params: Params that specify what to run inside of the VM
 		:timeout: The timeout for the vm
+		:attempt: Which copy of the job item this is, the master may re-dispatch
+			straggling items
 		"""
 		super(VMHandler, self).__init__()
 
 		self.job = job
 		self.idx = idx
+		self.attempt = attempt
 		self.debug = debug
 		self.image = image
 		self.image_username = image_username
@@ -220,6 +233,12 @@ class VMHandler(threading.Thread):
 		self._opened_libvirt = False
 
 		self.total_progress = 0
+		# set when the master cancels this VM, no progress should be reported for it
+		self.cancelled = False
+		# set when the master stops this VM to make room for a higher priority
+		# job item, ``successor``, which takes over the VM's slot
+		self.preempted = False
+		self.successor = None
 
 		# network can be 'all' or 'whitelist'
 		# whitelist values can also be followed by a semicolon
@@ -247,10 +266,16 @@ class VMHandler(threading.Thread):
 		self._ip = None
 		self._vm_killed = False
 		self._received_started_msg = False
+		# how long the VM took to boot until the tool started, and when the
+		# tool started running
+		self.boot_time = None
+		self.tool_start_time = None
 	
 	def on_received_started(self):
 		self.vm_status = "running tool"
 		self._received_started_msg = True
+		self.tool_start_time = time.time()
+		self.boot_time = self.tool_start_time - self.start_time
 	
 	# DEAD CODE
 	def unplug_bootstrap_img(self):
@@ -57,10 +57,39 @@ class Job(Document):
 	network		= StringField()
 	debug		= BooleanField(default=False)
 	vm_max		= IntField(default=30*60)
+	# whether the job's VMs may be stopped to make room for higher priority jobs
+	preemptible	= BooleanField(default=True)
+	num_errors	= IntField(default=0)
+	num_logs	= IntField(default=0)
+	# estimated completion time, None if it can't be estimated (yet)
+	eta			= FloatField(null=True)
+	# legacy, errors and logs are now stored as JobLog documents
 	errors		= ListField(EmbeddedDocumentField(JobError))
 	logs		= ListField(EmbeddedDocumentField(JobError))
 	tags		= ListField(StringField())
 
+class JobLog(Document):
+	meta = {
+		"indexes": [
+			{"fields": ["job", "idx"]},
+			{"fields": ["job", "type", "created"]},
+		]
+	}
+
+	job			= ReferenceField("Job", required=True)
+	idx			= IntField()
+	type		= StringField(required=True) # error or log
+	message		= StringField()
+	backtrace	= StringField()
+	logs		= ListField(StringField())
+	created		= DateTimeField(default=datetime.datetime.now)
+
+class ShareWeight(Document):
+	"""The fair-share weight of the group of jobs tagged with ``tag``,
+	relative to the other groups"""
+	tag			= StringField(unique=True)
+	weight		= FloatField(default=1.0)
+
 class FileSet(Document):
 	name		= StringField()
 	files		= ListField()
@@ -100,6 +129,7 @@ class Master(Document):
 	ip				= StringField()
 	vms				= ListField(DictField())
 	queues			= DictField()
+	stats			= DictField()
 
 class Slave(Document):
 	meta = {
@@ -115,4 +145,5 @@ class Slave(Document):
 	running_vms		= IntField(default=0)
 	total_jobs_run	= IntField(default=0)
 	vms				= ListField(DictField())
+	stats			= DictField()
 	timestamps		= DictField()
@@ -1,4 +1,4 @@
-from api.models import Image,OS,Code,Task,Job,Master,Slave,Result,JobError,FileSet
+from api.models import Image,OS,Code,Task,Job,Master,Slave,Result,JobError,JobLog,ShareWeight,FileSet
 from rest_framework_mongoengine.serializers import DocumentSerializer, EmbeddedDocumentSerializer
 
 class ResultSerializer(DocumentSerializer):
@@ -21,6 +21,15 @@ class JobSerializer(DocumentSerializer):
 		model = Job
 		depth = 2
 
+class JobLogSerializer(DocumentSerializer):
+	class Meta:
+		model = JobLog
+		depth = 0
+
+class ShareWeightSerializer(DocumentSerializer):
+	class Meta:
+		model = ShareWeight
+
 class CodeSerializer(DocumentSerializer):
 	class Meta:
 		model = Code
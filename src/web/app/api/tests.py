@@ -1,3 +1,118 @@
-from django.test import TestCase
+from bson import ObjectId
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+import api.views
+from api.models import Image, Job, Task
+
+# run with ``NO_CONNECT=1 python manage.py test api``, the database is
+# replaced by the fakes below
+
+class FakeObjects(object):
+	def __init__(self, docs):
+		self.docs = dict((str(doc.id), doc) for doc in docs)
+
+	def __call__(self, id__in=None):
+		for id_ in id__in:
+			if not ObjectId.is_valid(id_):
+				raise Exception("'{}' is not a valid ObjectId".format(id_))
+		return [self.docs[id_] for id_ in id__in if id_ in self.docs]
+
+class FakeModel(object):
+	def __init__(self, docs):
+		self.objects = FakeObjects(docs)
+
+class FakeJobObjects(object):
+	def __init__(self):
+		self.inserts = []
+
+	def insert(self, jobs, load_bulk=True):
+		self.inserts.append(list(jobs))
+		return [ObjectId() for job in jobs]
+
+class FakeJobModel(object):
+	objects = None
+
+	def __new__(cls, **fields):
+		return Job(**fields)
+
+class JobBulkCreateTests(SimpleTestCase):
+	def setUp(self):
+		self.task = Task(id=ObjectId(), name="task")
+		self.image = Image(id=ObjectId(), name="image")
+		FakeJobModel.objects = FakeJobObjects()
+
+		self._orig = (api.views.Task, api.views.Image, api.views.Job)
+		api.views.Task = FakeModel([self.task])
+		api.views.Image = FakeModel([self.image])
+		api.views.Job = FakeJobModel
+
+		self.view = api.views.JobBulkCreate.as_view()
+
+	def tearDown(self):
+		api.views.Task, api.views.Image, api.views.Job = self._orig
+
+	def _post(self, data):
+		request = APIRequestFactory().post("/api/job/bulk/", data, format="json")
+		return self.view(request)
+
+	def _job(self, **fields):
+		job = dict(task=str(self.task.id), image=str(self.image.id))
+		job.update(fields)
+		return job
+
+	def test_inserts_in_one_batch(self):
+		res = self._post([self._job(name="a"), self._job(name="b", status={"name": "stop"})])
+		self.assertEqual(res.status_code, 200)
+		self.assertEqual(len(res.data["ids"]), 2)
+
+		self.assertEqual(len(FakeJobModel.objects.inserts), 1)
+		jobs = FakeJobModel.objects.inserts[0]
+		self.assertEqual([job.name for job in jobs], ["a", "b"])
+		self.assertEqual(jobs[0].status, {"name": "run"})
+		self.assertEqual(jobs[1].status, {"name": "stop"})
+		self.assertEqual(jobs[0].task, self.task)
+
+	def test_empty_list(self):
+		res = self._post([])
+		self.assertEqual(res.status_code, 200)
+		self.assertEqual(res.data["ids"], [])
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_not_a_list(self):
+		res = self._post(self._job())
+		self.assertEqual(res.status_code, 400)
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_missing_task_or_image(self):
+		job = self._job()
+		del job["image"]
+		res = self._post([self._job(), job])
+		self.assertEqual(res.status_code, 400)
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_invalid_id(self):
+		res = self._post([self._job(task="not an id")])
+		self.assertEqual(res.status_code, 400)
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_unknown_task(self):
+		res = self._post([self._job(), self._job(task=str(ObjectId()))])
+		self.assertEqual(res.status_code, 400)
+		self.assertIn("Job 1", res.data["message"])
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_one_invalid_job_rejects_the_batch(self):
+		# jobs are validated before anything is inserted, so a bad job late in
+		# the batch doesn't leave the jobs before it half-created
+		res = self._post([self._job(name="a"), self._job(name="b"), self._job(priority="high")])
+		self.assertEqual(res.status_code, 400)
+		self.assertIn("Job 2", res.data["message"])
+		self.assertEqual(FakeJobModel.objects.inserts, [])
+
+	def test_unknown_fields_ignored(self):
+		res = self._post([self._job(progress=10, num_errors=3)])
+		self.assertEqual(res.status_code, 200)
+		job = FakeJobModel.objects.inserts[0][0]
+		self.assertEqual(job.progress, 0)
+		self.assertEqual(job.num_errors, 0)
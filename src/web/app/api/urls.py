@@ -28,8 +28,15 @@ urlpatterns = [
 	url(r'^task/(?P<id>' + OBJ_ID + ")/$", views.TaskDetails.as_view()),
 
 	url(r'^job/$', views.JobList.as_view()),
+	url(r'^job/bulk/$', views.JobBulkCreate.as_view()),
 	url(r'^job/(?P<id>' + OBJ_ID + ")/$", views.JobDetails.as_view()),
 
+	url(r'^job_log/$', views.JobLogList.as_view()),
+	url(r'^job_log/(?P<id>' + OBJ_ID + ")/$", views.JobLogDetails.as_view()),
+
+	url(r'^share_weight/$', views.ShareWeightList.as_view()),
+	url(r'^share_weight/(?P<id>' + OBJ_ID + ")/$", views.ShareWeightDetails.as_view()),
+
 	url(r'^code/$', views.CodeList.as_view()),
 	url(r'^code/create/$', views.CodeCreate.as_view()),
 	url(r'^code/(?P<id>' + OBJ_ID + ")/$", views.CodeDetails.as_view()),
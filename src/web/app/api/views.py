@@ -24,8 +24,8 @@ from rest_framework.parsers import MultiPartParser,FormParser,FileUploadParser
 
 from rest_framework_mongoengine.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 
-from api.models import Image, OS, TmpFile, Code, Task, Job, Master, Slave, Result, DB, FileSet
-from api.serializers import OSSerializer, ImageSerializer, ImageImportSerializer, CodeSerializer, TaskSerializer, JobSerializer, MasterSerializer, SlaveSerializer, ResultSerializer, FileSetSerializer
+from api.models import Image, OS, TmpFile, Code, Task, Job, JobLog, ShareWeight, Master, Slave, Result, DB, FileSet
+from api.serializers import OSSerializer, ImageSerializer, ImageImportSerializer, CodeSerializer, TaskSerializer, JobSerializer, JobLogSerializer, ShareWeightSerializer, MasterSerializer, SlaveSerializer, ResultSerializer, FileSetSerializer
 
 class TalusRenderer(JSONRenderer):
 	def render(self, data, accepted_media_type=None, renderer_context=None):
@@ -358,11 +358,98 @@ class JobList(FilterableListView):
 	serializer_class = JobSerializer
 	model = Job
 
+class JobBulkCreate(APIView):
+	"""Create many jobs in one request. The request body must be a JSON list
+	of jobs, each with at least ``task`` and ``image`` ids. Jobs are inserted
+	with a single database operation and start running (status ``run``)
+	unless a different status is given.
+	"""
+	JOB_FIELDS = ["name", "task", "image", "params", "status", "queue", "priority", "limit",
+					"network", "debug", "vm_max", "preemptible", "tags"]
+
+	def post(self, request, format=None):
+		jobs_data = request.data
+		if not isinstance(jobs_data, list):
+			return Response({"status": "error", "message": "The request body must be a list of jobs"}, status=400)
+
+		task_ids = set()
+		image_ids = set()
+		for job_data in jobs_data:
+			if not isinstance(job_data, dict) or "task" not in job_data or "image" not in job_data:
+				return Response({"status": "error", "message": "Every job must have a task and an image"}, status=400)
+			task_ids.add(job_data["task"])
+			image_ids.add(job_data["image"])
+
+		# one query per referenced collection, not per job
+		try:
+			tasks = dict((str(task.id), task) for task in Task.objects(id__in=list(task_ids)))
+			images = dict((str(image.id), image) for image in Image.objects(id__in=list(image_ids)))
+		except Exception as e:
+			return Response({"status": "error", "message": "Invalid task or image id: {}".format(e)}, status=400)
+
+		jobs = []
+		now = time.time()
+		for idx,job_data in enumerate(jobs_data):
+			fields = dict((k, v) for k,v in job_data.iteritems() if k in self.JOB_FIELDS)
+			if fields["task"] not in tasks or fields["image"] not in images:
+				return Response({"status": "error", "message": "Job {} has an unknown task or image".format(idx)}, status=400)
+
+			fields["task"] = tasks[fields["task"]]
+			fields["image"] = images[fields["image"]]
+			fields.setdefault("status", {"name": "run"})
+
+			job = Job(**fields)
+			job.timestamps = {"created": now}
+			try:
+				job.validate()
+			except Exception as e:
+				return Response({"status": "error", "message": "Job {} is invalid: {}".format(idx, e)}, status=400)
+			jobs.append(job)
+
+		ids = []
+		if len(jobs) > 0:
+			ids = Job.objects.insert(jobs, load_bulk=False)
+
+		return Response({"status": "success", "ids": [str(id_) for id_ in ids]})
+
 class JobDetails(RetrieveUpdateDestroyAPIView):
 	renderer_classes = (TalusRenderer,)
 	queryset = Job.objects.all()
 	serializer_class = JobSerializer
 
+class JobLogList(FilterableListView):
+	"""Job errors and logs. Use the ``job``, ``type`` (error/log) and ``idx``
+	query params to filter them and ``num``/``skip`` to page through them.
+	"""
+	renderer_classes = (TalusRenderer,)
+	serializer_class = JobLogSerializer
+	model = JobLog
+
+	def get_queryset(self):
+		cursor = super(JobLogList, self).get_queryset()
+		if "sort" not in self.request.QUERY_PARAMS:
+			cursor = cursor.order_by("created")
+		return cursor
+
+class JobLogDetails(RetrieveUpdateDestroyAPIView):
+	renderer_classes = (TalusRenderer,)
+	queryset = JobLog.objects.all()
+	serializer_class = JobLogSerializer
+
+class ShareWeightList(FilterableListView):
+	"""The fair-share weights of job tags. Jobs are grouped by the first of
+	their tags that has a weight, and groups share the slaves in proportion to
+	their weights.
+	"""
+	renderer_classes = (TalusRenderer,)
+	serializer_class = ShareWeightSerializer
+	model = ShareWeight
+
+class ShareWeightDetails(RetrieveUpdateDestroyAPIView):
+	renderer_classes = (TalusRenderer,)
+	queryset = ShareWeight.objects.all()
+	serializer_class = ShareWeightSerializer
+
 class CodeList(FilterableListView):
 	renderer_classes = (TalusRenderer,)
 	serializer_class = CodeSerializer
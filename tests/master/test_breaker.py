@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.breaker import CircuitBreaker
+
+class CircuitBreakerTests(unittest.TestCase):
+	def setUp(self):
+		self.breaker = CircuitBreaker(window=10, min_samples=5, threshold=0.8, backoff=60, max_backoff=200)
+
+	def _fail(self, num, now=0):
+		for x in range(num):
+			self.breaker.record(False, now)
+
+	def test_needs_min_samples(self):
+		self._fail(4)
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+		self.assertEqual(self.breaker.allowed(0), None)
+
+		self._fail(1)
+		self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+		self.assertEqual(self.breaker.allowed(0), 0)
+
+	def test_below_threshold(self):
+		for x in range(20):
+			self.breaker.record(x % 2 == 0, 0)
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+	def test_probe_success_closes(self):
+		self._fail(5)
+		self.assertEqual(self.breaker.allowed(59), 0)
+		self.assertEqual(self.breaker.allowed(60), 1)
+
+		self.breaker.dispatched(60)
+		self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+		self.assertEqual(self.breaker.allowed(61), 0)
+
+		self.breaker.record(True, 100)
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+		self.assertEqual(self.breaker.allowed(100), None)
+
+	def test_probe_failure_backs_off(self):
+		self._fail(5)
+		self.breaker.dispatched(60)
+		self.breaker.record(False, 100)
+		self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+		self.assertEqual(self.breaker.allowed(219), 0)
+		self.assertEqual(self.breaker.allowed(220), 1)
+
+		self.breaker.dispatched(220)
+		self.breaker.record(False, 220)
+		# capped at max_backoff
+		self.assertEqual(self.breaker.allowed(419), 0)
+		self.assertEqual(self.breaker.allowed(420), 1)
+
+	def test_lost_probe(self):
+		breaker = CircuitBreaker(min_samples=1, threshold=1.0, backoff=10, probe_timeout=30)
+		breaker.record(False, 0)
+		breaker.dispatched(10)
+		self.assertEqual(breaker.allowed(40), 0)
+		self.assertEqual(breaker.allowed(41), 0)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+		self.assertEqual(breaker.allowed(61), 1)
+
+	def test_stale_outcomes_ignored_while_probing(self):
+		self._fail(5)
+		self.breaker.dispatched(60, item="probe")
+		self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+		# items that were running before the breaker opened finish first
+		self.breaker.record(True, 70, item="old_1")
+		self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+		self.breaker.record(False, 80, item="old_2")
+		self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+		self.assertEqual(self.breaker.allowed(90), 0)
+
+		self.breaker.record(True, 100, item="probe")
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+	def test_stale_failure_does_not_back_off(self):
+		self._fail(5)
+		self.breaker.dispatched(60, item="probe")
+		self.breaker.record(False, 70, item="old")
+		self.breaker.record(False, 100, item="probe")
+		# the backoff is only doubled once
+		self.assertEqual(self.breaker.allowed(219), 0)
+		self.assertEqual(self.breaker.allowed(220), 1)
+
+	def test_reset(self):
+		self._fail(5)
+		self.breaker.reset()
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+		self._fail(4)
+		self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib import codec
+
+class CodecTests(unittest.TestCase):
+	def test_json_round_trip(self):
+		msg = codec.JobProgress(job="abc", idx=3, attempt=1, amt=2)
+		body,props = codec.Codec("json").encode(msg)
+		self.assertEqual(props["content_type"], codec.CONTENT_TYPE_JSON)
+		self.assertNotIn("content_encoding", props)
+		self.assertEqual(codec.decode(body, props["content_type"]), dict(msg))
+
+	def test_plain_json(self):
+		# sent by older masters and slaves, without a content type
+		data = codec.decode(json.dumps({"type": "heartbeat"}))
+		self.assertEqual(data, {"type": "heartbeat"})
+
+	def test_compression(self):
+		msg = codec.JobLog(job="abc", idx=1, tool="fuzzer", data={"logs": ["x" * 100] * 100})
+		body,props = codec.Codec("json", compress_threshold=1000).encode(msg)
+		self.assertEqual(props["content_encoding"], codec.CONTENT_ENCODING_ZLIB)
+		self.assertLess(len(body), 1000)
+		self.assertEqual(codec.decode(body, props["content_type"], props["content_encoding"]), dict(msg))
+
+	@unittest.skipIf(codec.msgpack is None, "msgpack is not installed")
+	def test_msgpack_round_trip(self):
+		msg = codec.SlaveStatus(uuid="abc", running_vms=1, total_jobs_run=5, vms=[{"job": "def", "idx": 2}])
+		body,props = codec.Codec("msgpack").encode(msg)
+		self.assertEqual(props["content_type"], codec.CONTENT_TYPE_MSGPACK)
+		self.assertEqual(codec.decode(body, props["content_type"]), dict(msg))
+
+	def test_choose(self):
+		self.assertEqual(codec.choose([]), "json")
+		self.assertEqual(codec.choose(["json"]), "json")
+		self.assertEqual(codec.choose(["msgpack", "json"]), codec.available_codecs()[0])
+
+	def test_typed_messages(self):
+		self.assertRaises(codec.CodecError, codec.JobFinished, job="abc", idx=1)
+
+		data = codec.Message.from_dict({"type": "finished", "job": "abc", "idx": 1, "started": True})
+		self.assertIsInstance(data, codec.JobFinished)
+		self.assertRaises(codec.CodecError, codec.Message.from_dict, {"type": "taken", "job": "abc"})
+
+		# types without a class are passed through
+		self.assertEqual(codec.Message.from_dict({"type": "heartbeat"}), {"type": "heartbeat"})
+
+	def test_unknown_content_type(self):
+		self.assertRaises(codec.CodecError, codec.decode, "", "application/xml")
+
+	def test_version(self):
+		class Props(object):
+			def __init__(self, **kwargs):
+				self.__dict__.update(kwargs)
+
+		msg = codec.JobProgress(job="abc", idx=3, attempt=1, amt=2)
+		body,props = codec.Codec("json").encode(msg)
+		self.assertEqual(codec.decode_props(body, Props(**props)), dict(msg))
+
+		# older masters and slaves don't send any properties
+		self.assertEqual(codec.decode_props(body, Props()), dict(msg))
+		self.assertEqual(codec.decode_props(body, Props(headers=None)), dict(msg))
+
+		props["headers"] = {"version": codec.VERSION + 1}
+		self.assertRaises(codec.CodecError, codec.decode_props, body, Props(**props))
+		props["headers"] = {"version": "1"}
+		self.assertRaises(codec.CodecError, codec.decode_props, body, Props(**props))
+
+if __name__ == "__main__":
+	unittest.main()
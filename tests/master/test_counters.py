@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.counters import CoalescedCounters
+
+JOB1 = "5501a0000000000000000001"
+JOB2 = "5501a0000000000000000002"
+
+class FakeBulk(object):
+	def __init__(self, collection):
+		self._collection = collection
+		self._ops = []
+		self._selector = None
+
+	def find(self, selector):
+		self._selector = selector
+		return self
+
+	def update_one(self, update):
+		self._ops.append((str(self._selector["_id"]), update["$inc"]))
+
+	def execute(self):
+		if self._collection.fail:
+			raise Exception("database unavailable")
+		self._collection.executed.append(dict(self._ops))
+
+class FakeCollection(object):
+	def __init__(self):
+		self.executed = []
+		self.fail = False
+
+	def initialize_unordered_bulk_op(self):
+		return FakeBulk(self)
+
+class FakeJob(object):
+	collection = FakeCollection()
+
+	@classmethod
+	def _get_collection(cls):
+		return cls.collection
+
+class CoalescedCountersTests(unittest.TestCase):
+	def setUp(self):
+		FakeJob.collection = FakeCollection()
+		self.counters = CoalescedCounters(FakeJob)
+
+	def test_coalesces_increments(self):
+		for x in range(10):
+			self.counters.inc(JOB1, "progress")
+		self.counters.inc(JOB1, "progress", 5)
+		self.counters.inc(JOB2, "progress", 2)
+		self.counters.inc(JOB2, "errors")
+		self.counters.flush()
+
+		# one update per document, in one bulk write
+		self.assertEqual(FakeJob.collection.executed, [{
+			JOB1: {"progress": 15},
+			JOB2: {"progress": 2, "errors": 1},
+		}])
+
+	def test_flush_clears_pending(self):
+		self.counters.inc(JOB1, "progress")
+		self.counters.flush()
+		self.counters.flush()
+		self.assertEqual(len(FakeJob.collection.executed), 1)
+
+		self.counters.inc(JOB1, "progress", 3)
+		self.counters.flush()
+		self.assertEqual(FakeJob.collection.executed[-1], {JOB1: {"progress": 3}})
+
+	def test_failed_flush_is_retried(self):
+		self.counters.inc(JOB1, "progress", 4)
+		FakeJob.collection.fail = True
+		self.counters.flush()
+		self.assertEqual(FakeJob.collection.executed, [])
+
+		# increments made while the write failed are added to the retried ones
+		self.counters.inc(JOB1, "progress", 1)
+		FakeJob.collection.fail = False
+		self.counters.flush()
+		self.assertEqual(FakeJob.collection.executed, [{JOB1: {"progress": 5}}])
+
+if __name__ == "__main__":
+	unittest.main()
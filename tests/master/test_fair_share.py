@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.fair_share import BandedRoundRobin, DeficitRoundRobin
+
+class DeficitRoundRobinTests(unittest.TestCase):
+	def setUp(self):
+		self.drr = DeficitRoundRobin()
+
+	def _simulate(self, weights, rounds, drip_size=25, capacities=None):
+		if capacities is None:
+			capacities = {}
+
+		totals = dict((key, 0) for key in weights)
+		for x in range(rounds):
+			entries = [(key, weight, capacities.get(key)) for key,weight in sorted(weights.items())]
+			for key,count in self.drr.allocate(drip_size, entries):
+				totals[key] += count
+		return totals
+
+	def test_shares_converge(self):
+		weights = {"a": 90, "b": 50, "c": 20, "d": 1}
+		totals = self._simulate(weights, 2000)
+
+		total_dripped = float(sum(totals.values()))
+		total_weight = float(sum(weights.values()))
+		self.assertEqual(total_dripped, 2000 * 25)
+		for key,weight in weights.items():
+			expected = weight / total_weight
+			actual = totals[key] / total_dripped
+			self.assertAlmostEqual(expected, actual, delta=0.005)
+
+	def test_low_priority_not_starved(self):
+		weights = {"high_1": 100, "high_2": 100, "low": 5}
+		totals = self._simulate(weights, 20)
+		self.assertTrue(totals["low"] > 0)
+
+	def test_capacity_respected(self):
+		weights = {"a": 50, "b": 50}
+		totals = self._simulate(weights, 10, capacities={"a": 2})
+		self.assertEqual(totals["a"], 20)
+		self.assertEqual(totals["b"], 230)
+
+	def test_nothing_to_allocate(self):
+		self.assertEqual(self.drr.allocate(25, []), [])
+		self.assertEqual(self.drr.allocate(25, [("a", 50, 0)]), [])
+		self.assertEqual(self.drr.allocate(0, [("a", 50, None)]), [])
+
+	def test_absent_keys_keep_deficit(self):
+		# an allocation may only cover some of the keys (e.g. the jobs whose
+		# image a slave has cached), which must not reset the others' deficits
+		self.drr.allocate(1, [("b", 50, None), ("a", 100, None)])
+		self.assertEqual(self.drr._deficits["b"], 0.5)
+
+		self.drr.allocate(5, [("a", 100, None)])
+		self.assertEqual(self.drr._deficits["b"], 0.5)
+
+	def test_remove_drops_deficit(self):
+		self.drr.allocate(1, [("b", 50, None), ("a", 100, None)])
+		self.drr.remove("b")
+		self.assertNotIn("b", self.drr._deficits)
+
+		# a re-added key starts from scratch
+		self.drr.allocate(1, [("a", 100, None), ("b", 50, None)])
+		self.assertEqual(self.drr._deficits["b"], 0.5)
+
+class BandedRoundRobinTests(unittest.TestCase):
+	def setUp(self):
+		self.brr = BandedRoundRobin()
+
+	def _simulate(self, bands, rounds, drip_size=25):
+		totals = {}
+		for x in range(rounds):
+			for band,key,count in self.brr.allocate(drip_size, bands):
+				totals[key] = totals.get(key, 0) + count
+		return totals
+
+	def test_equal_unlimited_jobs_share(self):
+		# two unlimited jobs of the same priority split every drip, the first
+		# one visited doesn't take the whole band
+		bands = [("priority_50", [("a", 50, None), ("b", 50, None)])]
+		for x in range(10):
+			counts = dict((key, count) for band,key,count in self.brr.allocate(10, bands))
+			self.assertEqual(counts, {"a": 5, "b": 5})
+
+		totals = self._simulate(bands, 9, drip_size=25)
+		self.assertAlmostEqual(totals["a"], totals["b"], delta=1)
+
+	def test_bands_then_jobs(self):
+		bands = [
+			("priority_90", [("high", 90, None)]),
+			("priority_10", [("low_1", 10, None), ("low_2", 10, None)]),
+		]
+		totals = self._simulate(bands, 1100)
+
+		total = float(sum(totals.values()))
+		self.assertAlmostEqual(totals["high"] / total, 90 / 110.0, delta=0.005)
+		self.assertAlmostEqual(totals["low_1"] / total, 10 / 110.0, delta=0.005)
+		self.assertAlmostEqual(totals["low_2"] / total, 10 / 110.0, delta=0.005)
+
+	def test_capacity(self):
+		bands = [("priority_50", [("a", 50, 2), ("b", 50, None)])]
+		counts = dict((key, count) for band,key,count in self.brr.allocate(10, bands))
+		self.assertEqual(counts, {"a": 2, "b": 8})
+
+		# a band with no capacity gives its share to the others
+		bands = [
+			("priority_50", [("a", 50, 0)]),
+			("priority_10", [("c", 10, None)]),
+		]
+		self.assertEqual(self.brr.allocate(10, bands), [("priority_10", "c", 10)])
+
+	def test_refund(self):
+		bands = [("priority_50", [("a", 50, None), ("b", 50, None)])]
+		self.brr.allocate(2, bands)
+		# a could not use its item, so it is owed one
+		self.brr.refund("priority_50", "a", 1)
+		counts = dict((key, count) for band,key,count in self.brr.allocate(3, bands))
+		self.assertEqual(counts, {"a": 2, "b": 1})
+
+	def test_remove(self):
+		bands = [("priority_50", [("b", 25, None), ("a", 50, None)])]
+		self.brr.allocate(1, bands)
+		self.brr.remove("priority_50", "b")
+		self.assertNotIn("b", self.brr._entries["priority_50"]._deficits)
+
+		self.brr.remove("priority_50")
+		self.assertNotIn("priority_50", self.brr._entries)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.ingest import BulkInserter
+
+class FakeObjects(object):
+	def __init__(self):
+		self.batches = []
+		self.inserted = threading.Event()
+
+	def insert(self, docs, load_bulk=True):
+		self.batches.append(list(docs))
+		self.inserted.set()
+
+class FakeResult(object):
+	objects = FakeObjects()
+
+class BulkInserterTests(unittest.TestCase):
+	def setUp(self):
+		FakeResult.objects = FakeObjects()
+		self.inserter = None
+
+	def tearDown(self):
+		if self.inserter is not None:
+			self.inserter.stop()
+			self.inserter.join(5)
+
+	def _start(self, batch_size, max_latency):
+		self.inserter = BulkInserter(FakeResult, batch_size=batch_size, max_latency=max_latency)
+		self.inserter.start()
+		self.inserter._running.wait(5)
+
+	def test_flush_splits_batches(self):
+		inserter = BulkInserter(FakeResult, batch_size=3)
+		for x in range(7):
+			inserter.add(x)
+		inserter.flush()
+		self.assertEqual(FakeResult.objects.batches, [[0, 1, 2], [3, 4, 5], [6]])
+
+	def test_flush_on_size(self):
+		# the latency is long enough that only a full batch can trigger a flush
+		self._start(batch_size=5, max_latency=60)
+		for x in range(4):
+			self.inserter.add(x)
+		time.sleep(0.1)
+		self.assertEqual(FakeResult.objects.batches, [])
+
+		self.inserter.add(4)
+		self.assertTrue(FakeResult.objects.inserted.wait(5))
+		self.assertEqual(FakeResult.objects.batches, [[0, 1, 2, 3, 4]])
+
+	def test_flush_on_interval(self):
+		self._start(batch_size=100, max_latency=0.1)
+		start = time.time()
+		self.inserter.add("doc")
+		self.assertTrue(FakeResult.objects.inserted.wait(5))
+		self.assertEqual(FakeResult.objects.batches, [["doc"]])
+		self.assertLess(time.time() - start, 1.0)
+
+	def test_stop_flushes(self):
+		self._start(batch_size=100, max_latency=60)
+		self.inserter.add("doc")
+		self.inserter.stop()
+		self.inserter.join(5)
+		self.assertEqual(FakeResult.objects.batches, [["doc"]])
+
+if __name__ == "__main__":
+	unittest.main()
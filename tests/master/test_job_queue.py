@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.job_queue import JobQueue
+
+class JobQueueTests(unittest.TestCase):
+	def setUp(self):
+		self.queue = JobQueue()
+
+	def _drain(self):
+		res = []
+		while len(self.queue) > 0:
+			res.append(self.queue.pop())
+		return res
+
+	def test_ordering(self):
+		priorities = list(range(200))
+		random.shuffle(priorities)
+		for p in priorities:
+			self.queue.put("job_{}".format(p), p, p)
+
+		self.assertEqual([x[0] for x in self._drain()], sorted(priorities))
+
+	def test_fifo_for_equal_priorities(self):
+		for x in range(10):
+			self.queue.put("job_{}".format(x), 50, x)
+
+		self.assertEqual([x[1] for x in self._drain()], list(range(10)))
+
+	def test_snapshot_does_not_mutate(self):
+		for x in range(20):
+			self.queue.put("job_{}".format(x), random.randint(0, 5), x)
+
+		snap1 = self.queue.snapshot()
+		snap2 = self.queue.snapshot()
+		self.assertEqual(len(self.queue), 20)
+		self.assertEqual(snap1, snap2)
+		self.assertEqual(snap1, self._drain())
+
+	def test_remove(self):
+		for x in range(50):
+			self.queue.put("job_{}".format(x), x % 7, x)
+
+		removed = set()
+		for x in random.sample(range(50), 20):
+			self.assertEqual(self.queue.remove("job_{}".format(x)), x)
+			removed.add(x)
+
+		self.assertIsNone(self.queue.remove("job_0" if 0 in removed else "nope"))
+		self.assertFalse("job_{}".format(list(removed)[0]) in self.queue)
+
+		drained = self._drain()
+		self.assertEqual(sorted(x[1] for x in drained), sorted(set(range(50)) - removed))
+		self.assertEqual([x[0] for x in drained], sorted(x[0] for x in drained))
+
+	def test_update(self):
+		for x in range(10):
+			self.queue.put("job_{}".format(x), 100 + x, x)
+
+		self.queue.update("job_9", 1)
+		self.queue.update("job_0", 500)
+		self.assertEqual(self.queue.peek(), (1, 9))
+		self.assertEqual(self._drain()[-1], (500, 0))
+
+	def test_put_existing_replaces(self):
+		self.queue.put("job", 10, "a")
+		self.queue.put("job", 5, "b")
+		self.assertEqual(len(self.queue), 1)
+		self.assertEqual(self.queue.get("job"), "b")
+		self.assertEqual(self.queue.priority("job"), 5)
+
+if __name__ == "__main__":
+	unittest.main()
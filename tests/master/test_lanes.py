@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.lanes import LanePool
+
+class LanePoolTests(unittest.TestCase):
+	def test_same_key_in_order(self):
+		handled = {}
+		lock = threading.Lock()
+		def callback(item):
+			key,num = item
+			with lock:
+				handled.setdefault(key, []).append(num)
+
+		pool = LanePool(callback, num_lanes=3)
+		pool.start()
+		for num in range(100):
+			for key in ["a", "b", "c", "d"]:
+				pool.submit(key, (key, num))
+		pool.stop()
+		for lane in pool._lanes:
+			lane.join(5)
+
+		for key in ["a", "b", "c", "d"]:
+			self.assertEqual(handled[key], range(100))
+
+	def test_errors_dont_stop_lane(self):
+		handled = []
+		def callback(item):
+			if item == 0:
+				raise ValueError("bad item")
+			handled.append(item)
+
+		pool = LanePool(callback, num_lanes=1)
+		pool.start()
+		pool.submit("job", 0)
+		pool.submit("job", 1)
+		pool.stop()
+		pool._lanes[0].join(5)
+
+		self.assertEqual(handled, [1])
+		self.assertEqual(pool.stats()["handled"], [2])
+
+	def test_stats(self):
+		pool = LanePool(lambda item: None, num_lanes=2)
+		# not started, so nothing is taken off of the lanes
+		for x in range(5):
+			pool.submit("job", x)
+
+		stats = pool.stats()
+		self.assertEqual(sorted(stats["depths"]), [0, 5])
+		self.assertEqual(sorted(stats["peaks"]), [0, 5])
+		# peaks are reset by each call
+		pool._lanes[0].queue.queue.clear()
+		pool._lanes[1].queue.queue.clear()
+		self.assertEqual(pool.stats()["peaks"], [0, 0])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.rate import RateEstimator, TokenBucket, estimate_eta
+
+class RateEstimatorTests(unittest.TestCase):
+	def test_starts_at_zero(self):
+		rate = RateEstimator(tau=10, now=0)
+		self.assertEqual(rate.rate, 0.0)
+		rate.sample(0)
+		self.assertEqual(rate.rate, 0.0)
+
+	def test_ewma(self):
+		rate = RateEstimator(tau=10, now=0)
+		rate.add(20)
+		rate.sample(10)
+
+		# one time constant of 2/s moves the estimate 1 - 1/e of the way there
+		self.assertAlmostEqual(rate.rate, 2.0 * (1 - math.exp(-1)))
+
+		rate.add(20)
+		rate.sample(20)
+		self.assertAlmostEqual(rate.rate, 2.0 * (1 - math.exp(-2)))
+
+	def test_converges(self):
+		rate = RateEstimator(tau=10, now=0)
+		for now in range(1, 200):
+			rate.add(5)
+			rate.sample(now)
+		self.assertAlmostEqual(rate.rate, 5.0)
+
+	def test_independent_of_sample_rate(self):
+		# a constant rate gives the same estimate however often it is sampled
+		coarse = RateEstimator(tau=10, now=0)
+		fine = RateEstimator(tau=10, now=0)
+
+		coarse.add(30)
+		coarse.sample(30)
+		for now in range(1, 31):
+			fine.add(1)
+			fine.sample(now)
+
+		self.assertAlmostEqual(coarse.rate, fine.rate)
+
+	def test_decays_when_idle(self):
+		rate = RateEstimator(tau=10, now=0)
+		for now in range(1, 100):
+			rate.add(4)
+			rate.sample(now)
+		before = rate.rate
+
+		rate.sample(109)
+		self.assertAlmostEqual(rate.rate, before * math.exp(-1))
+
+	def test_sample_ignores_no_elapsed_time(self):
+		rate = RateEstimator(tau=10, now=0)
+		rate.add(10)
+		rate.sample(0)
+		self.assertEqual(rate.rate, 0.0)
+
+		# the events are still counted by the next sample
+		rate.sample(10)
+		self.assertAlmostEqual(rate.rate, 1.0 * (1 - math.exp(-1)))
+
+	def test_warmed_up(self):
+		rate = RateEstimator(tau=10, now=100)
+		self.assertFalse(rate.warmed_up(105))
+		self.assertTrue(rate.warmed_up(110))
+
+class EstimateEtaTests(unittest.TestCase):
+	def test_unknown(self):
+		self.assertEqual(estimate_eta(None, 10, 1, 0), None)
+		self.assertEqual(estimate_eta(10, None, 1, 0), None)
+
+	def test_serial(self):
+		self.assertEqual(estimate_eta(5, 10, 1, 1000), 1050)
+
+	def test_parallel(self):
+		# 10 items four at a time take three rounds
+		self.assertEqual(estimate_eta(10, 60, 4, 1000), 1180)
+
+	def test_no_parallelism(self):
+		# a job with nothing outstanding is assumed to run one item at a time
+		self.assertEqual(estimate_eta(3, 10, 0, 0), 30)
+
+	def test_done(self):
+		self.assertEqual(estimate_eta(0, 10, 2, 500), 500)
+
+class TokenBucketTests(unittest.TestCase):
+	def test_burst(self):
+		bucket = TokenBucket(rate=1, burst=3, now=0)
+		self.assertEqual([bucket.take(0) for x in range(4)], [True, True, True, False])
+
+	def test_overdraw(self):
+		# taking from an empty bucket fails and does not go into debt
+		bucket = TokenBucket(rate=1, burst=1, now=0)
+		self.assertTrue(bucket.take(0))
+		for x in range(10):
+			self.assertFalse(bucket.take(0))
+		self.assertTrue(bucket.take(1))
+
+	def test_refill(self):
+		bucket = TokenBucket(rate=0.5, burst=2, now=0)
+		bucket.take(0)
+		bucket.take(0)
+		self.assertFalse(bucket.take(1))
+		# the half token from the failed take is kept
+		self.assertTrue(bucket.take(2))
+		self.assertFalse(bucket.take(2))
+
+	def test_refill_capped_at_burst(self):
+		bucket = TokenBucket(rate=1, burst=2, now=0)
+		bucket.take(0)
+		bucket.take(0)
+		self.assertEqual([bucket.take(1000) for x in range(3)], [True, True, False])
+
+if __name__ == "__main__":
+	unittest.main()
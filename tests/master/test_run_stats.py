@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.run_stats import RunningStats
+
+class RunningStatsTests(unittest.TestCase):
+	def test_empty(self):
+		stats = RunningStats()
+		self.assertEqual(stats.count, 0)
+		self.assertEqual(stats.variance, 0.0)
+
+	def test_mean_and_variance(self):
+		values = [2, 4, 4, 4, 5, 5, 7, 9]
+		stats = RunningStats()
+		for value in values:
+			stats.add(value)
+
+		mean = sum(values) / float(len(values))
+		variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+		self.assertEqual(stats.count, len(values))
+		self.assertAlmostEqual(stats.mean, mean)
+		self.assertAlmostEqual(stats.variance, variance)
+
+	def test_resume(self):
+		# stats loaded from the database continue where they left off
+		first = RunningStats()
+		for value in [10, 20, 30]:
+			first.add(value)
+
+		resumed = RunningStats(first.count, first.mean, first.m2)
+		straight = RunningStats()
+		for value in [10, 20, 30, 40, 50]:
+			straight.add(value)
+		for value in [40, 50]:
+			resumed.add(value)
+
+		self.assertAlmostEqual(resumed.mean, straight.mean)
+		self.assertAlmostEqual(resumed.variance, straight.variance)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+
+from master.lib.jobs.wait_times import WaitTimes, aged_order_key, percentile
+
+class WaitTimesTests(unittest.TestCase):
+	def test_percentile(self):
+		values = range(1, 101)
+		self.assertEqual(percentile(values, 0), 1)
+		self.assertEqual(percentile(values, 50), 51)
+		self.assertEqual(percentile(values, 99), 99)
+		self.assertEqual(percentile(values, 100), 100)
+		self.assertEqual(percentile([], 50), None)
+
+	def test_summary(self):
+		waits = WaitTimes()
+		for wait in range(100):
+			waits.add("priority_20", wait)
+		waits.add("priority_90", 0.5)
+
+		summary = waits.summary()
+		self.assertEqual(summary["priority_20"]["count"], 100)
+		self.assertEqual(summary["priority_20"]["p90"], 89)
+		self.assertEqual(summary["priority_90"]["p50"], 0.5)
+		self.assertEqual(summary["priority_90"]["p99"], 0.5)
+
+	def test_window(self):
+		waits = WaitTimes(window=10)
+		for wait in range(100):
+			waits.add("a", wait)
+
+		summary = waits.summary()
+		self.assertEqual(summary["a"]["count"], 10)
+		self.assertEqual(summary["a"]["p50"], 95)
+
+class AgedOrderKeyTests(unittest.TestCase):
+	def test_least_work_first(self):
+		short = aged_order_key(50, 10, 5, 1.0/60)
+		long = aged_order_key(50, 20, 500, 1.0/60)
+		self.assertLess(short, long)
+
+	def test_waited_longer_first(self):
+		short = aged_order_key(50, 10, 5, 1.0/60)
+		long = aged_order_key(50, 70, 500, 1.0/60)
+		self.assertLess(long, short)
+
+	def _simulate(self, aging_rate, ticks):
+		# one item is dripped per second to the first job in order, while a
+		# new one-item job arrives every second
+		long_start = 0
+		short_starts = []
+		long_served = []
+		for now in range(ticks):
+			short_starts.append(now)
+			entries = [(aged_order_key(50, now - long_start, 1000, aging_rate), "long", None)]
+			for start in short_starts:
+				entries.append((aged_order_key(50, now - start, 1, aging_rate), "short", start))
+			entries.sort()
+
+			order,name,start = entries[0]
+			if name == "long":
+				long_served.append(now - long_start)
+				long_start = now
+			else:
+				short_starts.remove(start)
+		return long_served
+
+	def test_long_job_not_starved(self):
+		# the long job is served once it has aged a whole priority past
+		# the new short jobs
+		waits = self._simulate(1.0/60, 600)
+		self.assertGreaterEqual(len(waits), 9)
+		self.assertLessEqual(max(waits), 61)
+
+		waits = self._simulate(10, 1500)
+		self.assertGreater(len(waits), 0)
+
+if __name__ == "__main__":
+	unittest.main()